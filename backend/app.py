@@ -1,12 +1,155 @@
-from flask import Flask, request, jsonify
+import json
+import time
+
+import psycopg2
+import requests
+from flask import Flask, Response, request, jsonify, stream_with_context, g
 from flask_cors import CORS
-from sql_generator import generate_sql_query, execute_sql_query
+from sql_generator import (resolve_sql_query, execute_sql_query, generate_sql_query_events, stream_sql_query,
+                           shutdown_candidate_executor)
+from db_pool import get_pool, close_pool, PoolTimeout
+from ollama_client import get_ollama_client, close_ollama_client
+from sql_cache import close_sql_cache, get_sql_cache
+from few_shot import get_example_library
+from embeddings import embed_text
+from result_cache import get_result_cache, RESULT_CACHE_ENABLED, RESULT_CACHE_STREAM_MAX_ROWS
+from intent_router import get_intent_router
+from tenancy import resolve_user_id, row_security_problems, scope_sql, TenantError
+from query_batch import answer_batch, BATCH_CONCURRENCY, BATCH_MAX_QUESTIONS
+from sql_guard import guard_sql, SQLGuardError, stats as sql_guard_stats
+import metrics
 
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
+metrics.REGISTRY.add_gauges("db_pool", lambda: get_pool().stats())
+metrics.REGISTRY.add_gauges("sql_cache", lambda: get_sql_cache().stats())
+metrics.REGISTRY.add_gauges("intent_router", lambda: get_intent_router().stats())
+metrics.REGISTRY.add_gauges("result_cache", lambda: get_result_cache().stats())
+metrics.REGISTRY.add_gauges("sql_guard", sql_guard_stats)
+metrics.REGISTRY.add_gauges("ollama_client", lambda: get_ollama_client().stats())
+
+
+def check_row_security():
+    """Warn when the row-level security policies can't isolate athletes for the backend's role."""
+    with get_pool().connection() as conn:
+        for problem in row_security_problems(conn):
+            print(f"⚠️ Athletes are only separated by SQL rewriting: {problem} "
+                  f"(see `python backend/tenancy.py status`)")
+
+
+def warm_up(ollama=True):
+    """
+    Load what the first request would otherwise wait for: the Ollama model (kept loaded with
+    keep_alive), the connection pool, the SQL cache, templates, few-shot examples and MiniLM.
+    Failures are reported but don't stop the server; requests load lazily as before.
+    """
+    steps = [("db_pool", lambda: get_pool().stats()),
+             ("row_security", check_row_security),
+             ("result_cache", lambda: get_result_cache().generation()),
+             ("sql_cache", get_sql_cache),
+             ("intent_router", get_intent_router),
+             ("few_shot", get_example_library),
+             ("embeddings", lambda: embed_text("warm up"))]
+    if ollama:
+        steps.insert(0, ("ollama", lambda: get_ollama_client().warmup()))
+    timings = []
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"⚠️ Warm-up of {name} failed: {e}")
+            continue
+        timings.append(f"{name} {time.perf_counter() - start:.2f}s")
+    print("✅ Warmed up: " + ", ".join(timings))
+
+
+def shut_down():
+    """Release connections and threads once in-flight requests have finished."""
+    shutdown_candidate_executor()
+    close_ollama_client()
+    close_sql_cache()
+    close_pool()
+
+@app.before_request
+def start_request_tracking():
+    """Give every request an ID and a context for stage timings."""
+    g.request_ctx = metrics.start_request(request.headers.get("X-Request-ID"))
+
+@app.after_request
+def finish_request_tracking(response):
+    """Log and record the request once the body (including streamed bodies) has been sent."""
+    ctx = g.get("request_ctx")
+    if ctx is None or request.path == "/metrics":
+        return response
+    response.headers["X-Request-ID"] = ctx["request_id"]
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    response.call_on_close(lambda: metrics.finish_request(ctx, endpoint, response.status_code))
+    return response
+
+def _bypass_result_cache():
+    """Clients can force a fresh read with `Cache-Control: no-cache` or `X-Bypass-Cache: 1`."""
+    return (not RESULT_CACHE_ENABLED
+            or "no-cache" in request.headers.get("Cache-Control", "")
+            or request.headers.get("X-Bypass-Cache", "").lower() in ("1", "true"))
+
+def _cached_results(sql_query, bypass=False):
+    """Results from the result cache, or None; returns (results, cache status)."""
+    if bypass:
+        get_result_cache().record_bypass()
+        return None, "bypass"
+    with metrics.stage("result_cache_lookup"):
+        results = get_result_cache().get(sql_query)
+    return results, "hit" if results is not None else "miss"
+
+def _request_user_id(data):
+    """Athlete the request is scoped to (body `user_id` or `X-User-ID` header)."""
+    user_id = resolve_user_id(data.get("user_id"), request.headers.get("X-User-ID"))
+    metrics.annotate(user_id=user_id)
+    return user_id
+
+def _answer_question(user_question, user_id, bypass_cache):
+    """
+    Generate, scope, guard and run SQL for one question.
+
+    Returns (body, status, result cache status); shared by /query and /query/batch, so it
+    must not touch the Flask request.
+    """
+    sql_query, source = resolve_sql_query(user_question, user_id)
+    print(f"Generated SQL ({source}): {sql_query}")
+    metrics.annotate(source=source)
+
+    if sql_query.lower().startswith("error"):
+        return {"error": sql_query}, 400, None  # Changed from 500 to 400
+    try:
+        scoped_sql = guard_sql(scope_sql(sql_query, user_id))
+    except (TenantError, SQLGuardError) as e:
+        metrics.annotate(error=str(e))
+        if source != "template":
+            get_sql_cache().invalidate(user_question, sql_query)
+        return {"error": str(e), "source": source}, 400, None
+    results, cache_status = _cached_results(scoped_sql, bypass_cache)
+    metrics.annotate(result_cache=cache_status)
+    if results is None:
+        try:
+            results = execute_sql_query(scoped_sql, user_id=user_id)
+        except SQLGuardError as e:
+            metrics.annotate(error=str(e))
+            if source != "template":
+                get_sql_cache().invalidate(user_question, sql_query)
+            return {"error": str(e), "source": source}, 400, cache_status
+        if results is None:
+            if source != "template":
+                get_sql_cache().invalidate(user_question, sql_query)  # don't keep serving SQL that fails
+            return {"error": "Failed to execute query", "source": source}, 500, cache_status
+        if cache_status == "miss":
+            get_result_cache().put(scoped_sql, results)
+
+    return {"sql_query": sql_query, "source": source, "results": results}, 200, cache_status
+
 @app.route("/query", methods=["POST"])
 def query():
     """API endpoint to handle user questions."""
@@ -14,16 +157,202 @@ def query():
     user_question = data.get("question", "").strip()
     if not user_question:
         return jsonify({"error": "No question provided"}), 400
-    sql_query = generate_sql_query(user_question)
-    print(f"Generated SQL: {sql_query}")
+    try:
+        user_id = _request_user_id(data)
+    except TenantError as e:
+        return jsonify({"error": str(e)}), 400
+    body, status, cache_status = _answer_question(user_question, user_id, _bypass_result_cache())
+    response = jsonify(body)
+    response.status_code = status
+    if status == 200:
+        response.headers["X-Result-Cache"] = cache_status
+    return response
 
-    if sql_query.lower().startswith("error"):
-        return jsonify({"error": sql_query}), 400  # Changed from 500 to 400
-    results = execute_sql_query(sql_query)
-    if results is None:
-        return jsonify({"error": "Failed to execute query"}), 500
+def _ndjson(event):
+    """Serialize one streamed event as a line of NDJSON."""
+    return json.dumps(event, default=str) + "\n"
+
+@app.route("/query/stream", methods=["POST"])
+def query_stream():
+    """
+    Streaming version of /query, as NDJSON events in three phases:
+    SQL tokens while the LLM generates, result rows in batches, then a timing summary.
+    """
+    data = request.get_json()
+    user_question = data.get("question", "").strip()
+    if not user_question:
+        return jsonify({"error": "No question provided"}), 400
+    batch_size = int(data.get("batch_size", 100))
+    try:
+        user_id = _request_user_id(data)
+    except TenantError as e:
+        return jsonify({"error": str(e)}), 400
+    ctx = metrics.current_request()
+    bypass_cache = _bypass_result_cache()
+
+    def generate():
+        metrics.use_request(ctx)
+        start = time.perf_counter()
+        sql_query, source = None, None
+        first_token_ms = None
+        try:
+            for event in generate_sql_query_events(user_question, user_id):
+                if event["phase"] == "sql" and first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                if event["phase"] == "sql_done":
+                    sql_query, source = event["sql_query"], event["source"]
+                    metrics.annotate(source=source)
+                yield _ndjson(event)
+        except requests.exceptions.RequestException as e:
+            metrics.annotate(error=f"Error querying Ollama: {e}")
+            yield _ndjson({"phase": "error", "error": f"Error querying Ollama: {e}"})
+            return
+        generated = time.perf_counter()
+
+        try:
+            scoped_sql = guard_sql(scope_sql(sql_query, user_id))
+        except (TenantError, SQLGuardError) as e:
+            metrics.annotate(error=str(e))
+            if source != "template":
+                get_sql_cache().invalidate(user_question, sql_query)
+            yield _ndjson({"phase": "error", "error": str(e)})
+            return
+
+        row_count = 0
+        first_row_ms = None
+        cached, cache_status = _cached_results(scoped_sql, bypass_cache)
+        metrics.annotate(result_cache=cache_status)
+        if cached is not None:
+            batches = (cached[i:i + batch_size] for i in range(0, len(cached), batch_size))
+        else:
+            batches = stream_sql_query(scoped_sql, batch_size=batch_size, user_id=user_id)
+        collected = [] if cache_status == "miss" else None  # small results are kept for the result cache
+        try:
+            for rows in batches:
+                if first_row_ms is None:
+                    first_row_ms = (time.perf_counter() - generated) * 1000
+                row_count += len(rows)
+                if collected is not None and row_count <= RESULT_CACHE_STREAM_MAX_ROWS:
+                    collected.extend(rows)
+                else:
+                    collected = None
+                yield _ndjson({"phase": "rows", "rows": rows})
+        except (psycopg2.Error, PoolTimeout) as e:
+            print(f"Error executing SQL query: {e}")
+            metrics.annotate(error=str(e).strip())
+            if source != "template":
+                get_sql_cache().invalidate(user_question, sql_query)
+            yield _ndjson({"phase": "error", "error": "Failed to execute query"})
+            return
+        except SQLGuardError as e:
+            metrics.annotate(error=str(e))
+            if source != "template":
+                get_sql_cache().invalidate(user_question, sql_query)
+            yield _ndjson({"phase": "error", "error": str(e)})
+            return
+        done = time.perf_counter()
+        metrics.annotate(row_count=row_count)
+        if collected is not None:
+            get_result_cache().put(scoped_sql, collected)
+
+        yield _ndjson({
+            "phase": "summary",
+            "row_count": row_count,
+            "source": source,
+            "result_cache": cache_status,
+            "request_id": ctx["request_id"],
+            "timings_ms": {
+                "first_token": round(first_token_ms or 0.0, 1),
+                "generation": round((generated - start) * 1000, 1),
+                "first_row": round(first_row_ms or 0.0, 1),
+                "execution": round((done - generated) * 1000, 1),
+                "total": round((done - start) * 1000, 1),
+            },
+        })
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/query/batch", methods=["POST"])
+def query_batch():
+    """
+    Answer a list of questions in one request. Duplicates and near-duplicates are answered once;
+    distinct questions run concurrently (`concurrency`, capped at BATCH_CONCURRENCY).
+
+    Returns {"results": [...], "summary": {...}} in question order, or with `"stream": true`
+    NDJSON: one {"phase": "item", ...} event per question as it completes, then a summary.
+    Every item carries its status, error (if any) and stage timings.
+    """
+    data = request.get_json()
+    questions = data.get("questions")
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"error": "No questions provided"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"At most {BATCH_MAX_QUESTIONS} questions per batch"}), 400
+    if not all(isinstance(q, str) and q.strip() for q in questions):
+        return jsonify({"error": "Questions must be non-empty strings"}), 400
+    questions = [q.strip() for q in questions]
+    try:
+        user_id = _request_user_id(data)
+    except TenantError as e:
+        return jsonify({"error": str(e)}), 400
+    concurrency = max(1, min(int(data.get("concurrency", BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+    bypass_cache = _bypass_result_cache()
+    ctx = metrics.current_request()
+    metrics.annotate(batch_size=len(questions))
+
+    def answer(question):
+        body, status, _ = _answer_question(question, user_id, bypass_cache)
+        return body, status
+
+    def summary(items, start):
+        answered = [item for item in items if "duplicate_of" not in item]
+        return {
+            "questions": len(items),
+            "unique": len(answered),
+            "errors": sum(1 for item in items if item["status"] != 200),
+            "request_id": ctx["request_id"],
+            "timings_ms": {
+                "total": round((time.perf_counter() - start) * 1000, 1),
+                # what answering the distinct questions one at a time would have taken
+                "sequential": round(sum(item["timings_ms"].get("total", 0.0) for item in answered), 1),
+            },
+        }
+
+    start = time.perf_counter()
+    items = answer_batch(questions, answer, concurrency, request_id=ctx["request_id"])
+    if not data.get("stream"):
+        results = sorted(items, key=lambda item: item["index"])
+        return jsonify({"results": results, "summary": summary(results, start)})
+
+    def generate():
+        metrics.use_request(ctx)
+        completed = []
+        for item in items:
+            completed.append(item)
+            yield _ndjson({"phase": "item", **item})
+        yield _ndjson({"phase": "summary", **summary(completed, start)})
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Expose connection pool, intent router, cache, SQL guard and Ollama client statistics."""
+    return jsonify({
+        "db_pool": get_pool().stats(),
+        "intent_router": get_intent_router().stats(),
+        "sql_cache": get_sql_cache().stats(),
+        "result_cache": get_result_cache().stats(),
+        "sql_guard": sql_guard_stats(),
+        "ollama_client": get_ollama_client().stats(),
+    })
 
-    return jsonify({"sql_query": sql_query, "results": results})
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Stage latency histograms, Ollama token rates and pool/cache gauges in Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    try:
+        app.run(host="0.0.0.0", port=5000, debug=True)
+    finally:
+        shut_down()
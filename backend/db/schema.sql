@@ -10,3 +10,78 @@ CREATE TABLE activities (
     timestamp TIMESTAMP,
     embedding vector(384)  -- Vector storage for embeddings
 );
+
+-- ANN index for `embedding <=>` similarity queries (manage with backend/vector_index.py)
+CREATE INDEX IF NOT EXISTS activities_embedding_hnsw_idx
+    ON activities USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- With pgvector >= 0.7 it can be replaced by a halfvec/bit index on an expression of `embedding`
+-- (`python backend/vector_index.py quantize --quantization bit`, then VECTOR_QUANTIZATION=bit);
+-- the float32 column is kept for re-ranking
+
+-- Per-type partial ANN indexes are added by `python backend/vector_index.py partial`
+-- (run_all.py does this after every sync); small types are filtered through this index instead
+CREATE INDEX IF NOT EXISTS activities_activity_type_idx ON activities (activity_type);
+
+-- Ingest counter: bumped by store_activities.py in the same transaction as the data it writes,
+-- so backend result caches (keyed on it) can tell when results may have changed
+CREATE TABLE IF NOT EXISTS data_generation (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),  -- single row
+    generation BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO data_generation (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
+
+-- Per-user, per-type aggregates by day/week/month/year, kept current by store_activities.py
+-- (rebuild with `python utils/strava/rollups.py`); aggregate questions read these instead of
+-- grouping the whole activities table
+CREATE TABLE IF NOT EXISTS activity_rollups (
+    user_id VARCHAR(50),
+    activity_type VARCHAR(50),
+    period VARCHAR(5) NOT NULL,  -- 'day' | 'week' | 'month' | 'year'
+    period_start DATE NOT NULL,  -- DATE_TRUNC(period, timestamp)
+    activity_count INT NOT NULL,
+    total_distance DOUBLE PRECISION,
+    total_duration BIGINT,
+    longest_distance DOUBLE PRECISION,
+    longest_duration INT,
+    fastest_speed DOUBLE PRECISION  -- max distance / duration (m/s)
+);
+CREATE INDEX IF NOT EXISTS activity_rollups_bucket_idx
+    ON activity_rollups (period, user_id, activity_type, period_start);
+
+-- Lets the store step find the activities in a touched rollup bucket without a full scan
+CREATE INDEX IF NOT EXISTS activities_timestamp_idx ON activities (timestamp);
+
+-- Per-athlete access paths: the backend scopes every query with user_id = ... (backend/tenancy.py)
+CREATE INDEX IF NOT EXISTS activities_user_timestamp_idx ON activities (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS activities_user_type_timestamp_idx ON activities (user_id, activity_type, timestamp);
+CREATE INDEX IF NOT EXISTS activities_user_type_distance_idx ON activities (user_id, activity_type, distance);
+
+-- Mean embedding per athlete and activity type, refreshed by `python utils/misc/centroids.py`
+-- (run_all.py does this after every sync); plot_embeddings.py overlays them on its projections
+CREATE TABLE IF NOT EXISTS activity_type_centroids (
+    user_id VARCHAR(50),
+    activity_type VARCHAR(50),
+    centroid vector(384) NOT NULL,
+    activity_count INT NOT NULL,
+    generation BIGINT,  -- data_generation the centroids were computed at
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Tenant isolation: the backend sets app.user_id (transaction-local) before running a question's
+-- SQL, and these policies hide every other athlete's rows. Sessions that don't set it (ingestion)
+-- see everything. Policies don't apply to superusers or BYPASSRLS roles, so the backend must
+-- connect as a regular role; check with `python backend/tenancy.py status`.
+ALTER TABLE activities ENABLE ROW LEVEL SECURITY;
+ALTER TABLE activities FORCE ROW LEVEL SECURITY;
+CREATE POLICY tenant_isolation ON activities
+    USING (COALESCE(current_setting('app.user_id', true), '') = '' OR user_id = current_setting('app.user_id', true));
+ALTER TABLE activity_rollups ENABLE ROW LEVEL SECURITY;
+ALTER TABLE activity_rollups FORCE ROW LEVEL SECURITY;
+CREATE POLICY tenant_isolation ON activity_rollups
+    USING (COALESCE(current_setting('app.user_id', true), '') = '' OR user_id = current_setting('app.user_id', true));
+ALTER TABLE activity_type_centroids ENABLE ROW LEVEL SECURITY;
+ALTER TABLE activity_type_centroids FORCE ROW LEVEL SECURITY;
+CREATE POLICY tenant_isolation ON activity_type_centroids
+    USING (COALESCE(current_setting('app.user_id', true), '') = '' OR user_id = current_setting('app.user_id', true));
@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+from dotenv import load_dotenv
+
+
+# Load environment variables
+load_dotenv()
+
+# Read database credentials
+POSTGRES_DB = os.getenv("POSTGRES_DB")
+POSTGRES_USER = os.getenv("POSTGRES_USER")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST")
+POSTGRES_PORT = os.getenv("POSTGRES_PORT")
+
+# Pool settings
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))  # ping connections idle longer than this (s)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+
+def connect(**kwargs):
+    """Open a plain connection with the configured credentials (outside the pool)."""
+    return psycopg2.connect(
+        dbname=POSTGRES_DB,
+        user=POSTGRES_USER,
+        password=POSTGRES_PASSWORD,
+        host=POSTGRES_HOST,
+        port=POSTGRES_PORT,
+        **kwargs,
+    )
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the pool timeout."""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections shared by the backend."""
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 timeout=DB_POOL_TIMEOUT, check_idle=DB_POOL_CHECK_IDLE,
+                 statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS, configure=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.statement_timeout_ms = statement_timeout_ms
+        self.configure = configure  # callable(conn) applying extra session settings to new connections
+
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (conn, last_used) so the warmest connection is reused first
+        self._size = 0   # open connections, idle + checked out (+ being opened)
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "health_check_failures": 0,
+            "statement_timeouts": 0,
+        }
+
+        for _ in range(min_size):
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                print(f"Database connection error while filling pool: {e}")
+                break
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        """Open a new connection with the per-connection session settings applied."""
+        conn = connect(options=f"-c statement_timeout={self.statement_timeout_ms}")
+        if self.configure:
+            try:
+                self.configure(conn)
+                conn.commit()  # session settings must survive the rollback done on every return
+            except psycopg2.Error:
+                conn.close()
+                raise
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        """Check a connection before handing it out."""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["connections_discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Check out a connection, waiting up to `timeout` seconds for one to free up."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection free after {self.timeout}s")
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except psycopg2.Error:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._discard(conn)
+                continue
+
+            wait_ms = (time.monotonic() - start) * 1000
+            with self._cond:
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                self._stats["wait_time_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, dropping it if it is broken."""
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()  # end any open (or aborted) transaction
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection and always returns it."""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except psycopg2.errors.QueryCanceledError:
+            # statement_timeout fired: the connection is fine once the transaction is rolled back
+            with self._cond:
+                self._stats["statement_timeouts"] += 1
+            raise
+        except psycopg2.InterfaceError:
+            discard = True
+            raise
+        except psycopg2.OperationalError:
+            discard = bool(conn.closed)  # only a lost connection; putconn discards it if rollback fails
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        """Snapshot of pool usage and wait statistics."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+        checkouts = stats["checkouts"]
+        stats["avg_wait_ms"] = round(stats["wait_time_ms"] / checkouts, 3) if checkouts else 0.0
+        stats["wait_time_ms"] = round(stats["wait_time_ms"], 3)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 3)
+        return stats
+
+    def close(self):
+        """Close all idle connections; checked-out ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from vector_index import apply_search_settings
+                _pool = ConnectionPool(configure=apply_search_settings)
+    return _pool
+
+
+def close_pool():
+    """Close the process-wide pool, if it was created."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,38 @@
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+
+# Same model the ingestion pipeline uses (utils/strava/store_activities.py)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Load the sentence-transformer on first use; returns None if it is not installed."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    print("sentence-transformers not installed, semantic features disabled")
+                    _model = False
+                    return None
+                _model = SentenceTransformer(EMBEDDING_MODEL)
+    return _model or None
+
+
+@lru_cache(maxsize=512)
+def embed_text(text):
+    """Embed a piece of text as a unit-length float32 vector (None if no model is available)."""
+    model = get_model()
+    if model is None:
+        return None
+    vector = model.encode(text, normalize_embeddings=True).astype(np.float32)
+    vector.setflags(write=False)  # shared via the lru_cache
+    return vector
@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embeddings import embed_text
+from sql_cache import normalize_question
+
+
+# Load environment variables
+load_dotenv()
+
+# false = the first FEW_SHOT_K library examples in every prompt, whatever the question
+FEW_SHOT_ENABLED = os.getenv("FEW_SHOT_ENABLED", "true").lower() == "true"
+FEW_SHOT_K = int(os.getenv("FEW_SHOT_K", "3"))
+FEW_SHOT_EXAMPLES_PATH = os.getenv(
+    "FEW_SHOT_EXAMPLES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql_examples.json"))
+
+
+class ExampleLibrary:
+    """Question -> SQL examples; picks the ones most similar to a question for the prompt."""
+
+    def __init__(self, path=FEW_SHOT_EXAMPLES_PATH):
+        self.path = path
+        with open(path, "r") as f:
+            self.examples = json.load(f)
+        self._lock = threading.Lock()
+        self._matrix = None  # stacked question embeddings, built on first use
+
+    def _embeddings(self):
+        with self._lock:
+            if self._matrix is None:
+                vectors = [embed_text(normalize_question(e["question"])) for e in self.examples]
+                self._matrix = np.stack(vectors) if vectors and vectors[0] is not None else False
+        return self._matrix if self._matrix is not False else None
+
+    def select(self, question, k=FEW_SHOT_K):
+        """
+        The k examples most similar to the question, least similar first so the best one sits
+        right before the question. Without an embedding model, word overlap ranks them instead.
+        """
+        if k >= len(self.examples):
+            return list(self.examples)
+        normalized = normalize_question(question)
+        matrix = self._embeddings()
+        embedding = embed_text(normalized) if matrix is not None else None
+        if embedding is not None:
+            scores = matrix @ embedding
+        else:
+            words = set(normalized.split())
+            scores = np.array([len(words & set(normalize_question(e["question"]).split())) for e in self.examples],
+                              dtype=np.float32)
+        # stable sort keeps library order among ties, so the same question always gets the same prompt
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [self.examples[i] for i in reversed(best)]
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_example_library():
+    """Return the process-wide example library, loading it on first use."""
+    global _library
+    if _library is None:
+        with _library_lock:
+            if _library is None:
+                _library = ExampleLibrary()
+    return _library
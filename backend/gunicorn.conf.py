@@ -0,0 +1,51 @@
+"""
+Gunicorn settings for serving the backend in production:
+
+    cd backend && gunicorn -c gunicorn.conf.py app:app
+
+The master loads the Ollama model once; each worker then opens its own connection pool and
+loads MiniLM before it takes requests. SIGTERM stops accepting connections and gives
+in-flight requests (streams included) BACKEND_GRACEFUL_TIMEOUT seconds to finish.
+"""
+import os
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+bind = os.getenv("BACKEND_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("BACKEND_WORKERS", "2"))
+# Requests mostly wait on Ollama and Postgres, so threads per worker carry the concurrency
+worker_class = "gthread"
+threads = int(os.getenv("BACKEND_THREADS", "8"))
+# Workers that stop heartbeating for this long are restarted
+timeout = int(os.getenv("BACKEND_TIMEOUT", "180"))
+graceful_timeout = int(os.getenv("BACKEND_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+# Pools, sessions and models are created after fork, per worker
+preload_app = False
+accesslog = None  # the backend logs one structured line per request itself
+
+
+def when_ready(server):
+    """Load the Ollama model once, before any worker serves a request."""
+    from ollama_client import OllamaClient
+    client = OllamaClient()
+    try:
+        client.warmup()
+        server.log.info("Ollama model loaded")
+    except Exception as e:
+        server.log.warning(f"Ollama warm-up failed: {e}")
+    finally:
+        client.close()
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up(ollama=False)
+
+
+def worker_exit(server, worker):
+    from app import shut_down
+    shut_down()
@@ -0,0 +1,352 @@
+import os
+import re
+import threading
+from datetime import date
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embeddings import embed_text
+from vector_index import VECTOR_QUANTIZATION, VECTOR_RERANK_CANDIDATES, similarity_order
+
+
+# Load environment variables
+load_dotenv()
+
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.8"))
+INTENT_EMBEDDINGS = os.getenv("INTENT_EMBEDDINGS", "true").lower() == "true"
+INTENT_EMBEDDING_THRESHOLD = float(os.getenv("INTENT_EMBEDDING_THRESHOLD", "0.8"))
+INTENT_USE_ROLLUPS = os.getenv("INTENT_USE_ROLLUPS", "true").lower() == "true"
+
+ACTIVITY_TYPES = {
+    "run": "Run", "runs": "Run", "running": "Run", "jog": "Run", "jogs": "Run", "jogging": "Run",
+    "ride": "Ride", "rides": "Ride", "riding": "Ride", "bike": "Ride", "biking": "Ride",
+    "cycle": "Ride", "cycling": "Ride",
+    "swim": "Swim", "swims": "Swim", "swimming": "Swim",
+    "walk": "Walk", "walks": "Walk", "walking": "Walk",
+    "hike": "Hike", "hikes": "Hike", "hiking": "Hike",
+    "workout": "Workout", "workouts": "Workout",
+    "yoga": "Yoga",
+}
+
+# Superlative word -> ORDER BY expression
+METRICS = {
+    "longest": "distance DESC", "farthest": "distance DESC", "furthest": "distance DESC",
+    "biggest": "distance DESC",
+    "shortest": "distance ASC",
+    "fastest": "distance / NULLIF(duration, 0) DESC",
+    "slowest": "distance / NULLIF(duration, 0) ASC",
+}
+
+PERIODS = {"day": "day", "days": "day", "week": "week", "weeks": "week",
+           "month": "month", "months": "month", "year": "year", "years": "year"}
+
+# Calendar window unit -> rollup periods whose buckets fit exactly inside such a window
+ROLLUP_PERIODS_WITHIN = {
+    "week": {"day", "week"},
+    "month": {"day", "month"},
+    "year": {"day", "month", "year"},
+}
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+                "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+
+# Words that carry no meaning for routing; anything else must be understood by a rule
+STOPWORDS = {
+    "what", "was", "were", "is", "are", "my", "i", "me", "the", "a", "an", "of", "to", "in",
+    "on", "did", "do", "does", "which", "when", "show", "find", "give", "list", "get", "tell",
+    "have", "had", "ever", "all", "with", "number", "activities", "activity",
+    "please", "that", "for", "by", "from", "during", "so", "far", "been", "it", "its",
+    "recent", "latest", "last", "this", "past", "previous", "top", "most", "least", "fewest",
+    "active", "similar", "like", "as", "one", "ones", "and", "or", "than",
+}
+
+TEMPLATES = {
+    "superlative": """SELECT activity_id, activity_type, distance, duration, timestamp
+FROM activities
+WHERE {where}
+ORDER BY {order}
+LIMIT {limit};""",
+    "active_period": """SELECT period_start AS activity_{period},
+       SUM(activity_count) AS total_activities
+FROM activity_rollups
+WHERE {where}
+GROUP BY period_start
+ORDER BY total_activities {direction}
+LIMIT {limit};""",
+    # Rolling windows ("last 30 days") cut through rollup buckets, so they group the raw rows
+    "active_period_scan": """SELECT DATE_TRUNC('{period}', timestamp) AS activity_{period},
+       COUNT(*) AS total_activities
+FROM activities
+{where_clause}GROUP BY activity_{period}
+ORDER BY total_activities {direction}
+LIMIT {limit};""",
+    "similar_to_last": """WITH last_activity AS (
+    SELECT embedding FROM activities
+    WHERE activity_type = '{activity_type}'
+    ORDER BY timestamp DESC
+    LIMIT 1
+)
+SELECT * FROM (
+    SELECT activity_id, activity_type, distance, duration, timestamp,
+           1 - (embedding <=> (SELECT embedding FROM last_activity)) AS similarity_score
+    FROM activities
+    WHERE activity_type = '{activity_type}'
+    ORDER BY embedding <=> (SELECT embedding FROM last_activity)
+    LIMIT {limit}
+) AS nearest
+ORDER BY similarity_score DESC;""",  # iterative index scans may return the nearest rows slightly out of order
+    # Quantized index: coarse candidates by reduced-precision distance, re-ranked by exact distance
+    "similar_to_last_rerank": """WITH last_activity AS (
+    SELECT embedding FROM activities
+    WHERE activity_type = '{activity_type}'
+    ORDER BY timestamp DESC
+    LIMIT 1
+)
+SELECT activity_id, activity_type, distance, duration, timestamp,
+       1 - (embedding <=> (SELECT embedding FROM last_activity)) AS similarity_score
+FROM (
+    SELECT activity_id, activity_type, distance, duration, timestamp, embedding
+    FROM activities
+    WHERE activity_type = '{activity_type}'
+    ORDER BY {coarse_order}
+    LIMIT {candidates}
+) AS candidates
+ORDER BY embedding <=> (SELECT embedding FROM last_activity)
+LIMIT {limit};""",
+}
+
+# Prototype questions per intent for the embedding classifier
+PROTOTYPES = {
+    "superlative": [
+        "what was my longest run", "my fastest ride ever", "show my shortest swim",
+        "top 5 longest hikes",
+    ],
+    "active_period": [
+        "which month was i most active", "year with the least number of activities",
+        "in which week did i do the most activities", "my least active month",
+    ],
+    "similar_to_last": [
+        "find similar activities to my last run", "activities like my latest ride",
+        "show rides similar to my most recent one",
+    ],
+}
+
+
+def tokenize(question):
+    return re.findall(r"[a-z0-9]+", question.lower())
+
+
+def _extract_limit(tokens, default, skip=()):
+    """Top-N from phrases like 'top 5', '3 longest' or 'last ten'."""
+    for token in tokens:
+        if token in skip:
+            continue
+        if token.isdigit() and len(token) < 4:
+            return max(1, min(int(token), 100)), token
+        if token in NUMBER_WORDS and token != "one":
+            return NUMBER_WORDS[token], token
+    return default, None
+
+
+def _extract_window(tokens, column="timestamp"):
+    """
+    Translate a time window phrase into a WHERE condition on `column`.
+
+    Returns (condition, words used, calendar unit); the unit ("week", "month", "year") is set
+    only for windows aligned to calendar boundaries, None for rolling ones like "last 30 days".
+    """
+    text = " ".join(tokens)
+    match = re.search(r"\b(?:in|during) (20\d\d|19\d\d)\b", text)
+    if match:
+        year = int(match.group(1))
+        return (f"{column} >= '{date(year, 1, 1)}' AND {column} < '{date(year + 1, 1, 1)}'",
+                {"in", "during", match.group(1)}, "year")
+    match = re.search(r"\b(?:last|past) (\d+) (day|days|week|weeks|month|months|year|years)\b", text)
+    if match:
+        unit = PERIODS[match.group(2)]
+        return (f"{column} >= NOW() - INTERVAL '{int(match.group(1))} {unit}s'",
+                {match.group(1), match.group(2)}, None)
+    match = re.search(r"\b(this|last|past) (week|month|year)\b", text)
+    if match:
+        unit = match.group(2)
+        if match.group(1) == "this":
+            return f"{column} >= DATE_TRUNC('{unit}', NOW())", {"this", unit}, unit
+        if match.group(1) == "past":
+            return f"{column} >= NOW() - INTERVAL '1 {unit}'", {"past", unit}, None
+        return (f"{column} >= DATE_TRUNC('{unit}', NOW()) - INTERVAL '1 {unit}' "
+                f"AND {column} < DATE_TRUNC('{unit}', NOW())", {"last", unit}, unit)
+    return None, set(), None
+
+
+def _unexplained(tokens, used):
+    return [t for t in tokens if t not in STOPWORDS and t not in used]
+
+
+def _confidence(tokens, used):
+    """Share of meaningful words the rules understood."""
+    content = [t for t in tokens if t not in STOPWORDS]
+    if not content:
+        return 0.0
+    return 1 - len(_unexplained(tokens, used)) / len(content)
+
+
+class IntentRouter:
+    """Maps common questions onto parameterized SQL templates so they skip the LLM."""
+
+    def __init__(self, min_confidence=INTENT_MIN_CONFIDENCE, use_embeddings=INTENT_EMBEDDINGS,
+                 embedding_threshold=INTENT_EMBEDDING_THRESHOLD):
+        self.min_confidence = min_confidence
+        self.use_embeddings = use_embeddings
+        self.embedding_threshold = embedding_threshold
+        self._lock = threading.Lock()
+        self._prototypes = None
+        self._stats = {"template_hits": 0, "low_confidence": 0, "no_match": 0}
+
+    def _classify_by_rules(self, tokens):
+        token_set = set(tokens)
+        if "similar" in token_set or "like" in token_set:
+            if token_set & {"last", "latest", "recent"}:
+                return "similar_to_last"
+        if token_set & {"most", "least", "fewest"} and token_set & set(PERIODS):
+            if token_set & {"active", "activities"}:
+                return "active_period"
+        if token_set & set(METRICS):
+            return "superlative"
+        return None
+
+    def _classify_by_embedding(self, question):
+        """Nearest prototype intent and its cosine similarity."""
+        embedding = embed_text(" ".join(tokenize(question)))
+        if embedding is None:
+            return None, 0.0
+        if self._prototypes is None:
+            self._prototypes = [
+                (intent, embed_text(p)) for intent, phrases in PROTOTYPES.items() for p in phrases
+            ]
+        intent, score = max(((i, float(np.dot(v, embedding))) for i, v in self._prototypes),
+                            key=lambda item: item[1])
+        return intent, score
+
+    def _build(self, intent, tokens):
+        """Fill the template for an intent; returns (sql, params, words used) or None."""
+        used = set()
+        activity_type = None
+        for token in tokens:
+            if token in ACTIVITY_TYPES:
+                activity_type = ACTIVITY_TYPES[token]
+                used.add(token)
+                break
+        window, window_words, window_unit = _extract_window(tokens)
+        used |= window_words
+        # "of all time" means no window; "time" anywhere else ("longest ride by time") asks for
+        # a duration ordering the templates don't have, so it stays unexplained
+        if re.search(r"\ball time\b", " ".join(tokens)):
+            used.add("time")
+
+        if intent == "superlative":
+            metric = next((t for t in tokens if t in METRICS), None)
+            if metric is None:
+                return None
+            used.add(metric)
+            limit, limit_word = _extract_limit(tokens, 1, window_words)
+            used.add(limit_word)
+            conditions = [f"activity_type = '{activity_type}'"] if activity_type else []
+            if window:
+                conditions.append(window)
+            sql = TEMPLATES["superlative"].format(
+                where=" AND ".join(conditions) or "TRUE", order=METRICS[metric], limit=limit)
+            params = {"activity_type": activity_type, "metric": metric, "window": window, "limit": limit}
+
+        elif intent == "active_period":
+            period = next((PERIODS[t] for t in tokens if t in PERIODS and t not in window_words), None)
+            if period is None:
+                return None
+            used |= {t for t in tokens if PERIODS.get(t) == period}
+            direction = "ASC" if {"least", "fewest"} & set(tokens) else "DESC"
+            limit, limit_word = _extract_limit(tokens, 1, window_words)
+            used.add(limit_word)
+            conditions = [f"activity_type = '{activity_type}'"] if activity_type else []
+            use_rollups = INTENT_USE_ROLLUPS and (window is None or period in ROLLUP_PERIODS_WITHIN.get(window_unit, ()))
+            if use_rollups:
+                if window:
+                    conditions.append(_extract_window(tokens, column="period_start")[0])
+                sql = TEMPLATES["active_period"].format(
+                    period=period, where=" AND ".join([f"period = '{period}'"] + conditions),
+                    direction=direction, limit=limit)
+            else:
+                if window:
+                    conditions.append(window)
+                where_clause = f"WHERE {' AND '.join(conditions)}\n" if conditions else ""
+                sql = TEMPLATES["active_period_scan"].format(
+                    period=period, where_clause=where_clause, direction=direction, limit=limit)
+            params = {"activity_type": activity_type, "period": period, "direction": direction,
+                      "window": window, "limit": limit, "rollups": use_rollups}
+
+        elif intent == "similar_to_last":
+            if activity_type is None or window:
+                return None
+            limit, limit_word = _extract_limit(tokens, 5, window_words)
+            used.add(limit_word)
+            if VECTOR_QUANTIZATION == "none":
+                sql = TEMPLATES["similar_to_last"].format(activity_type=activity_type, limit=limit)
+            else:
+                sql = TEMPLATES["similar_to_last_rerank"].format(
+                    activity_type=activity_type, limit=limit, candidates=max(limit, VECTOR_RERANK_CANDIDATES),
+                    coarse_order=similarity_order("(SELECT embedding FROM last_activity)"))
+            params = {"activity_type": activity_type, "limit": limit, "quantization": VECTOR_QUANTIZATION}
+
+        else:
+            return None
+        return sql, params, used
+
+    def route(self, question):
+        """
+        Return {"intent", "params", "confidence", "classifier", "sql"} when the question maps onto
+        a template with enough confidence, otherwise None (the caller falls back to the LLM).
+        """
+        tokens = tokenize(question)
+        intent, classifier = self._classify_by_rules(tokens), "rules"
+        built = self._build(intent, tokens) if intent else None
+        if built:
+            sql, params, used = built
+            confidence = _confidence(tokens, used)
+        elif self.use_embeddings:
+            intent, confidence = self._classify_by_embedding(question)
+            classifier = "embedding"
+            built = self._build(intent, tokens) if confidence >= self.embedding_threshold else None
+            if built:
+                sql, params, used = built
+                # The embedding only says which template is closest; words the template didn't use
+                # (units, other metrics, extra filters) still make it the wrong answer
+                confidence = min(confidence, _confidence(tokens, used))
+
+        with self._lock:
+            if not built:
+                self._stats["no_match"] += 1
+                return None
+            if confidence < self.min_confidence:
+                self._stats["low_confidence"] += 1
+                return None
+            self._stats["template_hits"] += 1
+        return {"intent": intent, "params": params, "confidence": round(confidence, 3),
+                "classifier": classifier, "sql": sql}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_intent_router():
+    """Return the process-wide intent router, creating it on first use."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = IntentRouter()
+    return _router
@@ -0,0 +1,229 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# Latency buckets (seconds) wide enough for both DB round trips and CPU LLM generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+
+logger = logging.getLogger("strava_insights.requests")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple((n, labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple((n, labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_gauges(self, prefix, collect):
+        """Register a callable returning a dict of numbers, exported as `<prefix>_<key>` gauges on scrape."""
+        self._collectors.append((prefix, collect))
+
+    def render(self):
+        """All metrics in Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                print(f"Metrics collector {prefix} failed: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "End-to-end request latency", ["endpoint", "status"])
+STAGE_SECONDS = REGISTRY.histogram(
+    "query_stage_duration_seconds", "Time spent per request in each stage of a query", ["stage"])
+SQL_SOURCE = REGISTRY.counter(
+    "query_sql_source_total", "Which path produced the SQL for a question", ["source"])
+OLLAMA_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ollama_generation_tokens_per_second", "Ollama generation speed (eval_count / eval_duration)",
+    buckets=TOKENS_PER_SECOND_BUCKETS)
+OLLAMA_TOKENS = REGISTRY.counter(
+    "ollama_tokens_total", "Tokens processed by Ollama", ["kind"])
+SQL_CANDIDATE_OUTCOMES = REGISTRY.counter(
+    "sql_candidates_total", "Speculative SQL candidates by outcome", ["outcome"])
+SPECULATIVE_SAVED_SECONDS = REGISTRY.histogram(
+    "sql_speculative_saved_seconds",
+    "Wall-clock saved by generating SQL candidates in parallel instead of retrying one after another")
+
+_request = contextvars.ContextVar("request_context", default=None)
+_stages_lock = threading.Lock()  # parallel work for one request (SQL candidates) adds to the same stages
+
+
+def start_request(request_id=None, **fields):
+    """Begin tracking a request; returns its context (request id, stage timings, log fields)."""
+    ctx = {
+        "request_id": request_id or uuid.uuid4().hex,
+        "start": time.perf_counter(),
+        "stages": {},
+        "fields": dict(fields),
+    }
+    _request.set(ctx)
+    return ctx
+
+
+def use_request(ctx):
+    """Re-attach a request context, e.g. inside a streaming response generator."""
+    _request.set(ctx)
+
+
+def current_request():
+    return _request.get()
+
+
+def annotate(**fields):
+    """Attach fields (source, row count, error, ...) to the current request's log line."""
+    ctx = _request.get()
+    if ctx is not None:
+        ctx["fields"].update(fields)
+
+
+def record_stage(name, elapsed):
+    """Add `elapsed` seconds to a stage; inside a request it adds to that request's total."""
+    ctx = _request.get()
+    if ctx is None:
+        STAGE_SECONDS.observe(elapsed, stage=name)
+    else:
+        with _stages_lock:
+            ctx["stages"][name] = ctx["stages"].get(name, 0.0) + elapsed
+
+
+@contextmanager
+def stage(name):
+    """Time a block of code as (part of) a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_ollama_stats(response):
+    """Record token counts and generation speed from Ollama's final response stats."""
+    eval_count = response.get("eval_count") or 0
+    eval_duration = response.get("eval_duration") or 0  # nanoseconds
+    prompt_eval_count = response.get("prompt_eval_count") or 0
+    OLLAMA_TOKENS.inc(eval_count, kind="completion")
+    OLLAMA_TOKENS.inc(prompt_eval_count, kind="prompt")
+    stats = {"prompt_tokens": prompt_eval_count, "completion_tokens": eval_count}
+    if eval_count and eval_duration:
+        tokens_per_second = eval_count / (eval_duration / 1e9)
+        OLLAMA_TOKENS_PER_SECOND.observe(tokens_per_second)
+        stats["tokens_per_second"] = round(tokens_per_second, 1)
+    if response.get("prompt_eval_duration"):
+        stats["prompt_eval_ms"] = round(response["prompt_eval_duration"] / 1e6, 1)
+    if response.get("load_duration"):
+        stats["load_ms"] = round(response["load_duration"] / 1e6, 1)
+    annotate(ollama=stats)
+    return stats
+
+
+def finish_request(ctx, endpoint, status):
+    """Record the request's histograms and emit its structured log line."""
+    duration = time.perf_counter() - ctx["start"]
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint, status=status)
+    for name, elapsed in ctx["stages"].items():
+        STAGE_SECONDS.observe(elapsed, stage=name)
+    if "source" in ctx["fields"]:
+        SQL_SOURCE.inc(source=ctx["fields"]["source"])
+    logger.info(json.dumps({
+        "request_id": ctx["request_id"],
+        "endpoint": endpoint,
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        "stages_ms": {name: round(elapsed * 1000, 1) for name, elapsed in ctx["stages"].items()},
+        **ctx["fields"],
+    }, default=str))
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from metrics import record_stage
+
+
+# Load environment variables
+load_dotenv()
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
+MODEL_NAME = os.getenv("OLLAMA_MODEL", "mistral")  # Change model here
+# How long Ollama keeps the model (and its evaluated prompt prefix) loaded after a request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+# Longest Ollama may go without sending a byte (the whole generation for non-streaming calls)
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+# Generations in flight per process; keep workers x this at or below Ollama's OLLAMA_NUM_PARALLEL
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "60"))  # seconds to wait for a free slot
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv("OLLAMA_WARMUP_TIMEOUT", "600"))  # loading a large model from disk
+
+
+class OllamaBusy(requests.exceptions.RequestException):
+    """Raised when no generation slot becomes free within the queue timeout."""
+
+
+class OllamaClient:
+    """
+    Keep-alive HTTP session to Ollama with timeouts and a cap on concurrent generations.
+
+    Requests beyond the cap wait for a slot instead of piling up inside Ollama, where they
+    would only queue behind each other anyway and hold a connection and a thread each.
+    """
+
+    def __init__(self, url=OLLAMA_URL, max_concurrency=OLLAMA_MAX_CONCURRENCY,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 queue_timeout=OLLAMA_QUEUE_TIMEOUT):
+        self.url = url
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self.session = requests.Session()
+        # Connections beyond the slot count are for warm-up and cancelled streams still closing
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "in_flight": 0,
+            "waiting": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "busy_rejections": 0,
+            "timeouts": 0,
+            "errors": 0,
+        }
+
+    @contextmanager
+    def _slot(self):
+        """Hold one of the generation slots, waiting up to the queue timeout for it."""
+        start = time.perf_counter()
+        with self._lock:
+            self._stats["waiting"] += 1
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._stats["waiting"] -= 1
+            if not acquired:
+                self._stats["busy_rejections"] += 1
+            else:
+                self._stats["requests"] += 1
+                self._stats["in_flight"] += 1
+                if waited > 0.001:
+                    self._stats["waits"] += 1
+                self._stats["wait_time_ms"] += waited * 1000
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], waited * 1000)
+        record_stage("ollama_queue", waited)
+        if not acquired:
+            raise OllamaBusy(f"{self.max_concurrency} generations already running; "
+                             f"no slot within {self.queue_timeout:.0f}s")
+        try:
+            yield
+        except requests.exceptions.Timeout:
+            self._count("timeouts")
+            raise
+        except requests.exceptions.RequestException:
+            self._count("errors")
+            raise
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._stats["in_flight"] -= 1
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def generate(self, payload):
+        """Non-streaming /api/generate call; returns Ollama's JSON response."""
+        with self._slot():
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.url, json={**payload, "stream": False}, timeout=self.timeout)
+                response.raise_for_status()
+            finally:
+                record_stage("ollama_generate", time.perf_counter() - start)
+            return response.json()
+
+    @contextmanager
+    def stream(self, payload):
+        """Streaming /api/generate call; yields the response, holding a slot until the block exits."""
+        with self._slot():
+            with self.session.post(self.url, json={**payload, "stream": True}, stream=True,
+                                   timeout=self.timeout) as response:
+                response.raise_for_status()
+                yield response
+
+    def warmup(self, model=MODEL_NAME, keep_alive=OLLAMA_KEEP_ALIVE, timeout=OLLAMA_WARMUP_TIMEOUT):
+        """Have Ollama load `model` and keep it loaded (a request without a prompt only loads it)."""
+        response = self.session.post(self.url, json={"model": model, "keep_alive": keep_alive, "stream": False},
+                                     timeout=(self.timeout[0], timeout))
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_concurrency"] = self.max_concurrency
+        stats["avg_wait_ms"] = round(stats["wait_time_ms"] / stats["requests"], 3) if stats["requests"] else 0.0
+        stats["wait_time_ms"] = round(stats["wait_time_ms"], 3)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 3)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_ollama_client():
+    """Return the process-wide Ollama client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OllamaClient()
+    return _client
+
+
+def close_ollama_client():
+    """Close the process-wide client's connections, if it was created."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,93 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+import metrics
+from embeddings import embed_text
+from sql_cache import SQL_CACHE_SIMILARITY, key_terms, normalize_question
+
+
+# Load environment variables
+load_dotenv()
+
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # distinct questions answered at once per batch
+# Questions at least this similar (and with the same key terms) are answered once; 0 = exact duplicates only
+BATCH_DEDUP_SIMILARITY = float(os.getenv("BATCH_DEDUP_SIMILARITY", str(SQL_CACHE_SIMILARITY)))
+
+
+def group_questions(questions, similarity=BATCH_DEDUP_SIMILARITY):
+    """
+    Index of the question each question is answered by: itself, or an earlier duplicate.
+
+    Duplicates have the same normalized text, or MiniLM embeddings at least `similarity`
+    apart with the same key terms, the rule the SQL cache uses for paraphrases.
+    """
+    owners = []
+    by_text = {}
+    representatives = []  # (index, key terms, embedding) of questions that are answered
+    for index, question in enumerate(questions):
+        normalized = normalize_question(question)
+        owner = by_text.get(normalized)
+        embedding = None
+        if owner is None and similarity > 0:
+            embedding = embed_text(normalized)
+            if embedding is not None:
+                terms = key_terms(normalized)
+                scores = [(float(other @ embedding), other_index)
+                          for other_index, other_terms, other in representatives
+                          if other is not None and other_terms == terms]
+                best = max(scores, default=None)
+                if best is not None and best[0] >= similarity:
+                    owner = best[1]
+        if owner is None:
+            owner = index
+            by_text[normalized] = index
+            representatives.append((index, key_terms(normalized), embedding))
+        owners.append(owner)
+    return owners
+
+
+def _answer_one(answer, question, request_id):
+    """Answer one question under its own request context, so its stage timings are its own."""
+    ctx = metrics.start_request(request_id, question=question)
+    body, status = answer(question)
+    metrics.finish_request(ctx, "/query/batch:item", status)
+    timings = {name: round(elapsed * 1000, 1) for name, elapsed in ctx["stages"].items()}
+    timings["total"] = round((time.perf_counter() - ctx["start"]) * 1000, 1)
+    return body, status, timings
+
+
+def answer_batch(questions, answer, concurrency=BATCH_CONCURRENCY, request_id=None, similarity=BATCH_DEDUP_SIMILARITY):
+    """
+    Answer `questions` with `answer(question) -> (body, status)`, distinct ones concurrently.
+
+    Yields one item per question as its answer completes (not in order): the body plus
+    `index`, `question`, `status`, `timings_ms` and, for duplicates, `duplicate_of`.
+    """
+    with metrics.stage("batch_dedup"):
+        owners = group_questions(questions, similarity)
+    followers = {}
+    for index, owner in enumerate(owners):
+        followers.setdefault(owner, []).append(index)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(followers))),
+                                  thread_name_prefix="query-batch")
+    try:
+        futures = {executor.submit(_answer_one, answer, questions[owner], f"{request_id}.{owner}"): owner
+                   for owner in followers}
+        for future in as_completed(futures):
+            owner = futures[future]
+            try:
+                body, status, timings = future.result()
+            except Exception as e:
+                body, status, timings = {"error": f"Failed to answer question: {e}"}, 500, {}
+            for index in followers[owner]:
+                item = {"index": index, "question": questions[index], **body, "status": status, "timings_ms": timings}
+                if index != owner:
+                    item["duplicate_of"] = owner
+                yield item
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)  # client went away: drop what hasn't started
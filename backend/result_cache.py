@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db_pool import get_pool, PoolTimeout
+
+
+# Load environment variables
+load_dotenv()
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "500"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # approx. JSON size
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))  # bounds staleness of CURRENT_DATE-style SQL, 0 = none
+# /query/stream only keeps results up to this many rows in memory for caching
+RESULT_CACHE_STREAM_MAX_ROWS = int(os.getenv("RESULT_CACHE_STREAM_MAX_ROWS", "5000"))
+# How often the data generation is re-read from Postgres; an ingest becomes visible within this many seconds
+RESULT_CACHE_GENERATION_TTL = float(os.getenv("RESULT_CACHE_GENERATION_TTL", "5"))
+
+GENERATION_SQL = "SELECT generation FROM data_generation"
+
+
+# String literals, quoted identifiers and -- comments (with their newline), kept verbatim; or a run of whitespace
+SQL_TOKENS = re.compile(r"(?<!\w)[eE]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(\w*)\$.*?\$\1\$|"
+                        r"--[^\n]*\n?|(\s+)", re.S)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace outside literals and comments and drop the trailing semicolon."""
+    sql = sql.strip().rstrip(";").strip()
+    return SQL_TOKENS.sub(lambda match: " " if match.group(2) else match.group(0), sql)
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of formatted query results keyed by normalized SQL.
+
+    Entries are tagged with the data generation they were computed at; `store_activities.py`
+    bumps the generation in Postgres on every ingest, which makes all older entries stale.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 ttl=RESULT_CACHE_TTL, generation_ttl=RESULT_CACHE_GENERATION_TTL, read_generation=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self.read_generation = read_generation or read_data_generation
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized sql -> entry, least recently used first
+        self._bytes = 0
+        self._generation = None
+        self._generation_checked = None
+        self._stats = {"hits": 0, "misses": 0, "bypasses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def generation(self):
+        """Current data generation, re-read from the database at most every `generation_ttl` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            if self._generation_checked is not None and now - self._generation_checked < self.generation_ttl:
+                return self._generation
+        generation = self.read_generation()
+        with self._lock:
+            self._generation_checked = now
+            if generation != self._generation:
+                if self._entries:
+                    self._stats["invalidations"] += 1
+                self._entries.clear()
+                self._bytes = 0
+                self._generation = generation
+        return generation
+
+    def get(self, sql):
+        """Return cached results for the SQL at the current data generation, or None."""
+        generation = self.generation()
+        if generation is None:
+            return None
+        key = normalize_sql(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and time.time() - entry["created"] > self.ttl:
+                self._remove(key)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None or entry["generation"] != generation:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry["results"]
+
+    def put(self, sql, results):
+        """Cache formatted results; results bigger than the whole cache are not stored."""
+        generation = self.generation()
+        if generation is None:
+            return
+        size = len(json.dumps(results, default=str))
+        if size > self.max_bytes:
+            return
+        key = normalize_sql(sql)
+        with self._lock:
+            if generation != self._generation:  # an ingest landed while the query ran
+                return
+            self._remove(key)
+            self._entries[key] = {"results": results, "generation": generation, "size": size,
+                                  "created": time.time()}
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats["bypasses"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["generation"] = self._generation
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def read_data_generation():
+    """Read the ingest counter from Postgres; None (caching off) if it can't be read."""
+    try:
+        with get_pool().connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(GENERATION_SQL)
+                row = cursor.fetchone()
+                return row[0] if row else 0
+    except (psycopg2.Error, PoolTimeout) as e:
+        print(f"Could not read data generation, result cache disabled: {e}")
+        return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the process-wide result cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache()
+    return _cache
@@ -0,0 +1,267 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embeddings import embed_text
+
+
+# Load environment variables
+load_dotenv()
+
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "1000"))
+SQL_CACHE_TTL = float(os.getenv("SQL_CACHE_TTL", "86400"))  # seconds, 0 = never expire
+SQL_CACHE_SIMILARITY = float(os.getenv("SQL_CACHE_SIMILARITY", "0.92"))  # cosine similarity for a semantic hit
+SQL_CACHE_SEMANTIC = os.getenv("SQL_CACHE_SEMANTIC", "true").lower() == "true"
+SQL_CACHE_PATH = os.getenv("SQL_CACHE_PATH", "")  # JSON file to persist the cache, empty = memory only
+# Seconds between background saves of a changed cache (the file is also written on shutdown)
+SQL_CACHE_SAVE_INTERVAL = float(os.getenv("SQL_CACHE_SAVE_INTERVAL", "30"))
+
+# Words that change the meaning of a question even when the embeddings are close,
+# e.g. "longest run" vs "shortest run" or "last 5 rides" vs "last 10 rides".
+KEY_TERMS = {
+    "run", "runs", "ride", "rides", "swim", "swims", "walk", "walks", "hike", "hikes",
+    "workout", "workouts", "yoga", "longest", "shortest", "fastest", "slowest",
+    "most", "least", "first", "last", "day", "week", "month", "year",
+}
+
+
+def normalize_question(question):
+    """Lowercase, drop punctuation and collapse whitespace so trivial variants share a key."""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+
+def key_terms(normalized):
+    """Tokens that must match exactly for a semantic hit to be trusted."""
+    return frozenset(t for t in normalized.split() if t in KEY_TERMS or t.isdigit())
+
+
+class SQLCache:
+    """Two-tier cache of generated SQL: exact normalized question, then embedding similarity."""
+
+    def __init__(self, max_entries=SQL_CACHE_MAX_ENTRIES, ttl=SQL_CACHE_TTL,
+                 similarity=SQL_CACHE_SIMILARITY, semantic=SQL_CACHE_SEMANTIC, path=SQL_CACHE_PATH,
+                 save_interval=SQL_CACHE_SAVE_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.semantic = semantic
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized question -> entry, least recently used first
+        self._matrix = None            # (keys, stacked embeddings), rebuilt lazily after changes
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expired": 0, "saves": 0}
+        self._dirty = False
+        self._stop = threading.Event()
+        self._saver = None  # background thread writing the file, started on the first change
+        if path:
+            self.load()
+
+    def _expired(self, entry, now):
+        return self.ttl > 0 and now - entry["created"] > self.ttl
+
+    def _embedding(self, normalized):
+        if not self.semantic:
+            return None
+        return embed_text(normalized)
+
+    def _semantic_lookup(self, normalized, embedding):
+        """Return the key of the most similar cached question above the threshold."""
+        if self._matrix is None:
+            keys = [k for k, e in self._entries.items() if e["embedding"] is not None]
+            vectors = np.stack([self._entries[k]["embedding"] for k in keys]) if keys else None
+            self._matrix = (keys, vectors)
+        keys, vectors = self._matrix
+        if not keys:
+            return None
+        scores = vectors @ embedding  # embeddings are unit length, so this is cosine similarity
+        terms = key_terms(normalized)
+        for idx in np.argsort(-scores):
+            if scores[idx] < self.similarity:
+                break
+            if key_terms(keys[idx]) == terms:
+                return keys[idx]
+        return None
+
+    def get(self, question):
+        """Return cached SQL for the question, or None on a miss."""
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(normalized)
+            if entry is not None and self._expired(entry, now):
+                self._remove(normalized)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(normalized)
+                self._stats["exact_hits"] += 1
+                return entry["sql"]
+
+        embedding = self._embedding(normalized)
+        if embedding is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        with self._lock:
+            while True:
+                key = self._semantic_lookup(normalized, embedding)
+                if key is None:
+                    self._stats["misses"] += 1
+                    return None
+                entry = self._entries[key]
+                if not self._expired(entry, now):
+                    break
+                self._remove(key)
+                self._stats["expired"] += 1
+            self._entries.move_to_end(key)
+            self._stats["semantic_hits"] += 1
+            return entry["sql"]
+
+    def put(self, question, sql):
+        """Store SQL generated for a question."""
+        normalized = normalize_question(question)
+        embedding = self._embedding(normalized)
+        with self._lock:
+            self._entries[normalized] = {"sql": sql, "embedding": embedding, "created": time.time()}
+            self._entries.move_to_end(normalized)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._matrix = None
+        self._mark_dirty()
+
+    def invalidate(self, question, sql=None):
+        """Drop the entry for a question, plus any entry holding `sql` (e.g. SQL that failed to run)."""
+        normalized = normalize_question(question)
+        with self._lock:
+            keys = [normalized] + [k for k, e in self._entries.items() if sql is not None and e["sql"] == sql]
+            removed = [self._remove(k) for k in keys]
+        if any(removed):
+            self._mark_dirty()
+
+    def _remove(self, key):
+        if self._entries.pop(key, None) is None:
+            return False
+        self._matrix = None
+        return True
+
+    def _mark_dirty(self):
+        """Schedule the change for the next background save instead of rewriting the file now."""
+        if not self.path:
+            return
+        with self._lock:
+            self._dirty = True
+            if self._saver is None and not self._stop.is_set():
+                self._saver = threading.Thread(target=self._save_periodically, name="sql-cache-save", daemon=True)
+                self._saver.start()
+
+    def _save_periodically(self):
+        while not self._stop.wait(self.save_interval):
+            self.flush()
+
+    def flush(self):
+        """Save the cache if it changed since the last save."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, False
+        if dirty:
+            self.save()
+
+    def close(self):
+        """Stop the background saver and write any pending changes."""
+        self._stop.set()
+        if self._saver is not None:
+            self._saver.join()
+        if self.path:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["unsaved_changes"] = self._dirty
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["semantic_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def save(self):
+        """Persist the cache as JSON (written atomically)."""
+        with self._lock:
+            data = [
+                {
+                    "question": key,
+                    "sql": e["sql"],
+                    "created": e["created"],
+                    "embedding": e["embedding"].tolist() if e["embedding"] is not None else None,
+                }
+                for key, e in self._entries.items()
+            ]
+        tmp_path = f"{self.path}.tmp"
+        with self._save_lock:
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not save SQL cache to {self.path}: {e}")
+                with self._lock:
+                    self._dirty = True  # try again on the next flush
+                return
+        with self._lock:
+            self._stats["saves"] += 1
+
+    def load(self):
+        """Load a persisted cache, skipping entries that have already expired."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load SQL cache from {self.path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for item in data[-self.max_entries:]:
+                embedding = item.get("embedding")
+                entry = {
+                    "sql": item["sql"],
+                    "created": item["created"],
+                    "embedding": np.asarray(embedding, dtype=np.float32) if embedding is not None else None,
+                }
+                if not self._expired(entry, now):
+                    self._entries[item["question"]] = entry
+            self._matrix = None
+        print(f"Loaded {len(self._entries)} cached SQL queries from {self.path}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_sql_cache():
+    """Return the process-wide SQL cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SQLCache()
+    return _cache
+
+
+def close_sql_cache():
+    """Write pending changes of the process-wide cache, if it was created."""
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
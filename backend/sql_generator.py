@@ -1,8 +1,24 @@
+import contextvars
+import json
+import threading
+import time
 import requests
 import os
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from datetime import datetime
+from db_pool import get_pool, PoolTimeout
+from sql_cache import get_sql_cache
+from intent_router import get_intent_router, INTENT_ROUTER_ENABLED
+from few_shot import get_example_library, FEW_SHOT_ENABLED, FEW_SHOT_K
+from metrics import (annotate, record_ollama_stats, record_stage, stage, SPECULATIVE_SAVED_SECONDS,
+                     SQL_CANDIDATE_OUTCOMES)
+from ollama_client import get_ollama_client, MODEL_NAME, OLLAMA_KEEP_ALIVE
+from tenancy import scope_sql, set_tenant
+from vector_index import rerank_similarity
+import sql_guard
 
 
 # Load environment variables
@@ -15,9 +31,11 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 
-# Ollama API details
-OLLAMA_URL = "http://localhost:11434/api/generate"
-MODEL_NAME = "mistral"  # Change model here
+# Speculative generation: request this many SQL candidates at once and run the first valid one (1 = off)
+SQL_CANDIDATES = int(os.getenv("SQL_CANDIDATES", "1"))
+SQL_CANDIDATE_CONCURRENCY = int(os.getenv("SQL_CANDIDATE_CONCURRENCY", "3"))  # candidate requests in flight, per process
+# Candidate i samples with temperature SQL_CANDIDATE_TEMPERATURES[i % len] and seed i
+SQL_CANDIDATE_TEMPERATURES = [float(t) for t in os.getenv("SQL_CANDIDATE_TEMPERATURES", "0,0.4,0.8").split(",")]
 
 # Database connection
 def connect_db():
@@ -41,108 +59,371 @@ def query_ollama(prompt):
     payload = {
         "model": MODEL_NAME,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
     
     try:
-        response = requests.post(OLLAMA_URL, json=payload)
-        response.raise_for_status()
-        return response.json().get("response", "No response received")
+        data = get_ollama_client().generate(payload)
+        record_ollama_stats(data)
+        return data.get("response", "No response received")
     except requests.exceptions.RequestException as e:
         return f"Error querying Ollama: {e}"
 
+# Streaming variant used by /query/stream
+def query_ollama_stream(prompt):
+    """Send a query to Ollama and yield response tokens as they are generated."""
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
+
+    with get_ollama_client().stream(payload) as response:
+        start = time.perf_counter()
+        lines = response.iter_lines()
+        while True:
+            # only time spent waiting on Ollama counts, not time the consumer spends on each token
+            line = next(lines, None)
+            record_stage("ollama_generate", time.perf_counter() - start)
+            if line is None:
+                break
+            if not line:
+                start = time.perf_counter()
+                continue
+            chunk = json.loads(line)
+            if chunk.get("done"):
+                record_ollama_stats(chunk)
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                break
+            start = time.perf_counter()
+
+# Static part of the prompt: schema and rules. It must stay byte-identical between calls so
+# Ollama can reuse the evaluated prefix from the previous request instead of re-reading it.
+SQL_PROMPT_PREFIX = """You are a PostgreSQL SQL expert using pgvector. Convert the user query into an SQL statement.
+
+## Database Schema
+CREATE TABLE activities (
+    activity_id BIGINT PRIMARY KEY,
+    activity_type VARCHAR(50),
+    distance DOUBLE PRECISION,
+    duration INTEGER,
+    timestamp TIMESTAMP,
+    embedding VECTOR(384)
+);
+
+-- One row per activity type and day/week/month/year bucket (period_start = DATE_TRUNC(period, timestamp))
+CREATE TABLE activity_rollups (
+    activity_type VARCHAR(50),
+    period VARCHAR(5),  -- 'day', 'week', 'month' or 'year'
+    period_start DATE,
+    activity_count INTEGER,
+    total_distance DOUBLE PRECISION,
+    total_duration BIGINT,
+    longest_distance DOUBLE PRECISION,
+    longest_duration INTEGER,
+    fastest_speed DOUBLE PRECISION
+);
+
+Use PostgreSQL syntax.
+
+## Query Rules:
+- The `embedding` column stores a 384-dimensional vector representing the activity. It is used to find similar activities.
+- Use the `<=>` operator for cosine similarity between embeddings. It returns a FLOAT, not a BOOLEAN.
+- Never use `<=>` directly in a JOIN ... ON clause unless it is wrapped in a comparison (e.g., `< 0.5`) or placed inside `ORDER BY`.
+- To find the most similar activity, use `<=>` inside an `ORDER BY` clause and `LIMIT 1`.
+- Order similarity searches by the distance itself (`ORDER BY embedding <=> ...`), not by a computed similarity score, so the vector index can be used.
+- When the question is about one activity type, also filter the outer query with `activity_type = '...'`.
+- Use `timestamp` for time-based queries.
+- Use `distance` and `duration` for activity performance queries.
+- For counts, totals, averages and "most/least active" per day, week, month or year, query `activity_rollups` (filter `period`, sum over activity types when no type is asked for) instead of grouping `activities`.
+- When listing individual activities, always return `activity_id`, `activity_type`, `distance`, `duration`, and `timestamp` in the SELECT statement.
+- PostgreSQL does **not support** YEAR(timestamp). Instead, use: EXTRACT(YEAR FROM "timestamp")
+- Same for month: use EXTRACT(MONTH FROM "timestamp")
+- Use double quotes for column names when needed (like "timestamp")
+- Write SQL that finds similar runs using embedding comparison, and if you use subqueries or CTEs, make sure to include all columns that are referenced later (e.g. timestamp).
+- Just return the SQL query, no other text.
+
+## Examples
+"""
+
+SQL_PROMPT_EXAMPLE = """User Question: "{question}"
+SQL Query:
+{sql}
+
+"""
+
+SQL_PROMPT_QUESTION = """Now, generate the SQL query based on the following user question:
+User Question: {user_question}
+SQL Query:
+"""
+
+
+def build_prompt(user_question, k=FEW_SHOT_K, retrieve=FEW_SHOT_ENABLED):
+    """
+    Build the NL -> SQL prompt: the static prefix, `k` library examples, then the question.
+    With `retrieve` the examples are the ones closest to the question, otherwise the first k.
+    """
+    with stage("prompt_build"):
+        library = get_example_library()
+        examples = library.select(user_question, k) if retrieve else library.examples[:k]
+        prompt = SQL_PROMPT_PREFIX + "".join(
+            SQL_PROMPT_EXAMPLE.format(question=e["question"], sql=e["sql"]) for e in examples
+        ) + SQL_PROMPT_QUESTION.format(user_question=user_question)
+    annotate(prompt_chars=len(prompt), prompt_examples=len(examples))
+    return prompt
+
+
+def clean_sql(response_text):
+    """Strip markdown formatting the LLM may wrap around the SQL; re-rank quantized similarity searches."""
+    return rerank_similarity(response_text.replace("```sql", "").replace("```", "").strip())
+
+
+def route_question(user_question):
+    """Try the deterministic template fast path; returns an intent match or None."""
+    if not INTENT_ROUTER_ENABLED:
+        return None
+    with stage("template_route"):
+        match = get_intent_router().route(user_question)
+    if match:
+        print(f"\n* Template SQL ({match['intent']}, confidence {match['confidence']}): *\n", match["sql"])
+    return match
+
+
+def validate_sql(sql_query, user_id=None):
+    """
+    Cheap check that SQL would run for `user_id`: scoping, the SQL guard, then EXPLAIN.
+
+    Raises TenantError/SQLGuardError (both ValueError), PoolTimeout or a psycopg2 error otherwise.
+    """
+    guarded_sql = sql_guard.guard_sql(scope_sql(sql_query, user_id))
+    with get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            sql_guard.begin_guarded(cursor)
+            set_tenant(cursor, user_id)
+            if sql_guard.check_cost(cursor, guarded_sql) is None:
+                sql_guard.explain_cost(cursor, guarded_sql)
+
+
+_candidate_executor = None
+_candidate_executor_lock = threading.Lock()
+
+
+def get_candidate_executor():
+    """Return the process-wide pool candidate generations run on, creating it on first use."""
+    global _candidate_executor
+    if _candidate_executor is None:
+        with _candidate_executor_lock:
+            if _candidate_executor is None:
+                _candidate_executor = ThreadPoolExecutor(max_workers=max(1, SQL_CANDIDATE_CONCURRENCY),
+                                                         thread_name_prefix="sql-candidate")
+    return _candidate_executor
+
+
+def shutdown_candidate_executor():
+    """Stop the candidate pool, dropping candidates that haven't started."""
+    global _candidate_executor
+    with _candidate_executor_lock:
+        if _candidate_executor is not None:
+            _candidate_executor.shutdown(wait=False, cancel_futures=True)
+            _candidate_executor = None
+
+
+def _generate_candidate(prompt, index, user_id, cancel):
+    """
+    Generate and validate one candidate; returns None if it was cancelled first.
+
+    Generation streams so a cancelled candidate can close its connection, which makes Ollama
+    stop generating for it.
+    """
+    if cancel.is_set():
+        return None
+    start = time.perf_counter()
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"temperature": SQL_CANDIDATE_TEMPERATURES[index % len(SQL_CANDIDATE_TEMPERATURES)], "seed": index},
+    }
+    candidate = {"index": index, "valid": False, "error": None, "ollama": None}
+    tokens = []
+    try:
+        with get_ollama_client().stream(payload) as response:
+            for line in response.iter_lines():
+                if cancel.is_set():
+                    return None
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                tokens.append(chunk.get("response", ""))
+                if chunk.get("done"):
+                    candidate["ollama"] = record_ollama_stats(chunk)
+                    break
+    except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: a malformed stream line
+        candidate.update(sql=f"Error querying Ollama: {e}", error=str(e), outcome="error",
+                         elapsed=time.perf_counter() - start)
+        return candidate
+
+    candidate["sql"] = clean_sql("".join(tokens))
+    candidate["generate_s"] = time.perf_counter() - start
+    try:
+        validate_sql(candidate["sql"], user_id)
+        candidate.update(valid=True, outcome="valid")
+    except (ValueError, PoolTimeout, psycopg2.Error) as e:
+        candidate.update(error=str(e).strip(), outcome="invalid")
+    candidate["elapsed"] = time.perf_counter() - start
+    return candidate
+
+
+def generate_sql_candidates(user_question, user_id=None, count=SQL_CANDIDATES):
+    """
+    Ask Ollama for `count` SQL candidates concurrently and return the first one that validates.
+
+    Candidates differ in temperature and seed. Each is validated (scoping, SQL guard, EXPLAIN)
+    as soon as it arrives; the first valid one wins and the rest are cancelled. Returns
+    (sql_query, valid); without a valid candidate it is the first one that came back.
+
+    "Saved" time compares the wait for the winner with running the candidates that finished
+    one after another (what retrying after each failure would have cost).
+    """
+    prompt = build_prompt(user_question)
+    cancel = threading.Event()
+    start = time.perf_counter()
+    executor = get_candidate_executor()
+    # Each candidate runs in a copy of the request context, so its stages and Ollama stats count
+    # towards this request (a context can only be entered by one thread at a time)
+    futures = [executor.submit(contextvars.copy_context().run, _generate_candidate, prompt, index, user_id, cancel)
+               for index in range(count)]
+    finished, winner = [], None
+    try:
+        for future in as_completed(futures):
+            candidate = future.result()
+            if candidate is None:
+                continue
+            finished.append(candidate)
+            SQL_CANDIDATE_OUTCOMES.inc(outcome=candidate["outcome"])
+            if candidate["valid"]:
+                winner = candidate
+                break
+    finally:
+        cancel.set()
+        for future in futures:
+            future.cancel()
+    wall = time.perf_counter() - start
+    record_stage("sql_candidates", wall)
+    SQL_CANDIDATE_OUTCOMES.inc(count - len(finished), outcome="cancelled")
+
+    sequential = sum(candidate["elapsed"] for candidate in finished)
+    saved = max(0.0, sequential - wall)
+    SPECULATIVE_SAVED_SECONDS.observe(saved)
+    chosen = winner or (finished[0] if finished else {"sql": "Error querying Ollama: no candidates", "index": None})
+    if chosen.get("ollama"):
+        annotate(ollama=chosen["ollama"])
+    annotate(candidates={
+        "requested": count,
+        "finished": len(finished),
+        "invalid": sum(1 for candidate in finished if candidate["outcome"] == "invalid"),
+        "winner": winner["index"] if winner else None,
+        "wall_ms": round(wall * 1000, 1),
+        "sequential_ms": round(sequential * 1000, 1),
+        "saved_ms": round(saved * 1000, 1),
+    })
+    for candidate in finished:
+        if not candidate["valid"]:
+            print(f"⚠️ SQL candidate {candidate['index']} rejected: {candidate['error']}")
+    return chosen["sql"], winner is not None
+
+
 # Generate SQL Query using LLM
-def generate_sql_query(user_question):
-    """Send the user question to Ollama and get an SQL query back."""
-    schema_info = """
-    You are a PostgreSQL SQL expert using pgvector. Convert the user query into an SQL statement.
-    
-    ## Database Schema
-    CREATE TABLE activities (
-        activity_id BIGINT PRIMARY KEY,
-        activity_type VARCHAR(50),
-        distance DOUBLE PRECISION,
-        duration INTEGER,
-        timestamp TIMESTAMP,
-        embedding VECTOR(384)
-    );
-    
-    Use PostgreSQL syntax.
-    
-    ## Query Rules:
-    - The `embedding` column stores a 384-dimensional vector representing the activity. It is used to find similar activities.
-    - Use the `<=>` operator for cosine similarity between embeddings. It returns a FLOAT, not a BOOLEAN.
-    - Never use `<=>` directly in a JOIN ... ON clause unless it is wrapped in a comparison (e.g., `< 0.5`) or placed inside `ORDER BY`.
-    - To find the most similar activity, use `<=>` inside an `ORDER BY` clause and `LIMIT 1`.
-    - Use `timestamp` for time-based queries.
-    - Use `distance` and `duration` for activity performance queries.
-    - Use `embedding <=> embedding` for cosine similarity queries.
-    - Use cosine similarity (`<=>`) on the `embedding` vector column when needed.
-    - Always return `activity_id`, `activity_type`, `distance`, `duration`, and `timestamp` in the SELECT statement.
-    - PostgreSQL does **not support** YEAR(timestamp). Instead, use: EXTRACT(YEAR FROM "timestamp")
-    - Same for month: use EXTRACT(MONTH FROM "timestamp")
-    - Use double quotes for column names when needed (like "timestamp")
-    - Write SQL that finds similar runs using embedding comparison, and if you use subqueries or CTEs, make sure to include all columns that are referenced later (e.g. timestamp).
-    - Just return the SQL query, no other text.
-    
-    
-    ## **Examples**
-    ### Example 1: Find my longest run
-    User Question: "What was my longest run?"
-    SQL Query:
-    SELECT activity_id, activity_type, distance, duration, timestamp 
-    FROM activities 
-    WHERE activity_type = 'Run' 
-    ORDER BY distance DESC 
-    LIMIT 1;
-    
-    ### Example 2: Find similar activities to my last run
-    User Question: "Find similar activities to my last 'Run' activity"
-    SQL Query:
-    WITH last_run AS (
-        SELECT embedding FROM activities 
-        WHERE activity_type = 'Run' 
-        ORDER BY timestamp DESC 
-        LIMIT 1
-    )
-    SELECT activity_id, activity_type, distance, duration, timestamp, 
-           1 - (embedding <=> (SELECT embedding FROM last_run)) AS similarity_score
-    FROM activities
-    ORDER BY similarity_score DESC
-    LIMIT 5;
-    
-    ### Example 3: Find my most active month
-    User Question: "Which month was I most active?"
-    SQL Query:
-    SELECT DATE_TRUNC('month', timestamp) AS activity_month, 
-           COUNT(*) AS total_activities 
-    FROM activities 
-    GROUP BY activity_month 
-    ORDER BY total_activities DESC 
-    LIMIT 1;
-
-    ### Example: Find the year with the least number of activities
-    SELECT EXTRACT(YEAR FROM timestamp) AS activity_year, COUNT(*) AS total_activities
-    FROM activities
-    GROUP BY activity_year
-    ORDER BY total_activities ASC
-    LIMIT 1;
-    
-    Now, generate the SQL query based on the following user question:
-    User Question: {user_question}
-    SQL Query:
+def generate_sql_query(user_question, user_id=None):
+    """Get an SQL query back for the user question (template, cache or Ollama)."""
+    return resolve_sql_query(user_question, user_id)[0]
+
+
+def resolve_sql_query(user_question, user_id=None):
     """
-    
-    full_prompt = schema_info.format(user_question=user_question)
-    sql_query = query_ollama(full_prompt)
+    Turn a question into SQL via the cheapest path that can answer it.
+
+    Returns (sql_query, source) where source is "template", "cache" or "llm". With
+    SQL_CANDIDATES > 1 the LLM path generates candidates in parallel and validates them
+    against `user_id`'s scope.
+    """
+    match = route_question(user_question)
+    if match:
+        return match["sql"], "template"
+
+    with stage("sql_cache_lookup"):
+        cached_sql = get_sql_cache().get(user_question)
+    if cached_sql:
+        cached_sql = rerank_similarity(cached_sql)  # cached before VECTOR_QUANTIZATION was set
+        print("\n* Cached SQL Query: *\n", cached_sql)
+        return cached_sql, "cache"
+
+    if SQL_CANDIDATES > 1:
+        sql_query, valid = generate_sql_candidates(user_question, user_id)
+        print("\n* Generated SQL Query (speculative): *\n", sql_query)
+        if valid:
+            get_sql_cache().put(user_question, sql_query)
+        return sql_query, "llm"
+
+    sql_query = query_ollama(build_prompt(user_question))
     
     # Clean response (removes markdown formatting, if any)
-    sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
+    sql_query = clean_sql(sql_query)
     
     # Debugging: Print SQL query for review
     print("\n* Generated SQL Query: *\n", sql_query)
-    
-    return sql_query
+
+    if not sql_query.lower().startswith("error"):
+        get_sql_cache().put(user_question, sql_query)
+
+    return sql_query, "llm"
+
+
+def generate_sql_query_events(user_question, user_id=None):
+    """
+    Streaming counterpart of resolve_sql_query.
+
+    Yields {"phase": "sql", "token": ...} events as the LLM generates, then one
+    {"phase": "sql_done", "sql_query": ..., "source": ...} event with the cleaned SQL.
+    Speculative candidates can't be streamed token by token, so the winner comes as one token.
+    """
+    match = route_question(user_question)
+    if match:
+        yield {"phase": "sql", "token": match["sql"]}
+        yield {"phase": "sql_done", "sql_query": match["sql"], "source": "template", "intent": match["intent"]}
+        return
+
+    with stage("sql_cache_lookup"):
+        cached_sql = get_sql_cache().get(user_question)
+    if cached_sql:
+        cached_sql = rerank_similarity(cached_sql)  # cached before VECTOR_QUANTIZATION was set
+        yield {"phase": "sql", "token": cached_sql}
+        yield {"phase": "sql_done", "sql_query": cached_sql, "source": "cache"}
+        return
+
+    if SQL_CANDIDATES > 1:
+        sql_query, valid = generate_sql_candidates(user_question, user_id)
+        print("\n* Generated SQL Query (speculative): *\n", sql_query)
+        if valid:
+            get_sql_cache().put(user_question, sql_query)
+        yield {"phase": "sql", "token": sql_query}
+        yield {"phase": "sql_done", "sql_query": sql_query, "source": "llm"}
+        return
+
+    tokens = []
+    for token in query_ollama_stream(build_prompt(user_question)):
+        tokens.append(token)
+        yield {"phase": "sql", "token": token}
+
+    sql_query = clean_sql("".join(tokens))
+    print("\n* Generated SQL Query: *\n", sql_query)
+    get_sql_cache().put(user_question, sql_query)
+    yield {"phase": "sql_done", "sql_query": sql_query, "source": "llm"}
 
 
 ACTIVITY_EMOJIS = {
@@ -192,22 +473,65 @@ def format_results(results, cursor_description):
     return formatted
 
 
-def execute_sql_query(sql_query):
-    """Execute the generated SQL query and return formatted results."""
-    conn = connect_db()
-    if not conn:
-        return None
+@contextmanager
+def _guarded_cursor(conn, sql_query, name, batch_size, user_id):
+    """
+    Server-side cursor over `sql_query` in a READ ONLY transaction with the question timeout,
+    limited to `user_id`'s rows by the row-level security policies, after the planner's cost
+    estimate has been checked (raises SQLGuardError if it's too high).
+    """
+    with conn.cursor() as cursor:
+        with stage("sql_guard"):
+            sql_guard.begin_guarded(cursor)
+            set_tenant(cursor, user_id)
+            cost = sql_guard.check_cost(cursor, sql_query)
+    if cost is not None:
+        annotate(plan_cost=round(cost, 1))
+    with conn.cursor(name=name) as cursor:
+        cursor.itersize = batch_size
+        with stage("sql_execute"):
+            cursor.execute(sql_query)
+        yield cursor
+
 
-    cursor = conn.cursor()
+def execute_sql_query(sql_query, batch_size=sql_guard.SQL_FETCH_BATCH, user_id=None):
+    """
+    Execute the generated SQL query on a pooled connection and return formatted results.
 
+    Rows are fetched in batches from a server-side cursor; SQLGuardError propagates so callers
+    can tell a refused query from a failed one.
+    """
     try:
-        cursor.execute(sql_query)
-        results = cursor.fetchall()
-        formatted_results = format_results(results, cursor.description)
+        with get_pool().connection() as conn:
+            with _guarded_cursor(conn, sql_query, "query_execute", batch_size, user_id) as cursor:
+                formatted_results = []
+                while True:
+                    with stage("row_fetch"):
+                        rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    with stage("format_results"):
+                        formatted_results.extend(format_results(rows, cursor.description))
+                annotate(row_count=len(formatted_results))
+                return formatted_results
+    except PoolTimeout as e:
+        print(f"Database pool exhausted: {e}")
+        annotate(error=str(e))
     except psycopg2.Error as e:
         print(f"Error executing SQL query: {e}")
-        formatted_results = None
+        annotate(error=str(e).strip())
+    return None
+
 
-    cursor.close()
-    conn.close()
-    return formatted_results
\ No newline at end of file
+def stream_sql_query(sql_query, batch_size=100, user_id=None):
+    """Execute SQL with a server-side cursor and yield formatted rows in batches."""
+    with get_pool().connection() as conn:
+        with _guarded_cursor(conn, sql_query, "query_stream", batch_size, user_id) as cursor:
+            while True:
+                with stage("row_fetch"):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                with stage("format_results"):
+                    formatted_rows = format_results(rows, cursor.description)
+                yield formatted_rows
@@ -0,0 +1,162 @@
+import os
+import re
+import threading
+
+from dotenv import load_dotenv
+
+
+# Load environment variables
+load_dotenv()
+
+SQL_GUARD_ENABLED = os.getenv("SQL_GUARD_ENABLED", "true").lower() == "true"
+# Row cap: a missing LIMIT is added, a larger one (or LIMIT ALL) is lowered to this
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000"))
+# Planner cost above which a query is refused before it runs (0 = don't EXPLAIN)
+SQL_MAX_PLAN_COST = float(os.getenv("SQL_MAX_PLAN_COST", "1000000"))
+# Per-query timeout for question queries (the pool's DB_STATEMENT_TIMEOUT_MS still applies to everything else)
+SQL_GUARD_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_GUARD_STATEMENT_TIMEOUT_MS", "10000"))
+SQL_FETCH_BATCH = int(os.getenv("SQL_FETCH_BATCH", "500"))  # rows per server-side cursor round trip
+
+# Statements and clauses that write, lock or change session state
+FORBIDDEN_KEYWORDS = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|UPSERT|DROP|ALTER|CREATE|TRUNCATE|GRANT|REVOKE|COPY|VACUUM|ANALYZE|CLUSTER|"
+    r"REINDEX|CALL|DO|LOCK|SET|RESET|COMMENT|REFRESH|LISTEN|NOTIFY|PREPARE|EXECUTE|DEALLOCATE|DISCARD|BEGIN|"
+    r"COMMIT|ROLLBACK|SAVEPOINT|INTO)\b|\bFOR\s+(NO\s+KEY\s+|KEY\s+)?SHARE\b",
+    re.I,
+)
+# Functions with side effects, or that read the server's files or hold the connection
+FORBIDDEN_FUNCTIONS = re.compile(
+    r"\b(pg_sleep\w*|pg_read_file|pg_read_binary_file|pg_ls_\w+|pg_stat_file|lo_\w+|dblink\w*|"
+    r"pg_terminate_backend|pg_cancel_backend|pg_reload_conf|pg_rotate_logfile|set_config|"
+    r"pg_advisory\w*|pg_try_advisory\w*|nextval|setval|\w+_to_xml\w*|pg_notify)\s*\(",
+    re.I,
+)
+# System catalogs and statistics views (pg_stats holds sampled column values of every table)
+FORBIDDEN_RELATIONS = re.compile(r"\b(pg_\w+|information_schema)\b", re.I)
+
+_stats = {"checked": 0, "rejected_statement": 0, "rejected_cost": 0, "limit_added": 0, "limit_lowered": 0}
+_stats_lock = threading.Lock()
+
+
+class SQLGuardError(ValueError):
+    """Generated SQL that is not allowed to run."""
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _mask(sql, keep_identifiers=False):
+    """
+    SQL with comments, string literals and quoted identifiers blanked out, keeping every offset.
+    With `keep_identifiers`, quoted identifiers keep their name (between blanks) instead.
+    """
+    def blank(match):
+        text = match.group(0)
+        if text.startswith(("--", "/*")):
+            return " " * len(text)
+        if keep_identifiers and text.startswith('"'):
+            return f" {text[1:-1]} "
+        return text[0] + "x" * (len(text) - 2) + text[-1]
+    return re.sub(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(\w*)\$.*?\$\1\$", blank, sql, flags=re.S)
+
+
+def check_read_only(sql):
+    """Raise SQLGuardError unless `sql` is a single SELECT (or WITH ... SELECT) without side effects."""
+    masked = _mask(sql)
+    if ";" in masked:
+        raise SQLGuardError("Only a single statement is allowed")
+    if not re.match(r"\s*(\(\s*)*(SELECT|WITH)\b", masked, re.I):
+        raise SQLGuardError("Only SELECT queries are allowed")
+    if re.search(r"\bU&['\"]", masked, re.I):
+        raise SQLGuardError("Unicode-escaped identifiers and strings are not allowed")
+    match = FORBIDDEN_KEYWORDS.search(masked) or FORBIDDEN_FUNCTIONS.search(masked)
+    if match:
+        raise SQLGuardError(f"Query uses a disallowed keyword or function: {match.group(0).strip()}")
+    match = FORBIDDEN_RELATIONS.search(_mask(sql, keep_identifiers=True))
+    if match:
+        raise SQLGuardError(f"Query reads a system catalog: {match.group(0)}")
+
+
+def _top_level_limit(masked):
+    """The last LIMIT/FETCH keyword outside parentheses, or None."""
+    depth, last = 0, None
+    for match in re.finditer(r"[()]|\bLIMIT\b|\bFETCH\b", masked, re.I):
+        token = match.group(0)
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            last = match
+    return last
+
+
+def cap_limit(sql, max_rows=SQL_MAX_ROWS):
+    """
+    Make sure the query returns at most `max_rows` rows; returns (sql, action).
+
+    action is None (existing limit is small enough), "added" or "lowered". Limits that aren't a
+    plain number are left alone and the whole query is wrapped in an outer LIMIT instead.
+    """
+    masked = _mask(sql)
+    keyword = _top_level_limit(masked)
+    if keyword is None:
+        return f"{sql}\nLIMIT {max_rows}", "added"  # newline: the query may end in a -- comment
+
+    tail = masked[keyword.start():]
+    match = (re.match(r"LIMIT\s+(\d+|ALL)\b", tail, re.I)
+             or re.match(r"FETCH\s+(?:FIRST|NEXT)\s+(\d+)\s+ROWS?\s+(?:ONLY|WITH\s+TIES)\b", tail, re.I))
+    if match is None:
+        return f"SELECT * FROM (\n{sql}\n) AS limited\nLIMIT {max_rows}", "added"
+    value = match.group(1)
+    if value.upper() != "ALL" and int(value) <= max_rows:
+        return sql, None
+    start = keyword.start() + match.start(1)
+    return f"{sql[:start]}{max_rows}{sql[start + len(value):]}", "lowered"
+
+
+def guard_sql(sql, max_rows=SQL_MAX_ROWS):
+    """Validate generated SQL and cap its row count; returns the SQL to execute and cache on."""
+    sql = sql.strip().rstrip(";").strip()
+    if not SQL_GUARD_ENABLED:
+        return sql
+    _count("checked")
+    try:
+        check_read_only(sql)
+    except SQLGuardError:
+        _count("rejected_statement")
+        raise
+    sql, action = cap_limit(sql, max_rows)
+    if action:
+        _count(f"limit_{action}")
+    return sql
+
+
+def begin_guarded(cursor, timeout_ms=SQL_GUARD_STATEMENT_TIMEOUT_MS):
+    """Start the transaction as READ ONLY with the question timeout (first statements of the transaction)."""
+    cursor.execute("SET TRANSACTION READ ONLY")
+    cursor.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+
+
+def explain_cost(cursor, sql):
+    """The planner's total cost estimate for `sql` (raises psycopg2 errors for SQL that doesn't plan)."""
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql)
+    return cursor.fetchone()[0][0]["Plan"]["Total Cost"]
+
+
+def check_cost(cursor, sql, max_cost=SQL_MAX_PLAN_COST):
+    """EXPLAIN the query and refuse it if the planner's total cost estimate is above `max_cost`."""
+    if not SQL_GUARD_ENABLED or not max_cost:
+        return None
+    cost = explain_cost(cursor, sql)
+    if cost > max_cost:
+        _count("rejected_cost")
+        raise SQLGuardError(f"Query too expensive (estimated cost {cost:.0f} > {max_cost:.0f})")
+    return cost
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,158 @@
+"""
+Per-athlete isolation of the SQL the backend runs.
+
+Postgres row-level security is the boundary: a policy on every tenant table only exposes rows
+whose user_id matches the transaction-local `app.user_id` setting, which the backend sets
+before running a question's SQL. scope_sql additionally shadows the tables with filtered CTEs,
+so cache keys differ per athlete and the filter reaches the (user_id, ...) indexes.
+
+    python backend/tenancy.py status    # RLS state of the tenant tables and the backend role
+    python backend/tenancy.py enable    # add the policies to an existing database
+"""
+import argparse
+import os
+import re
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+
+# Load environment variables
+load_dotenv()
+
+# Athlete used when a request doesn't name one (single-athlete installs)
+DEFAULT_USER_ID = os.getenv("DEFAULT_USER_ID") or os.getenv("STRAVA_USER_ID") or None
+# Refuse requests that don't identify an athlete instead of querying every athlete's rows
+REQUIRE_USER_ID = os.getenv("REQUIRE_USER_ID", "false").lower() == "true"
+
+# Tables holding per-athlete rows; every reference to them is scoped to the requesting athlete
+TENANT_TABLES = ("activities", "activity_rollups", "activity_type_centroids")
+
+USER_ID_PATTERN = re.compile(r"^[\w-]{1,50}$")
+
+# Transaction-local setting the row-level security policies compare user_id with
+TENANT_SETTING = "app.user_id"
+
+# Sessions that never set it (ingestion, maintenance, unscoped requests) see every row
+RLS_SQL = """
+    ALTER TABLE {table} ENABLE ROW LEVEL SECURITY;
+    ALTER TABLE {table} FORCE ROW LEVEL SECURITY;
+    DROP POLICY IF EXISTS tenant_isolation ON {table};
+    CREATE POLICY tenant_isolation ON {table}
+        USING (COALESCE(current_setting('app.user_id', true), '') = ''
+               OR user_id = current_setting('app.user_id', true))
+"""
+
+
+class TenantError(ValueError):
+    """The request can't be scoped to a single athlete."""
+
+
+def resolve_user_id(body_user_id=None, header_user_id=None):
+    """Athlete for a request: body `user_id`, then `X-User-ID`, then DEFAULT_USER_ID (None = unscoped)."""
+    user_id = body_user_id or header_user_id or DEFAULT_USER_ID
+    if user_id is None:
+        if REQUIRE_USER_ID:
+            raise TenantError("No user_id provided")
+        return None
+    user_id = str(user_id).strip()
+    if not USER_ID_PATTERN.match(user_id):
+        raise TenantError(f"Invalid user_id: {user_id!r}")
+    return user_id
+
+
+def _strip_literals(sql):
+    """SQL with comments and string literals blanked out and identifiers unquoted, for structural checks."""
+    sql = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.S)
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    return re.sub(r'"((?:[^"]|"")*)"', lambda m: m.group(1).replace('""', '"'), sql)
+
+
+def scope_sql(sql, user_id):
+    """
+    Rewrite a single SELECT so every tenant table only exposes `user_id`'s rows.
+
+    Each tenant table is shadowed by a CTE of the same name filtering on user_id. The CTEs are
+    NOT MATERIALIZED, so Postgres inlines them and the filter reaches the (user_id, ...) indexes.
+    """
+    if user_id is None:
+        return sql
+    if not USER_ID_PATTERN.match(user_id):
+        raise TenantError(f"Invalid user_id: {user_id!r}")
+    sql = sql.strip().rstrip(";").strip()
+    structure = _strip_literals(sql)
+    if ";" in structure:
+        raise TenantError("Only a single statement can be scoped")
+    if re.search(r"\bU&\S", structure, re.I):
+        raise TenantError("Unicode-escaped identifiers can't be scoped")
+    if re.search(r"\.\s*(?:" + "|".join(TENANT_TABLES) + r")\b", structure, re.I):
+        raise TenantError("Schema-qualified tenant tables can't be scoped")
+
+    ctes = ",\n".join(
+        f"{table} AS NOT MATERIALIZED (SELECT * FROM public.{table} WHERE user_id = '{user_id}')"
+        for table in TENANT_TABLES
+    )
+    match = re.match(r"WITH(\s+RECURSIVE)?\s+", sql, re.I)
+    if match:
+        return f"{match.group(0)}{ctes},\n{sql[match.end():]}"
+    return f"WITH {ctes}\n{sql}"
+
+
+def set_tenant(cursor, user_id):
+    """Limit the rest of the current transaction to `user_id`'s rows (None = every row)."""
+    cursor.execute("SELECT set_config(%s, %s, true)", (TENANT_SETTING, user_id or ""))
+
+
+def enable_row_security(conn, tables=TENANT_TABLES):
+    """Enable RLS with the tenant policy on every tenant table that exists."""
+    enabled = []
+    with conn.cursor() as cursor:
+        for table in tables:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+            if cursor.fetchone()[0]:
+                cursor.execute(sql.SQL(RLS_SQL).format(table=sql.Identifier(table)))
+                enabled.append(table)
+    conn.commit()
+    return enabled
+
+
+def row_security_problems(conn, tables=TENANT_TABLES):
+    """Reasons the RLS policies would not isolate athletes for this connection's role (empty = fine)."""
+    problems = []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT rolsuper OR rolbypassrls FROM pg_roles WHERE rolname = current_user")
+        if cursor.fetchone()[0]:
+            problems.append("the database role is a superuser or has BYPASSRLS")
+        cursor.execute("SELECT relname FROM pg_class WHERE relname = ANY(%s) AND relkind = 'r' "
+                       "AND relnamespace = 'public'::regnamespace AND NOT (relrowsecurity AND relforcerowsecurity)",
+                       (list(tables),))
+        problems.extend(f"row-level security is not enabled on {table}" for (table,) in cursor.fetchall())
+    conn.rollback()
+    return problems
+
+
+def main():
+    from db_pool import connect
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "enable"])
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        if args.command == "enable":
+            print(f"✅ Row-level security enabled on {', '.join(enable_row_security(conn))}")
+        problems = row_security_problems(conn)
+        for problem in problems:
+            print(f"⚠️ {problem}")
+        if not problems:
+            print("✅ Queries are isolated per athlete")
+    except psycopg2.Error as e:
+        print(f"❌ {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
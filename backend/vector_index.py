@@ -0,0 +1,387 @@
+"""
+Build and maintain the ANN index on activities.embedding.
+
+    python backend/vector_index.py status
+    python backend/vector_index.py create --method hnsw --m 16 --ef-construction 64
+    python backend/vector_index.py create --method ivfflat --lists 100
+    python backend/vector_index.py reindex
+    python backend/vector_index.py drop
+    python backend/vector_index.py partial --min-rows 100 --max-share 0.25
+    python backend/vector_index.py quantize --quantization bit
+
+With --quantization halfvec or bit the index is built on a reduced-precision expression of
+`embedding` (half-precision floats, or one bit per dimension compared by Hamming distance).
+Similarity queries scan that small index for VECTOR_RERANK_CANDIDATES coarse candidates
+and re-rank them by exact float32 distance, which stays in the table.
+"""
+import argparse
+import math
+import os
+import re
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+from db_pool import connect
+
+
+# Load environment variables
+load_dotenv()
+
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw")  # hnsw | ivfflat
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "0"))  # 0 = derive from the row count
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "0"))  # 0 = sqrt(lists)
+INDEX_MAINTENANCE_WORK_MEM = os.getenv("INDEX_MAINTENANCE_WORK_MEM", "512MB")
+# Activity types with fewer rows get no partial index; an exact sort of that many rows is as fast
+PARTIAL_INDEX_MIN_ROWS = int(os.getenv("PARTIAL_INDEX_MIN_ROWS", "100"))
+# Types above this share of the table get no partial index either: post-filtering the global
+# index's ef_search candidates still leaves enough of them (0.25 keeps 10 of hnsw's default 40)
+PARTIAL_INDEX_MAX_SHARE = float(os.getenv("PARTIAL_INDEX_MAX_SHARE", "0.25"))
+# pgvector >= 0.8: keep scanning a global index until enough rows pass the WHERE filter
+# ("relaxed_order" / "strict_order"); every question is filtered by user_id, so this is on by
+# default. Empty (or an older pgvector) leaves the server default, which stops after ef_search rows
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+
+# none | halfvec | bit: representation the ANN index stores (the table always keeps float32)
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+# Coarse candidates read from a quantized index before re-ranking by exact distance
+VECTOR_RERANK_CANDIDATES = int(os.getenv("VECTOR_RERANK_CANDIDATES", "100"))
+EMBEDDING_DIM = 384
+
+# Cosine distance, matching the `<=>` operator used by every similarity query
+OPCLASS = "vector_cosine_ops"
+
+# Indexed expression, operator class and the matching ORDER BY for each representation
+QUANTIZATIONS = {
+    "none": {"expression": "embedding", "opclass": OPCLASS, "order": "embedding <=> {query}"},
+    "halfvec": {"expression": f"(embedding::halfvec({EMBEDDING_DIM}))", "opclass": "halfvec_cosine_ops",
+                "order": f"embedding::halfvec({EMBEDDING_DIM}) <=> ({{query}})::halfvec({EMBEDDING_DIM})"},
+    "bit": {"expression": f"(binary_quantize(embedding)::bit({EMBEDDING_DIM}))", "opclass": "bit_hamming_ops",
+            "order": f"binary_quantize(embedding)::bit({EMBEDDING_DIM}) <~> "
+                     f"binary_quantize({{query}})::bit({EMBEDDING_DIM})"},
+}
+
+
+def _prefix(table, method, quantization):
+    quantized = "" if quantization == "none" else f"{quantization}_"
+    return f"{table}_embedding_{quantized}{method}"
+
+
+def index_name(table="activities", method=VECTOR_INDEX_METHOD, quantization=VECTOR_QUANTIZATION):
+    return f"{_prefix(table, method, quantization)}_idx"
+
+
+def partial_index_name(activity_type, table="activities", method=VECTOR_INDEX_METHOD,
+                       quantization=VECTOR_QUANTIZATION):
+    slug = re.sub(r"\W", "", activity_type).lower()
+    return f"{_prefix(table, method, quantization)}_{slug}_idx"
+
+
+def similarity_order(query, quantization=VECTOR_QUANTIZATION):
+    """ORDER BY expression served by the `quantization` index, for `query` (SQL yielding a vector)."""
+    return QUANTIZATIONS[quantization]["order"].format(query=query)
+
+
+# Outermost `FROM activities [alias] [WHERE ...] ORDER BY embedding <=> <query> LIMIT n`, as the
+# prompt and the few-shot examples write similarity searches
+SIMILARITY_SEARCH = re.compile(
+    r"^(?P<head>.*)\bFROM\s+activities(?P<alias>\s+(?:AS\s+)?(?!WHERE\b|ORDER\b)\w+)?(?P<where>\s+WHERE\s+.+?)?"
+    r"\s+ORDER\s+BY\s+(?P<column>(?:\w+\.)?embedding)\s*<=>\s*(?P<query>.+?)(?:\s+ASC)?"
+    r"\s+LIMIT\s+(?P<limit>\d+)\s*(?P<end>;?)\s*$", re.I | re.S)
+NOT_IN_FILTER = re.compile(r"\b(?:GROUP|HAVING|WINDOW|UNION|INTERSECT|EXCEPT|ORDER|LIMIT|OFFSET)\b|,", re.I)
+
+
+def _top_level(sql):
+    """`sql` with string literals and parenthesized parts removed, None if its parentheses don't balance."""
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    while True:
+        stripped = re.sub(r"\([^()]*\)", "", sql)
+        if stripped == sql:
+            return None if "(" in sql or ")" in sql else sql
+        sql = stripped
+
+
+def rerank_similarity(sql, quantization=VECTOR_QUANTIZATION, candidates=VECTOR_RERANK_CANDIDATES):
+    """
+    Rewrite a similarity search ordered by the exact `embedding <=>` distance so it reads its
+    candidates from the `quantization` index and re-ranks them by exact distance (the same shape
+    as the similar_to_last_rerank template). SQL of any other shape is returned unchanged and
+    falls back to an exact sort if the float32 index was dropped.
+    """
+    match = SIMILARITY_SEARCH.match(sql.strip()) if quantization != "none" else None
+    if match is None:
+        return sql
+    where, query = match.group("where") or "", match.group("query")
+    head, where_top, query_top = _top_level(match.group("head")), _top_level(where), _top_level(query)
+    if head is None or where_top is None or query_top is None or \
+            NOT_IN_FILTER.search(where_top) or NOT_IN_FILTER.search(query_top):
+        return sql
+    alias = match.group("alias") or ""
+    name = alias.split()[-1] if alias else "activities"
+    limit = int(match.group("limit"))
+    filter_clause = f"\n    WHERE {where.strip()[len('WHERE'):].strip()}" if where else ""
+    return (f"{match.group('head')}FROM (\n"
+            f"    SELECT * FROM activities{alias}{filter_clause}\n"
+            f"    ORDER BY {similarity_order(query, quantization)}\n"
+            f"    LIMIT {max(limit, candidates)}\n"
+            f") AS {name}\n"
+            f"ORDER BY {match.group('column')} <=> {query}\n"
+            f"LIMIT {limit}{match.group('end')}")
+
+
+def default_lists(rows):
+    """pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond."""
+    if rows <= 1_000_000:
+        return max(1, rows // 1000)
+    return int(math.sqrt(rows))
+
+
+def default_probes(lists):
+    return max(1, int(math.sqrt(lists)))
+
+
+def search_settings(method=VECTOR_INDEX_METHOD, ef_search=HNSW_EF_SEARCH, probes=None, lists=None,
+                    quantization=VECTOR_QUANTIZATION):
+    """Session settings that control the recall/latency trade-off at query time."""
+    if method == "hnsw":
+        if quantization != "none":
+            ef_search = max(int(ef_search), VECTOR_RERANK_CANDIDATES)  # HNSW returns at most ef_search rows
+        settings = {"hnsw.ef_search": int(ef_search)}
+        if HNSW_ITERATIVE_SCAN:
+            settings["hnsw.iterative_scan"] = HNSW_ITERATIVE_SCAN
+        return settings
+    if probes is None:
+        probes = IVFFLAT_PROBES or default_probes(lists or IVFFLAT_LISTS or 100)
+    return {"ivfflat.probes": int(probes)}
+
+
+def pgvector_version(conn):
+    """Installed pgvector version as (major, minor), (0, 0) if the extension is missing."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cursor.fetchone()
+    return tuple(int(part) for part in re.findall(r"\d+", row[0])[:2]) if row else (0, 0)
+
+
+def supported_settings(conn, settings):
+    """`settings` without the ones the installed pgvector doesn't know (iterative scans need 0.8)."""
+    if "hnsw.iterative_scan" in settings and pgvector_version(conn) < (0, 8):
+        settings = {name: value for name, value in settings.items() if name != "hnsw.iterative_scan"}
+    return settings
+
+
+def apply_search_settings(conn, **kwargs):
+    """SET the ANN search parameters for this session (used for every pooled connection)."""
+    settings = supported_settings(conn, search_settings(**kwargs))
+    with conn.cursor() as cursor:
+        for name, value in settings.items():
+            cursor.execute(f"SET {name} = %s", (value,))
+
+
+def create_index(conn, method=VECTOR_INDEX_METHOD, table="activities", m=HNSW_M,
+                 ef_construction=HNSW_EF_CONSTRUCTION, lists=IVFFLAT_LISTS, concurrently=True,
+                 where=None, name=None, quantization=VECTOR_QUANTIZATION):
+    """Build an HNSW or IVFFlat index on `table.embedding` (or its quantized form); returns the index name."""
+    name = name or index_name(table, method, quantization)
+    with conn.cursor() as cursor:
+        if method == "hnsw":
+            options = sql.SQL("WITH (m = {}, ef_construction = {})").format(
+                sql.Literal(int(m)), sql.Literal(int(ef_construction)))
+        elif method == "ivfflat":
+            if not lists:
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(table)))
+                lists = default_lists(cursor.fetchone()[0])
+            options = sql.SQL("WITH (lists = {})").format(sql.Literal(int(lists)))
+        else:
+            raise ValueError(f"Unknown index method: {method}")
+
+        cursor.execute("SET maintenance_work_mem = %s", (INDEX_MAINTENANCE_WORK_MEM,))
+        statement = sql.SQL("CREATE INDEX {concurrently} IF NOT EXISTS {name} ON {table} "
+                            "USING {method} ({expression} {opclass}) {options}").format(
+            concurrently=sql.SQL("CONCURRENTLY" if concurrently else ""),
+            name=sql.Identifier(name),
+            table=sql.Identifier(table),
+            method=sql.SQL(method),
+            expression=sql.SQL(QUANTIZATIONS[quantization]["expression"]),
+            opclass=sql.SQL(QUANTIZATIONS[quantization]["opclass"]),
+            options=options,
+        )
+        if where is not None:
+            statement = sql.SQL("{} WHERE {}").format(statement, where)
+        cursor.execute(statement)
+    return name
+
+
+def activity_type_counts(conn, table="activities"):
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL(
+            "SELECT activity_type, COUNT(*) FROM {} WHERE activity_type IS NOT NULL "
+            "GROUP BY activity_type ORDER BY COUNT(*) DESC").format(sql.Identifier(table)))
+        return dict(cursor.fetchall())
+
+
+def partial_index_types(counts, min_rows=PARTIAL_INDEX_MIN_ROWS, max_share=PARTIAL_INDEX_MAX_SHARE):
+    """
+    Activity types selective enough for a partial index: a small share of the table, where the
+    global index would return few matching rows, but not so few rows that an exact sort is as fast.
+    """
+    total = sum(counts.values())
+    return [activity_type for activity_type, rows in counts.items()
+            if min_rows <= rows <= max_share * total]
+
+
+def ensure_partial_indexes(conn, method=VECTOR_INDEX_METHOD, table="activities", min_rows=PARTIAL_INDEX_MIN_ROWS,
+                           m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, concurrently=True,
+                           quantization=VECTOR_QUANTIZATION, max_share=PARTIAL_INDEX_MAX_SHARE):
+    """
+    Create a partial ANN index (WHERE activity_type = X) per selective activity type present in
+    the data, so type-scoped similarity queries search only that type's vectors. Returns the new
+    index names.
+    """
+    existing = {index["name"] for index in list_indexes(conn, table)}
+    created = []
+    counts = activity_type_counts(conn, table)
+    for activity_type in partial_index_types(counts, min_rows, max_share):
+        rows = counts[activity_type]
+        name = partial_index_name(activity_type, table, method, quantization)
+        if name in existing:
+            continue
+        print(f"Creating {name} for {rows} {activity_type} activities ({rows / sum(counts.values()):.1%}) ...")
+        create_index(conn, method, table, m=m, ef_construction=ef_construction, lists=default_lists(rows),
+                     concurrently=concurrently, name=name, quantization=quantization,
+                     where=sql.SQL("activity_type = {}").format(sql.Literal(activity_type)))
+        created.append(name)
+    return created
+
+
+def check_quantization_support(conn, quantization):
+    """Raise ValueError if the installed pgvector can't index `quantization` (halfvec/bit need 0.7)."""
+    if quantization == "none":
+        return
+    version = pgvector_version(conn)
+    if version < (0, 7):
+        raise ValueError(f"{quantization} indexes need pgvector >= 0.7 "
+                         f"(installed: {'.'.join(map(str, version)) if version != (0, 0) else 'none'})")
+
+
+def quantize(conn, quantization, method=VECTOR_INDEX_METHOD, table="activities", m=HNSW_M,
+             ef_construction=HNSW_EF_CONSTRUCTION, min_rows=PARTIAL_INDEX_MIN_ROWS, drop_full=False,
+             concurrently=True, max_share=PARTIAL_INDEX_MAX_SHARE):
+    """
+    Migrate similarity search to a quantized index: build it (and per-type partial ones) over the
+    existing rows, then optionally drop the float32 indexes it replaces. New rows are indexed
+    automatically because the index is on an expression of `embedding`.
+    """
+    check_quantization_support(conn, quantization)
+    name = create_index(conn, method, table, m, ef_construction, concurrently=concurrently, quantization=quantization)
+    created = [name] + ensure_partial_indexes(conn, method, table, min_rows, m, ef_construction,
+                                              concurrently=concurrently, quantization=quantization,
+                                              max_share=max_share)
+    if drop_full:
+        replaced = re.compile(rf"{re.escape(table)}_embedding_{method}_(\w+_)?idx$")
+        for index in list_indexes(conn, table):
+            if replaced.match(index["name"]):
+                print(f"Dropping {index['name']} ({index['size_bytes'] / 1024 / 1024:.1f} MB) ...")
+                drop_index(conn, index["name"], concurrently=concurrently)
+    return created
+
+
+def drop_index(conn, name, concurrently=True):
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("DROP INDEX {} IF EXISTS {}").format(
+            sql.SQL("CONCURRENTLY" if concurrently else ""), sql.Identifier(name)))
+
+
+def reindex(conn, name, concurrently=True):
+    """Rebuild an index, e.g. after IVFFlat lists no longer fit the table size."""
+    with conn.cursor() as cursor:
+        cursor.execute("SET maintenance_work_mem = %s", (INDEX_MAINTENANCE_WORK_MEM,))
+        cursor.execute(sql.SQL("REINDEX INDEX {} {}").format(
+            sql.SQL("CONCURRENTLY" if concurrently else ""), sql.Identifier(name)))
+
+
+def list_indexes(conn, table="activities"):
+    """Vector indexes on a table with their size and definition."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT i.relname, am.amname, pg_relation_size(i.oid), pg_get_indexdef(i.oid)
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            JOIN pg_class t ON t.oid = x.indrelid
+            JOIN pg_am am ON am.oid = i.relam
+            WHERE t.relname = %s AND am.amname IN ('hnsw', 'ivfflat')
+            ORDER BY i.relname
+            """,
+            (table,),
+        )
+        return [
+            {"name": name, "method": method, "size_bytes": size, "definition": definition}
+            for name, method, size, definition in cursor.fetchall()
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "create", "drop", "reindex", "partial", "quantize"])
+    parser.add_argument("--table", default="activities")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default=VECTOR_INDEX_METHOD)
+    parser.add_argument("--quantization", choices=sorted(QUANTIZATIONS), default=VECTOR_QUANTIZATION)
+    parser.add_argument("--drop-full", action="store_true",
+                        help="quantize: drop the float32 indexes once the quantized ones are built")
+    parser.add_argument("--m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--lists", type=int, default=IVFFLAT_LISTS, help="0 = derive from the row count")
+    parser.add_argument("--min-rows", type=int, default=PARTIAL_INDEX_MIN_ROWS,
+                        help="Smallest activity type that gets a partial index")
+    parser.add_argument("--max-share", type=float, default=PARTIAL_INDEX_MAX_SHARE,
+                        help="Largest share of the table an activity type with a partial index may have")
+    parser.add_argument("--name", help="Index name (defaults to <table>_embedding_<method>_idx)")
+    parser.add_argument("--blocking", action="store_true", help="Don't build/drop CONCURRENTLY")
+    args = parser.parse_args()
+
+    conn = connect()
+    conn.autocommit = True  # CREATE/DROP/REINDEX CONCURRENTLY can't run inside a transaction
+    try:
+        name = args.name or index_name(args.table, args.method, args.quantization)
+        if args.command == "create":
+            check_quantization_support(conn, args.quantization)
+            name = create_index(conn, args.method, args.table, args.m, args.ef_construction,
+                                args.lists, concurrently=not args.blocking, name=name,
+                                quantization=args.quantization)
+            print(f"✅ Created index {name}")
+        elif args.command == "quantize":
+            if args.quantization == "none":
+                parser.error("quantize needs --quantization halfvec or bit")
+            created = quantize(conn, args.quantization, args.method, args.table, args.m, args.ef_construction,
+                               args.min_rows, drop_full=args.drop_full, concurrently=not args.blocking,
+                               max_share=args.max_share)
+            print(f"✅ Built {len(created)} {args.quantization} index(es); set VECTOR_QUANTIZATION={args.quantization}")
+        elif args.command == "drop":
+            drop_index(conn, name, concurrently=not args.blocking)
+            print(f"✅ Dropped index {name}")
+        elif args.command == "partial":
+            created = ensure_partial_indexes(conn, args.method, args.table, args.min_rows, args.m,
+                                             args.ef_construction, concurrently=not args.blocking,
+                                             quantization=args.quantization, max_share=args.max_share)
+            print(f"✅ Created {len(created)} partial index(es)")
+        elif args.command == "reindex":
+            reindex(conn, name, concurrently=not args.blocking)
+            print(f"✅ Rebuilt index {name}")
+
+        for index in list_indexes(conn, args.table):
+            print(f"{index['name']} ({index['method']}, {index['size_bytes'] / 1024 / 1024:.1f} MB)")
+            print(f"    {index['definition']}")
+        print(f"Query-time settings: {search_settings()}")
+    except (psycopg2.Error, ValueError) as e:
+        print(f"❌ {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
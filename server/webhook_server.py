@@ -0,0 +1,130 @@
+"""
+Receive Strava push subscription events and keep `activities` fresh without polling.
+
+    python server/webhook_server.py serve                      # receiver + background worker
+    python server/webhook_server.py serve --no-worker          # receiver only (run utils/strava/webhook_worker.py)
+    python server/webhook_server.py subscribe --callback-url https://example.com/webhook
+    python server/webhook_server.py list
+    python server/webhook_server.py unsubscribe <subscription_id>
+
+Events are acknowledged as soon as they are on the durable queue; Strava expects a 200
+within two seconds and retries otherwise.
+"""
+import argparse
+import os
+import sys
+
+import requests
+from dotenv import load_dotenv
+from flask import Flask, jsonify, request
+
+# The queue and worker live with the other Strava ingestion modules
+STRAVA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils", "strava")
+if STRAVA_DIR not in sys.path:
+    sys.path.insert(0, STRAVA_DIR)
+
+from event_queue import EventQueue
+
+# Load environment variables from .env file
+load_dotenv()
+
+STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
+STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
+STRAVA_API_URL = os.getenv("STRAVA_API_URL", "https://www.strava.com/api/v3")
+# Echoed back by Strava when validating the callback URL; pick any secret string
+STRAVA_VERIFY_TOKEN = os.getenv("STRAVA_VERIFY_TOKEN", "")
+# Reject events for other subscriptions when set
+STRAVA_SUBSCRIPTION_ID = os.getenv("STRAVA_SUBSCRIPTION_ID", "")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+
+EVENT_OBJECT_TYPES = ("activity", "athlete")
+EVENT_ASPECT_TYPES = ("create", "update", "delete")
+
+app = Flask(__name__)
+event_queue = EventQueue()
+worker = None
+
+
+@app.route("/webhook", methods=["GET"])
+def validate_subscription():
+    """Answer Strava's callback validation by echoing hub.challenge."""
+    if request.args.get("hub.mode") != "subscribe" or not STRAVA_VERIFY_TOKEN \
+            or request.args.get("hub.verify_token") != STRAVA_VERIFY_TOKEN:
+        return jsonify({"error": "Invalid verification request"}), 403
+    return jsonify({"hub.challenge": request.args.get("hub.challenge", "")})
+
+
+@app.route("/webhook", methods=["POST"])
+def receive_event():
+    """Queue a create/update/delete event for the worker."""
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict) or event.get("object_type") not in EVENT_OBJECT_TYPES \
+            or event.get("aspect_type") not in EVENT_ASPECT_TYPES or not str(event.get("object_id", "")).isdigit():
+        return jsonify({"error": "Not a Strava webhook event"}), 400
+    if STRAVA_SUBSCRIPTION_ID and str(event.get("subscription_id")) != STRAVA_SUBSCRIPTION_ID:
+        return jsonify({"error": "Unknown subscription"}), 403
+    event_queue.put(event)
+    return "", 200
+
+
+@app.route("/webhook/stats", methods=["GET"])
+def webhook_stats():
+    return jsonify(worker.stats() if worker else {"queue": event_queue.stats()})
+
+
+def _credentials():
+    return {"client_id": STRAVA_CLIENT_ID, "client_secret": STRAVA_CLIENT_SECRET}
+
+
+def subscribe(callback_url):
+    """Create the push subscription; Strava validates callback_url (this server must be reachable)."""
+    res = requests.post(f"{STRAVA_API_URL}/push_subscriptions", timeout=30,
+                        data=dict(_credentials(), callback_url=callback_url, verify_token=STRAVA_VERIFY_TOKEN))
+    res.raise_for_status()
+    return res.json()
+
+
+def list_subscriptions():
+    res = requests.get(f"{STRAVA_API_URL}/push_subscriptions", params=_credentials(), timeout=30)
+    res.raise_for_status()
+    return res.json()
+
+
+def unsubscribe(subscription_id):
+    res = requests.delete(f"{STRAVA_API_URL}/push_subscriptions/{int(subscription_id)}",
+                          params=_credentials(), timeout=30)
+    res.raise_for_status()
+
+
+def main():
+    global worker
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "subscribe", "list", "unsubscribe"])
+    parser.add_argument("subscription_id", nargs="?", help="For unsubscribe")
+    parser.add_argument("--callback-url", help="Public URL of /webhook, for subscribe")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--no-worker", action="store_true", help="Only queue events; process them elsewhere")
+    args = parser.parse_args()
+
+    if args.command == "subscribe":
+        if not args.callback_url or not STRAVA_VERIFY_TOKEN:
+            parser.error("subscribe needs --callback-url and STRAVA_VERIFY_TOKEN")
+        print(f"✅ Subscribed: {subscribe(args.callback_url)}")
+    elif args.command == "list":
+        for subscription in list_subscriptions():
+            print(subscription)
+    elif args.command == "unsubscribe":
+        if not args.subscription_id:
+            parser.error("unsubscribe needs a subscription_id")
+        unsubscribe(args.subscription_id)
+        print(f"✅ Deleted subscription {args.subscription_id}")
+    else:
+        if not args.no_worker:
+            from webhook_worker import WebhookWorker
+            worker = WebhookWorker(queue=event_queue)
+            worker.start()
+        app.run(port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
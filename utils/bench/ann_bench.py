@@ -0,0 +1,293 @@
+"""
+Recall@k and latency of ANN indexes against exact search, across table sizes.
+
+Loads synthetic activities into a scratch table (grown in place between sizes), measures
+exact search, builds the index and sweeps the query-time search parameter.
+
+    python utils/bench/ann_bench.py --sizes 10000,100000,1000000 --method hnsw --ef-search 20,40,100
+    python utils/bench/ann_bench.py --sizes 100000 --method ivfflat --probes 1,5,10,20
+
+At the largest size, type-scoped queries (WHERE activity_type = X) for --types compare a
+global index (post-filtering), exact pre-filtering and the shipped setup: the global index plus
+the partial indexes `vector_index.py partial` builds with the configured thresholds, and
+--quantizations compares halfvec/bit indexes with float32 re-ranking of --rerank coarse
+candidates against the float32 index: bytes per stored vector, index size, latency, recall@k.
+
+    python utils/bench/ann_bench.py --sizes 100000 --quantizations halfvec,bit --rerank 20,50,100,200
+"""
+import argparse
+import time
+
+import numpy as np
+from psycopg2 import sql
+
+from bench_common import summarize, write_results
+from synthetic import EmbeddingSpace, create_bench_table, load_rows, random_types, synthetic_activities, vector_literal
+
+from db_pool import connect
+from vector_index import (PARTIAL_INDEX_MAX_SHARE, PARTIAL_INDEX_MIN_ROWS, check_quantization_support, create_index,
+                          default_lists, default_probes, drop_index, ensure_partial_indexes, index_name,
+                          list_indexes, partial_index_name, search_settings, similarity_order, supported_settings)
+
+BENCH_TABLE = "bench_activities"
+
+
+def run_queries(conn, table, queries, k, where=None, settings=None, exact=False, statement=None, vector_params=1):
+    """Run top-k similarity queries; returns (result id lists, latencies in ms)."""
+    statement = statement or sql.SQL(
+        "SELECT activity_id FROM {table} {where} ORDER BY embedding <=> %s::vector LIMIT %s").format(
+        table=sql.Identifier(table),
+        where=sql.SQL("WHERE ") + where if where is not None else sql.SQL(""),
+    )
+    results, latencies = [], []
+    settings = supported_settings(conn, settings or {})
+    with conn.cursor() as cur:
+        for name, value in settings.items():
+            cur.execute(f"SET {name} = %s", (value,))
+        cur.execute("SET enable_indexscan = %s", ("off" if exact else "on",))
+        for vector, params in queries:
+            start = time.perf_counter()
+            cur.execute(statement, (*params, *[vector_literal(vector)] * vector_params, k))
+            ids = [row[0] for row in cur.fetchall()]
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append(ids)
+        cur.execute("RESET enable_indexscan")
+    conn.commit()
+    return results, latencies
+
+
+def rerank_statement(table, quantization, candidates):
+    """
+    Top-k by exact distance among the `candidates` nearest by the quantized index's distance
+    (takes the query vector twice).
+    """
+    return sql.SQL(
+        "SELECT activity_id FROM (SELECT activity_id, embedding FROM {table} ORDER BY {coarse} LIMIT {candidates}) "
+        "AS candidates ORDER BY embedding <=> %s::vector LIMIT %s").format(
+        table=sql.Identifier(table),
+        coarse=sql.SQL(similarity_order("%s::vector", quantization)),
+        candidates=sql.Literal(int(candidates)),
+    )
+
+
+def storage_sizes(conn, table):
+    """Average stored bytes per embedding as float32 vector, halfvec and binary-quantized bit string."""
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "SELECT AVG(pg_column_size(embedding)), AVG(pg_column_size(embedding::halfvec(384))), "
+            "AVG(pg_column_size(binary_quantize(embedding)::bit(384))) FROM {}").format(sql.Identifier(table)))
+        sizes = cur.fetchone()
+    conn.commit()
+    return dict(zip(["none", "halfvec", "bit"], (round(float(size), 1) for size in sizes)))
+
+
+def quantized_benchmark(conn, queries, exact, k, quantizations, rerank, method, m, ef_construction, ef_search,
+                        baseline):
+    """
+    Each quantized index next to the float32 one: vector and index sizes, build time, and
+    latency/recall@k when re-ranking `rerank` coarse candidates by exact distance.
+    """
+    for quantization in quantizations:
+        check_quantization_support(conn, quantization)
+    vector_bytes = storage_sizes(conn, BENCH_TABLE)
+    results = {"none": {"vector_bytes": vector_bytes["none"], **baseline}}
+    for quantization in quantizations:
+        conn.autocommit = True
+        name = index_name(BENCH_TABLE, method, quantization)
+        drop_index(conn, name, concurrently=False)
+        start = time.perf_counter()
+        create_index(conn, method, BENCH_TABLE, m=m, ef_construction=ef_construction, concurrently=False,
+                     quantization=quantization)
+        entry = {
+            "vector_bytes": vector_bytes[quantization],
+            "build_s": round(time.perf_counter() - start, 2),
+            "index_bytes": next(i["size_bytes"] for i in list_indexes(conn, BENCH_TABLE) if i["name"] == name),
+            "runs": [],
+        }
+        conn.autocommit = False
+        for candidates in rerank:
+            candidates = max(candidates, k)
+            settings = search_settings(method, ef_search=max(ef_search, candidates), quantization="none")
+            approx, latencies = run_queries(conn, BENCH_TABLE, queries, k, settings=settings,
+                                            statement=rerank_statement(BENCH_TABLE, quantization, candidates),
+                                            vector_params=2)
+            run = {"candidates": candidates, f"recall@{k}": recall_at_k(approx, exact, k), **summarize(latencies)}
+            entry["runs"].append(run)
+            print(f"   {quantization} ({entry['index_bytes'] / 1024 / 1024:.1f} MB index), {candidates} candidates: "
+                  f"recall {run[f'recall@{k}']}, p50 {run['p50_ms']} ms, p99 {run['p99_ms']} ms")
+        results[quantization] = entry
+        conn.autocommit = True
+        drop_index(conn, name, concurrently=False)  # keep later measurements on the float32 index
+        conn.autocommit = False
+    return results
+
+
+def recall_at_k(approx, exact, k):
+    hits = [len(set(a) & set(e[:k])) / max(1, min(k, len(e))) for a, e in zip(approx, exact)]
+    return round(float(np.mean(hits)), 4) if hits else 0.0
+
+
+def make_queries(n, seed=1234):
+    rng = np.random.default_rng(seed)
+    vectors = EmbeddingSpace().sample(random_types(n, rng), rng)
+    return [(v, ()) for v in vectors]
+
+
+def plan_indexes(conn, statement, params):
+    """Names of the indexes the planner uses for `statement`."""
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("EXPLAIN (FORMAT JSON) ") + statement, params)
+        plan = cur.fetchone()[0][0]["Plan"]
+    conn.commit()
+    names, nodes = [], [plan]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            names.append(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+    return names
+
+
+def type_scoped_benchmark(conn, method, activity_types, n_queries, k, m, ef_construction,
+                          min_rows=PARTIAL_INDEX_MIN_ROWS, max_share=PARTIAL_INDEX_MAX_SHARE):
+    """
+    Latency and recall of `WHERE activity_type = X ORDER BY embedding <=> q` per strategy; "shipped"
+    is the global index plus the partial indexes built with `min_rows`/`max_share`.
+    """
+    where = sql.SQL("activity_type = %s")
+    counts = {}
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT activity_type, COUNT(*) FROM {} GROUP BY 1").format(sql.Identifier(BENCH_TABLE)))
+        counts = dict(cur.fetchall())
+    conn.commit()
+    settings = search_settings(method, quantization="none")
+
+    rng = np.random.default_rng(99)
+    space = EmbeddingSpace()
+    workloads = {t: [(v, (t,)) for v in space.sample([t] * n_queries, rng)] for t in activity_types}
+    results = {t: {"rows": counts.get(t, 0)} for t in activity_types}
+
+    for activity_type, queries in workloads.items():
+        exact, latencies = run_queries(conn, BENCH_TABLE, queries, k, where=where, exact=True)
+        results[activity_type]["exact_prefilter"] = summarize(latencies)
+        approx, latencies = run_queries(conn, BENCH_TABLE, queries, k, where=where, settings=settings)
+        results[activity_type]["global_index"] = {f"recall@{k}": recall_at_k(approx, exact, k), **summarize(latencies)}
+        results[activity_type]["_exact"] = exact
+
+    conn.autocommit = True
+    created = ensure_partial_indexes(conn, method, BENCH_TABLE, min_rows=min_rows, m=m,
+                                     ef_construction=ef_construction, concurrently=False, quantization="none",
+                                     max_share=max_share)
+    conn.autocommit = False
+
+    statement = sql.SQL("SELECT activity_id FROM {} WHERE activity_type = %s "
+                        "ORDER BY embedding <=> %s::vector LIMIT %s").format(sql.Identifier(BENCH_TABLE))
+    for activity_type, queries in workloads.items():
+        exact = results[activity_type].pop("_exact")
+        approx, latencies = run_queries(conn, BENCH_TABLE, queries, k, where=where, settings=settings)
+        vector, params = queries[0]
+        results[activity_type]["shipped"] = {
+            "partial_index": partial_index_name(activity_type, BENCH_TABLE, method, "none") in created,
+            "plan_indexes": plan_indexes(conn, statement, (*params, vector_literal(vector), k)),
+            f"recall@{k}": recall_at_k(approx, exact, k),
+            **summarize(latencies),
+        }
+        r = results[activity_type]
+        print(f"   {activity_type} ({r['rows']} rows): global recall {r['global_index'][f'recall@{k}']} "
+              f"p50 {r['global_index']['p50_ms']} ms | shipped ({', '.join(r['shipped']['plan_indexes']) or 'no index'}) "
+              f"recall {r['shipped'][f'recall@{k}']} p50 {r['shipped']['p50_ms']} ms | "
+              f"exact p50 {r['exact_prefilter']['p50_ms']} ms")
+
+    conn.autocommit = True
+    for name in created:
+        drop_index(conn, name, concurrently=False)
+    conn.autocommit = False
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000", help="Comma separated table sizes, ascending")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--ef-search", default="20,40,100")
+    parser.add_argument("--lists", type=int, default=0, help="0 = derive from table size")
+    parser.add_argument("--probes", default="", help="Comma separated; default 1, sqrt(lists), 2*sqrt(lists)")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--types", default="Swim,Yoga,Run", help="Activity types for the type-scoped benchmark, empty to skip")
+    parser.add_argument("--min-rows", type=int, default=PARTIAL_INDEX_MIN_ROWS,
+                        help="Partial index threshold for the type-scoped benchmark (defaults to the shipped one)")
+    parser.add_argument("--max-share", type=float, default=PARTIAL_INDEX_MAX_SHARE,
+                        help="Partial index threshold for the type-scoped benchmark (defaults to the shipped one)")
+    parser.add_argument("--quantizations", default="halfvec,bit", help="Quantized indexes to compare, empty to skip")
+    parser.add_argument("--rerank", default="20,50,100,200", help="Coarse candidates re-ranked by exact distance")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    queries = make_queries(args.queries)
+    conn = connect()
+    create_bench_table(conn, BENCH_TABLE, drop=True)
+    space = EmbeddingSpace()
+
+    results = {"method": args.method, "k": args.k, "queries": args.queries, "sizes": []}
+    loaded = 0
+    for size in sorted(sizes):
+        print(f"📦 Growing {BENCH_TABLE} to {size} rows ...")
+        loaded += load_rows(conn, BENCH_TABLE, synthetic_activities(size - loaded, start_id=loaded + 1,
+                                                                    seed=size, space=space))
+        exact, exact_latencies = run_queries(conn, BENCH_TABLE, queries, args.k, exact=True)
+        entry = {"rows": size, "exact": summarize(exact_latencies), "runs": []}
+
+        conn.autocommit = True
+        name = index_name(BENCH_TABLE, args.method, "none")
+        drop_index(conn, name, concurrently=False)
+        lists = args.lists or default_lists(size)
+        start = time.perf_counter()
+        create_index(conn, args.method, BENCH_TABLE, m=args.m, ef_construction=args.ef_construction,
+                     lists=lists, concurrently=False, quantization="none")
+        entry["build_s"] = round(time.perf_counter() - start, 2)
+        entry["index_bytes"] = next(i["size_bytes"] for i in list_indexes(conn, BENCH_TABLE) if i["name"] == name)
+        conn.autocommit = False
+
+        if args.method == "hnsw":
+            sweep = [{"hnsw.ef_search": int(v)} for v in args.ef_search.split(",")]
+        else:
+            entry["lists"] = lists
+            probes = [int(v) for v in args.probes.split(",")] if args.probes else \
+                sorted({1, default_probes(lists), 2 * default_probes(lists)})
+            sweep = [{"ivfflat.probes": p} for p in probes]
+
+        for settings in sweep:
+            approx, latencies = run_queries(conn, BENCH_TABLE, queries, args.k, settings=settings)
+            run = {"settings": settings, f"recall@{args.k}": recall_at_k(approx, exact, args.k)}
+            run.update(summarize(latencies))
+            entry["runs"].append(run)
+            print(f"   {settings}: recall {run[f'recall@{args.k}']}, p50 {run['p50_ms']} ms, p99 {run['p99_ms']} ms")
+        results["sizes"].append(entry)
+
+    if args.quantizations:
+        print(f"🗜️ Quantized indexes at {max(sizes)} rows ...")
+        largest = results["sizes"][-1]
+        baseline = {"index_bytes": largest["index_bytes"], "build_s": largest["build_s"], "runs": largest["runs"]}
+        try:
+            results["quantized"] = quantized_benchmark(
+                conn, queries, exact, args.k, args.quantizations.split(","), [int(v) for v in args.rerank.split(",")],
+                args.method, args.m, args.ef_construction, max(int(v) for v in args.ef_search.split(",")), baseline)
+        except ValueError as e:
+            print(f"⚠️ Skipping quantized indexes: {e}")
+
+    if args.types:
+        print(f"🔎 Type-scoped queries at {max(sizes)} rows ...")
+        results["type_scoped"] = type_scoped_benchmark(conn, args.method, args.types.split(","), args.queries,
+                                                       args.k, args.m, args.ef_construction, args.min_rows,
+                                                       args.max_share)
+
+    conn.close()
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
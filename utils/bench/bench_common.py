@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+
+# Make the backend modules importable from the benchmark scripts
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies_ms, wall_s=None):
+    """Latency summary used by every benchmark."""
+    summary = {
+        "count": len(latencies_ms),
+        "p50_ms": round(percentile(latencies_ms, 50), 2),
+        "p90_ms": round(percentile(latencies_ms, 90), 2),
+        "p99_ms": round(percentile(latencies_ms, 99), 2),
+        "max_ms": round(max(latencies_ms), 2) if latencies_ms else 0.0,
+    }
+    if wall_s:
+        summary["throughput_per_s"] = round(len(latencies_ms) / wall_s, 2)
+    return summary
+
+
+def write_results(results, path=None):
+    """Print results and optionally write them as JSON for later comparison."""
+    print(json.dumps(results, indent=2, default=str))
+    if path:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"✅ Results written to {path}")
@@ -0,0 +1,105 @@
+"""
+Embedding throughput per backend, agreement between them, and the effect of the embedding cache.
+
+    python utils/strava/embedder.py export-onnx        # once, for the onnx backend
+    python utils/bench/embed_bench.py --activities 5000 --backends torch,onnx --output embed.json
+
+For each backend: model load time and texts/sec encoding synthetic activity texts, then
+texts/sec through the cache (first pass fills it, second pass is all hits). With two
+backends, per-text cosine similarity between their vectors and the overlap of each text's
+--k nearest neighbours measure how interchangeable they are.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench_common import write_results
+from synthetic import synthetic_strava_activity
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "strava"))
+import embedder
+from store_activities import activity_text
+
+
+def neighbours(vectors, queries, k):
+    """Indices of the k nearest (cosine) vectors to each query row, excluding itself."""
+    scores = vectors[queries] @ vectors.T
+    scores[np.arange(len(queries)), queries] = -np.inf
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def run_backend(name, texts, batch_size):
+    start = time.perf_counter()
+    backend = embedder.BACKENDS[name]()
+    load_s = time.perf_counter() - start
+    backend.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+
+    start = time.perf_counter()
+    vectors = backend.encode(texts, batch_size=batch_size)
+    encode_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cached = embedder.Embedder(name, cache_path=os.path.join(workdir, "cache.sqlite3"))
+        cached._backend = backend
+        start = time.perf_counter()
+        cached.embed(texts, batch_size=batch_size)
+        fill_s = time.perf_counter() - start
+        start = time.perf_counter()
+        cached.embed(texts, batch_size=batch_size)
+        hit_s = time.perf_counter() - start
+        cached.cache.conn.close()
+
+    return vectors, {
+        "load_s": round(load_s, 2),
+        "encode_s": round(encode_s, 2),
+        "texts_per_s": round(len(texts) / encode_s, 1),
+        "cache_fill_texts_per_s": round(len(texts) / fill_s, 1),
+        "cache_hit_texts_per_s": round(len(texts) / hit_s, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--activities", type=int, default=2000)
+    parser.add_argument("--backends", default="torch,onnx")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="Texts whose neighbours are compared")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [activity_text(synthetic_strava_activity(i + 1, rng=rng)) for i in range(args.activities)]
+    results = {"activities": len(texts), "unique_texts": len(set(texts)), "backends": {}}
+    vectors = {}
+    for name in args.backends.split(","):
+        vectors[name], results["backends"][name] = run_backend(name, texts, args.batch_size)
+        print(f"{name}: {results['backends'][name]}")
+
+    names = list(vectors)
+    if len(names) >= 2:
+        a, b = vectors[names[0]], vectors[names[1]]
+        cosine = np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+        queries = np.random.default_rng(args.seed).choice(len(texts), size=min(args.queries, len(texts)),
+                                                          replace=False)
+        left, right = neighbours(a, queries, args.k), neighbours(b, queries, args.k)
+        overlap = [len(set(x) & set(y)) / args.k for x, y in zip(left, right)]
+        results["agreement"] = {
+            "backends": names[:2],
+            "cosine_mean": round(float(cosine.mean()), 5),
+            "cosine_min": round(float(cosine.min()), 5),
+            "cosine_p1": round(float(np.percentile(cosine, 1)), 5),
+            f"neighbour_overlap_at_{args.k}": round(float(np.mean(overlap)), 4),
+        }
+        print(f"agreement: {results['agreement']}")
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Local stand-in for Ollama's /api/generate with configurable latency and scripted SQL replies.
+
+    python utils/bench/fake_ollama.py --port 11435 --load-ms 0 --prompt-ms 300 --tokens-per-second 15
+
+Point the backend at it with OLLAMA_URL=http://localhost:11435/api/generate.
+Replies come from --replies (a JSON object mapping a substring of the question to SQL);
+questions matching nothing get DEFAULT_SQL.
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+from flask import Flask, Response, jsonify, request
+
+DEFAULT_SQL = """SELECT activity_id, activity_type, distance, duration, timestamp
+FROM activities
+ORDER BY timestamp DESC
+LIMIT 5;"""
+INVALID_SQL = """SELECT activity_id, activity_type, distance, duration, timestamp
+FROM activity
+ORDER BY timestamp DESC
+LIMIT 5;"""
+
+app = Flask(__name__)
+config = {"load_ms": 0.0, "prompt_ms": 300.0, "tokens_per_second": 15.0, "replies": {}, "loaded": False,
+          "invalid_rate": 0.0}
+
+
+def pick_reply(prompt):
+    """Scripted SQL for the question embedded at the end of the prompt."""
+    match = re.findall(r"User Question:\s*(.*)", prompt)
+    question = (match[-1] if match else prompt).strip().lower()
+    for needle, sql in config["replies"].items():
+        if needle.lower() in question:
+            return sql
+    return DEFAULT_SQL
+
+
+def tokenize(text):
+    """Split a reply into token-sized chunks (roughly what an LLM would stream)."""
+    return re.findall(r"\s*\S{1,4}", text) or [text]
+
+
+@app.route("/api/generate", methods=["POST"])
+def generate():
+    data = request.get_json()
+    prompt = data.get("prompt", "")
+    reply = pick_reply(prompt)
+    seed = (data.get("options") or {}).get("seed")
+    rng = random.Random(f"{seed}:{prompt}") if seed is not None else random
+    if config["invalid_rate"] and rng.random() < config["invalid_rate"]:
+        reply = INVALID_SQL
+    tokens = tokenize(reply) if prompt else []
+    load_ms = 0.0 if config["loaded"] else config["load_ms"]
+    config["loaded"] = True
+    prompt_tokens = len(prompt) // 4
+    token_delay = 1.0 / config["tokens_per_second"] if config["tokens_per_second"] > 0 else 0.0
+
+    def stats(start):
+        eval_duration = int(len(tokens) * token_delay * 1e9)
+        return {
+            "model": data.get("model", "mistral"),
+            "done": True,
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "load_duration": int(load_ms * 1e6),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(config["prompt_ms"] * 1e6),
+            "eval_count": len(tokens),
+            "eval_duration": eval_duration,
+        }
+
+    start = time.perf_counter()
+    time.sleep((load_ms + config["prompt_ms"]) / 1000)
+
+    if not data.get("stream", True):
+        time.sleep(len(tokens) * token_delay)
+        return jsonify({**stats(start), "response": "".join(tokens)})
+
+    def stream():
+        for token in tokens:
+            time.sleep(token_delay)
+            yield json.dumps({"model": data.get("model", "mistral"), "response": token, "done": False}) + "\n"
+        yield json.dumps({**stats(start), "response": ""}) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--load-ms", type=float, default=0.0, help="One-off model load delay on the first request")
+    parser.add_argument("--prompt-ms", type=float, default=300.0, help="Prompt evaluation delay per request")
+    parser.add_argument("--tokens-per-second", type=float, default=15.0)
+    parser.add_argument("--replies", help="JSON file mapping question substrings to SQL")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Share of replies with SQL that fails")
+    args = parser.parse_args()
+
+    config.update(load_ms=args.load_ms, prompt_ms=args.prompt_ms, tokens_per_second=args.tokens_per_second,
+                  invalid_rate=args.invalid_rate)
+    if args.replies:
+        with open(args.replies, "r") as f:
+            config["replies"] = json.load(f)
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
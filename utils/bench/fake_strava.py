@@ -0,0 +1,132 @@
+"""
+Local stand-in for the Strava API serving a synthetic, paginated activity history.
+
+    python utils/bench/fake_strava.py --port 8090 --activities 5000 --latency-ms 50
+
+Point the sync at it with STRAVA_API_URL=http://localhost:8090/api/v3.
+Supports per_page/page/after on /athlete/activities, /activities/<id>, token refresh, and sends
+X-RateLimit-Limit / X-RateLimit-Usage headers (429 once --rate-limit is exceeded).
+Access tokens of the form "athlete-<n>" get their own history (ids offset by n * 10^7),
+so multi-athlete syncs can be tested; any other token gets the default history.
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify, request
+
+from synthetic import synthetic_strava_activity
+
+app = Flask(__name__)
+config = {"latency_ms": 0.0, "rate_limit": 0, "daily_limit": 0, "error_rate": 0.0, "activities": 1000, "seed": 7}
+state = {"activities": [], "athletes": {}, "requests": 0, "window_start": time.time(), "window_requests": 0, "day_requests": 0}
+lock = threading.Lock()
+
+
+def build_history(count, seed=7, athlete=0):
+    """Synthetic activities, oldest first, spread over the last ~10 years."""
+    rng = random.Random(seed + athlete)
+    start = datetime.utcnow() - timedelta(days=3650)
+    step = timedelta(days=3650) / max(count, 1)
+    history = [synthetic_strava_activity(athlete * 10**7 + i + 1, rng=rng, when=start + step * i) for i in range(count)]
+    for activity in history:
+        activity["athlete"] = {"id": athlete or 1000}
+    return history
+
+
+def history_for(token):
+    """The activity history behind an access token."""
+    if not token.startswith("athlete-") or not token[8:].isdigit():
+        return state["activities"]
+    athlete = int(token[8:])
+    with lock:
+        if athlete not in state["athletes"]:
+            state["athletes"][athlete] = build_history(config["activities"], config["seed"], athlete)
+        return state["athletes"][athlete]
+
+
+def rate_limited():
+    """Apply the 15-minute/daily request budget; returns (headers, exceeded)."""
+    with lock:
+        now = time.time()
+        if now - state["window_start"] > 900:
+            state["window_start"], state["window_requests"] = now, 0
+        state["window_requests"] += 1
+        state["day_requests"] += 1
+        state["requests"] += 1
+        headers = {  # "unlimited" is advertised as a very large budget
+            "X-RateLimit-Limit": f"{config['rate_limit'] or 10**6},{config['daily_limit'] or 10**7}",
+            "X-RateLimit-Usage": f"{state['window_requests']},{state['day_requests']}",
+        }
+        exceeded = (config["rate_limit"] and state["window_requests"] > config["rate_limit"]) or \
+                   (config["daily_limit"] and state["day_requests"] > config["daily_limit"])
+    return headers, exceeded
+
+
+@app.route("/api/v3/oauth/token", methods=["POST"])
+def token():
+    refresh_token = request.form.get("refresh_token", "")
+    return jsonify({
+        "token_type": "Bearer",
+        "access_token": refresh_token if refresh_token.startswith("athlete-") else f"fake-access-{int(time.time())}",
+        "refresh_token": refresh_token or "fake-refresh",
+        "expires_at": int(time.time()) + 21600,
+        "expires_in": 21600,
+    })
+
+
+@app.route("/api/v3/athlete/activities", methods=["GET"])
+def athlete_activities():
+    headers, exceeded = rate_limited()
+    time.sleep(config["latency_ms"] / 1000)
+    if exceeded:
+        return jsonify({"message": "Rate Limit Exceeded"}), 429, headers
+    if config["error_rate"] and random.random() < config["error_rate"]:
+        return jsonify({"message": "Server Error"}), 503, headers
+
+    per_page = min(int(request.args.get("per_page", 30)), 200)
+    page = max(int(request.args.get("page", 1)), 1)
+    after = request.args.get("after")
+    activities = history_for(request.headers.get("Authorization", "").replace("Bearer ", "", 1))
+    if after is not None:
+        cutoff = datetime.utcfromtimestamp(int(after)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        selected = [a for a in activities if a["start_date"] > cutoff]  # ascending, like Strava
+    else:
+        selected = activities[::-1]  # newest first
+    return jsonify(selected[(page - 1) * per_page: page * per_page]), 200, headers
+
+
+@app.route("/api/v3/activities/<int:activity_id>", methods=["GET"])
+def activity(activity_id):
+    headers, exceeded = rate_limited()
+    time.sleep(config["latency_ms"] / 1000)
+    if exceeded:
+        return jsonify({"message": "Rate Limit Exceeded"}), 429, headers
+    activities = history_for(request.headers.get("Authorization", "").replace("Bearer ", "", 1))
+    index = activity_id % 10**7 - 1  # histories are ordered by id
+    if not 0 <= index < len(activities) or activities[index]["id"] != activity_id:
+        return jsonify({"message": "Record Not Found"}), 404, headers
+    return jsonify(activities[index]), 200, headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--activities", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per 15 minutes, 0 = unlimited")
+    parser.add_argument("--daily-limit", type=int, default=0, help="Requests per day, 0 = unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 503")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    config.update(latency_ms=args.latency_ms, rate_limit=args.rate_limit, daily_limit=args.daily_limit,
+                  error_rate=args.error_rate, activities=args.activities, seed=args.seed)
+    state["activities"] = build_history(args.activities, seed=args.seed)
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
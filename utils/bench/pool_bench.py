@@ -0,0 +1,80 @@
+"""
+Compare per-query connections against the backend connection pool.
+
+    python utils/bench/pool_bench.py --clients 16 --queries 2000
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_common import summarize, write_results
+
+import psycopg2
+from db_pool import ConnectionPool
+from sql_generator import connect_db
+
+DEFAULT_SQL = "SELECT activity_id, activity_type, distance, duration, timestamp FROM activities ORDER BY distance DESC LIMIT 1"
+
+
+def run_connect_per_query(sql, queries, clients):
+    """The old behaviour: open and close a connection for every query."""
+    def one(_):
+        start = time.perf_counter()
+        conn = connect_db()
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(one, range(queries)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_pooled(sql, queries, clients, max_size):
+    pool = ConnectionPool(min_size=min(clients, max_size), max_size=max_size)
+
+    def one(_):
+        start = time.perf_counter()
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+                cursor.fetchall()
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(one, range(queries)))
+    summary = summarize(latencies, time.perf_counter() - start)
+    summary["pool"] = pool.stats()
+    pool.close()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--sql", default=DEFAULT_SQL)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    try:
+        results = {
+            "clients": args.clients,
+            "queries": args.queries,
+            "before_connect_per_query": run_connect_per_query(args.sql, args.queries, args.clients),
+            "after_pooled": run_pooled(args.sql, args.queries, args.clients, args.pool_size),
+        }
+    except psycopg2.Error as e:
+        print(f"❌ Benchmark failed: {e}")
+        return
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Prompt size and Ollama latency for static vs retrieval-selected few-shot prompts.
+
+    python utils/bench/prompt_bench.py --k 1,2,3 --repeat 2
+    OLLAMA_URL=http://localhost:11435/api/generate python utils/bench/prompt_bench.py   # fake Ollama
+
+"static" is the old behaviour (the first --static-k library examples in every prompt).
+Ollama reports prompt_eval_count/prompt_eval_duration per request; when the static prefix
+is reused from the previous request only the new tail is evaluated, which shows up as a
+lower prompt_eval_count than the prompt's total size.
+"""
+import argparse
+import time
+
+import requests
+
+from bench_common import summarize, write_results
+from run_bench import DEFAULT_QUESTIONS
+
+from ollama_client import MODEL_NAME, OLLAMA_KEEP_ALIVE, OLLAMA_URL
+from sql_generator import build_prompt
+
+
+def run_config(questions, k, retrieve, repeat):
+    latencies, prompt_tokens, prompt_eval_ms, prompt_chars = [], [], [], []
+    for _ in range(repeat):
+        for question in questions:
+            prompt = build_prompt(question, k=k, retrieve=retrieve)
+            start = time.perf_counter()
+            response = requests.post(OLLAMA_URL, json={"model": MODEL_NAME, "prompt": prompt, "stream": False,
+                                                       "keep_alive": OLLAMA_KEEP_ALIVE})
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+            data = response.json()
+            prompt_chars.append(len(prompt))
+            prompt_tokens.append(data.get("prompt_eval_count") or 0)
+            prompt_eval_ms.append((data.get("prompt_eval_duration") or 0) / 1e6)
+    summary = summarize(latencies)
+    summary["avg_prompt_chars"] = round(sum(prompt_chars) / len(prompt_chars), 1)
+    summary["avg_prompt_eval_tokens"] = round(sum(prompt_tokens) / len(prompt_tokens), 1)
+    summary["avg_prompt_eval_ms"] = round(sum(prompt_eval_ms) / len(prompt_eval_ms), 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", default="1,2,3", help="Comma separated example counts for retrieval prompts")
+    parser.add_argument("--static-k", type=int, default=4, help="Examples in the static (before) prompt")
+    parser.add_argument("--questions", help="'|'-separated questions")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    questions = args.questions.split("|") if args.questions else DEFAULT_QUESTIONS
+    # one throwaway request so model load time isn't charged to the first configuration
+    requests.post(OLLAMA_URL, json={"model": MODEL_NAME, "prompt": "SELECT 1;", "stream": False,
+                                    "keep_alive": OLLAMA_KEEP_ALIVE}).raise_for_status()
+
+    results = {"model": MODEL_NAME, "questions": len(questions), "repeat": args.repeat, "runs": []}
+    configs = [("static", args.static_k, False)] + [("retrieval", int(k), True) for k in args.k.split(",")]
+    for name, k, retrieve in configs:
+        summary = run_config(questions, k, retrieve, args.repeat)
+        results["runs"].append({"prompt": name, "k": k, **summary})
+        print(f"   {name} k={k}: {summary['avg_prompt_chars']} chars, {summary['avg_prompt_eval_tokens']} "
+              f"prompt tokens evaluated in {summary['avg_prompt_eval_ms']} ms, p50 {summary['p50_ms']} ms")
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
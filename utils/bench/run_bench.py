@@ -0,0 +1,428 @@
+"""
+Repeatable end-to-end scenarios against local fakes of Ollama and Strava.
+
+    python utils/bench/run_bench.py populate --rows 100000
+    python utils/bench/run_bench.py ingest --activities 2000 --strava-latency-ms 50
+    python utils/bench/run_bench.py ingest --activities 500 --users 50 --strava-error-rate 0.05
+    python utils/bench/run_bench.py query --clients 8 --requests 200 --tokens-per-second 15
+    python utils/bench/run_bench.py similarity --sizes 10000,100000,1000000
+    python utils/bench/run_bench.py webhook --events 200 --burst 50 --strava-latency-ms 50
+    python utils/bench/run_bench.py populate --rows 1000000 --users 300 && \
+        python utils/bench/run_bench.py tenants --queries 200 --compare-unscoped
+
+Every scenario writes one JSON document (scenario, params, timestamp, git commit, results)
+so runs before and after a change can be compared. Point POSTGRES_DB at a scratch database:
+`populate`, `ingest` and `webhook` write to its `activities` table.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from bench_common import summarize, write_results
+from synthetic import EmbeddingSpace, load_rows, synthetic_activities
+
+from db_pool import connect
+from intent_router import TEMPLATES
+from tenancy import scope_sql
+from vector_index import apply_search_settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "strava"))
+import rollups
+
+BUMP_GENERATION_SQL = """
+    INSERT INTO data_generation (id, generation, updated_at) VALUES (TRUE, 1, now())
+    ON CONFLICT (id) DO UPDATE SET generation = data_generation.generation + 1, updated_at = now()
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.normpath(os.path.join(BENCH_DIR, "..", ".."))
+BENCH_USER_ID = "bench"
+
+DEFAULT_QUESTIONS = [
+    "What was my longest run?",
+    "What was my longest ride this year?",
+    "Which month was I most active?",
+    "Show runs similar to my last run",
+    "How many kilometers did I swim last month?",
+    "What was my fastest 5k?",
+    "Average ride distance per week in 2023",
+    "When did I last go for a hike?",
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def start_server(script, port, *args, **popen_kwargs):
+    """Start a fake (or repo) server on localhost and wait until it accepts connections."""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, script), "--port", str(port), *args],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **popen_kwargs)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{script} did not start on port {port}")
+
+
+def bench_user(synthetic_user, users):
+    """User id for a synthetic row: "bench", or "bench-<n>" when several athletes are generated."""
+    return BENCH_USER_ID if users == 1 else f"{BENCH_USER_ID}-{synthetic_user}"
+
+
+def populate(args):
+    """Fill `activities` with synthetic rows for the bench athletes (replacing earlier ones)."""
+    conn = connect()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM activities WHERE user_id = %s OR user_id LIKE %s",
+                    (BENCH_USER_ID, f"{BENCH_USER_ID}-%"))
+    conn.commit()
+    start = time.perf_counter()
+    rows = load_rows(conn, "activities", (
+        [(activity_id + args.id_offset, bench_user(user_id, args.users), *rest) for activity_id, user_id, *rest in batch]
+        for batch in synthetic_activities(args.rows, users=args.users, seed=args.seed)
+    ))
+    elapsed = time.perf_counter() - start
+    with conn.cursor() as cur:
+        rollups.rebuild(cur)
+        cur.execute(BUMP_GENERATION_SQL)  # like an ingest, so backend result caches are invalidated
+    conn.commit()
+    conn.close()
+    return {"rows": rows, "seconds": round(elapsed, 2), "rows_per_s": round(rows / elapsed, 1) if elapsed else None}
+
+
+def ingest(args):
+    """
+    Sync synthetic histories from the fake Strava API through run_all.py (fetch, embed, store);
+    with --users N, N athletes are synced concurrently (`run_all.py --athletes`).
+    """
+    users = [BENCH_USER_ID] if args.users == 1 else [bench_user(n + 1, args.users) for n in range(args.users)]
+    conn = connect()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM activities WHERE user_id = ANY(%s)", (users,))
+    conn.commit()
+
+    strava = start_server("fake_strava.py", args.strava_port, "--activities", str(args.activities),
+                          "--latency-ms", str(args.strava_latency_ms), "--rate-limit", str(args.strava_rate_limit),
+                          "--error-rate", str(args.strava_error_rate))
+    try:
+        with tempfile.TemporaryDirectory() as workdir:  # token files, sync state and spool live here
+            tokens = {"refresh_token": "bench", "expires_at": time.time() + 86400, "expires_in": 86400,
+                      "token_type": "Bearer"}
+            with open(os.path.join(workdir, "token.json"), "w") as f:
+                json.dump(dict(tokens, access_token="bench"), f)
+            run_all_args = list(args.run_all_args)
+            if args.users > 1:
+                with open(os.path.join(workdir, "athletes.json"), "w") as f:
+                    json.dump({user_id: dict(tokens, access_token=f"athlete-{n + 1}", refresh_token=f"athlete-{n + 1}")
+                               for n, user_id in enumerate(users)}, f)
+                run_all_args.append("--athletes")
+            env = dict(os.environ, STRAVA_API_URL=f"http://127.0.0.1:{args.strava_port}/api/v3",
+                       STRAVA_USER_ID=BENCH_USER_ID, STRAVA_ATHLETES_FILE="athletes.json")
+            command = [sys.executable, os.path.join(REPO_ROOT, "utils", "strava", "run_all.py"), *run_all_args]
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+    finally:
+        strava.terminate()
+        strava.wait()
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM activities WHERE user_id = ANY(%s)", (users,))
+        stored = cur.fetchone()[0]
+    conn.close()
+    if result.returncode != 0:
+        print(result.stdout[-2000:], result.stderr[-2000:])
+    return {
+        "returncode": result.returncode,
+        "athletes": len(users),
+        "activities_served": args.activities * len(users),
+        "activities_stored": stored,
+        "seconds": round(elapsed, 2),
+        "activities_per_s": round(stored / elapsed, 1) if elapsed else None,
+    }
+
+
+def webhook(args):
+    """
+    Post bursts of create events to server/webhook_server.py (backed by the fake Strava API)
+    and time how long each activity takes to become visible in `activities`.
+    """
+    conn = connect()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM activities WHERE user_id = %s", (BENCH_USER_ID,))
+
+    strava = start_server("fake_strava.py", args.strava_port, "--activities", str(args.activities),
+                          "--latency-ms", str(args.strava_latency_ms))
+    ack_ms, visible_ms = [], []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:  # token file and event queue live here
+            with open(os.path.join(workdir, "token.json"), "w") as f:
+                json.dump({"access_token": "bench", "refresh_token": "bench", "expires_at": time.time() + 86400,
+                           "expires_in": 86400, "token_type": "Bearer"}, f)
+            env = dict(os.environ, STRAVA_API_URL=f"http://127.0.0.1:{args.strava_port}/api/v3",
+                       STRAVA_USER_ID=BENCH_USER_ID, STRAVA_ATHLETES_FILE="athletes.json",
+                       WEBHOOK_QUEUE_PATH=os.path.join(workdir, "events.sqlite3"), STRAVA_SUBSCRIPTION_ID="")
+            server = start_server(os.path.join(REPO_ROOT, "server", "webhook_server.py"), args.webhook_port,
+                                  cwd=workdir, env=env)
+            try:
+                posted = {}
+                activity_ids = list(range(1, min(args.events, args.activities) + 1))
+                start = time.perf_counter()
+                for i in range(0, len(activity_ids), args.burst):
+                    for activity_id in activity_ids[i:i + args.burst]:
+                        t0 = time.perf_counter()
+                        requests.post(f"http://127.0.0.1:{args.webhook_port}/webhook", timeout=10, json={
+                            "object_type": "activity", "object_id": activity_id, "aspect_type": "create",
+                            "owner_id": 1000, "subscription_id": 1, "event_time": int(time.time()), "updates": {},
+                        }).raise_for_status()
+                        posted[activity_id] = time.perf_counter()
+                        ack_ms.append((posted[activity_id] - t0) * 1000)
+                    time.sleep(args.burst_interval)
+
+                deadline = time.perf_counter() + args.webhook_timeout
+                pending = set(activity_ids)
+                while pending and time.perf_counter() < deadline:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT activity_id FROM activities WHERE activity_id = ANY(%s) AND user_id = %s",
+                                    (list(pending), BENCH_USER_ID))
+                        seen = {row[0] for row in cur.fetchall()}
+                    now = time.perf_counter()
+                    visible_ms.extend((now - posted[activity_id]) * 1000 for activity_id in seen)
+                    pending -= seen
+                    time.sleep(0.1)
+                elapsed = time.perf_counter() - start
+                stats = requests.get(f"http://127.0.0.1:{args.webhook_port}/webhook/stats", timeout=10).json()
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        strava.terminate()
+        strava.wait()
+    conn.close()
+    return {
+        "events": len(activity_ids),
+        "visible": len(visible_ms),
+        "seconds": round(elapsed, 2),
+        "ack": summarize(ack_ms),
+        "event_to_visible": summarize(visible_ms),
+        "worker": stats,
+    }
+
+
+def query(args):
+    """`/query` latency with N concurrent clients against a fake Ollama."""
+    ollama_args = ["--prompt-ms", str(args.prompt_ms), "--tokens-per-second", str(args.tokens_per_second)]
+    if args.replies:
+        ollama_args += ["--replies", args.replies]
+    if args.invalid_rate:
+        ollama_args += ["--invalid-rate", str(args.invalid_rate)]
+    ollama = start_server("fake_ollama.py", args.ollama_port, *ollama_args)
+    # The backend reads OLLAMA_URL at import time, so set it before importing the app
+    os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{args.ollama_port}/api/generate"
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server("127.0.0.1", args.backend_port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{args.backend_port}/query"
+    questions = args.questions.split("|") if args.questions else DEFAULT_QUESTIONS
+
+    def one(i):
+        start = time.perf_counter()
+        response = requests.post(url, json={"question": questions[i % len(questions)]}, timeout=300)
+        elapsed = (time.perf_counter() - start) * 1000
+        source = response.json().get("source") if response.ok else None
+        return elapsed, response.status_code, source
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            outcomes = list(executor.map(one, range(args.requests)))
+        wall = time.perf_counter() - start
+        stats = requests.get(f"http://127.0.0.1:{args.backend_port}/stats", timeout=10).json()
+    finally:
+        server.shutdown()
+        ollama.terminate()
+        ollama.wait()
+
+    results = summarize([latency for latency, _, _ in outcomes], wall)
+    results["errors"] = sum(1 for _, status, _ in outcomes if status != 200)
+    results["sources"] = {}
+    for _, _, source in outcomes:
+        if source:
+            results["sources"][source] = results["sources"].get(source, 0) + 1
+    results["stats"] = stats
+    return results
+
+
+def similarity(args):
+    """Latency of the backend's similarity query shape as the table grows (uses ann_bench's scratch table)."""
+    from ann_bench import BENCH_TABLE, make_queries, run_queries
+    from synthetic import create_bench_table
+    from vector_index import create_index, index_name, drop_index, search_settings
+
+    conn = connect()
+    create_bench_table(conn, BENCH_TABLE, drop=True)
+    queries = make_queries(args.queries)
+    space = EmbeddingSpace()
+    results, loaded = [], 0
+    for size in sorted(int(s) for s in args.sizes.split(",")):
+        loaded += load_rows(conn, BENCH_TABLE, synthetic_activities(size - loaded, start_id=loaded + 1,
+                                                                    seed=size, space=space))
+        _, exact = run_queries(conn, BENCH_TABLE, queries, args.k, exact=True)
+        conn.autocommit = True
+        drop_index(conn, index_name(BENCH_TABLE, quantization="none"), concurrently=False)
+        create_index(conn, table=BENCH_TABLE, concurrently=False, quantization="none")
+        conn.autocommit = False
+        _, indexed = run_queries(conn, BENCH_TABLE, queries, args.k, settings=search_settings(quantization="none"))
+        results.append({"rows": size, "seq_scan": summarize(exact), "index": summarize(indexed)})
+        print(f"   {size} rows: seq scan p50 {results[-1]['seq_scan']['p50_ms']} ms, "
+              f"index p50 {results[-1]['index']['p50_ms']} ms")
+    conn.close()
+    return results
+
+
+# Query shapes the backend produces most often (templates), run per athlete in the tenants scenario
+TENANT_QUERIES = {
+    "longest_run": TEMPLATES["superlative"].format(where="activity_type = 'Run'", order="distance DESC", limit=1),
+    "recent": TEMPLATES["superlative"].format(where="TRUE", order="timestamp DESC", limit=10),
+    "most_active_month": TEMPLATES["active_period"].format(period="month", where="period = 'month'",
+                                                           direction="DESC", limit=1),
+    "similar_to_last_run": TEMPLATES["similar_to_last"].format(activity_type="Run", limit=5),
+}
+
+
+def plan_indexes(cur, sql):
+    """Index names used by a query's plan."""
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql)
+    found, nodes = set(), [cur.fetchone()[0][0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            found.add(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+    return sorted(found)
+
+
+def tenants(args):
+    """Per-athlete latency of the common query shapes, scoped with user_id (see `populate --users`)."""
+    conn = connect()
+    apply_search_settings(conn)
+    conn.commit()
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT user_id FROM activities WHERE user_id LIKE %s", (f"{BENCH_USER_ID}-%",))
+        users = sorted(row[0] for row in cur.fetchall())
+        cur.execute("SELECT COUNT(*) FROM activities")
+        total_rows = cur.fetchone()[0]
+    if not users:
+        raise RuntimeError("No bench athletes found, run `populate --users N` first")
+
+    rng = random.Random(args.seed)
+    results = {"athletes": len(users), "total_rows": total_rows, "queries": {}}
+    with conn.cursor() as cur:
+        for name, sql in TENANT_QUERIES.items():
+            latencies, unscoped = [], []
+            for _ in range(args.queries):
+                scoped = scope_sql(sql, rng.choice(users))
+                start = time.perf_counter()
+                cur.execute(scoped)
+                cur.fetchall()
+                latencies.append((time.perf_counter() - start) * 1000)
+                if args.compare_unscoped:
+                    start = time.perf_counter()
+                    cur.execute(sql)
+                    cur.fetchall()
+                    unscoped.append((time.perf_counter() - start) * 1000)
+            entry = {"scoped": summarize(latencies), "indexes": plan_indexes(cur, scope_sql(sql, users[0]))}
+            if unscoped:
+                entry["unscoped"] = summarize(unscoped)
+            results["queries"][name] = entry
+            print(f"   {name}: p50 {entry['scoped']['p50_ms']} ms, p99 {entry['scoped']['p99_ms']} ms "
+                  f"using {', '.join(entry['indexes']) or 'no index'}")
+    conn.rollback()
+    conn.close()
+    return results
+
+
+SCENARIOS = {"populate": populate, "ingest": ingest, "webhook": webhook, "query": query, "similarity": similarity,
+             "tenants": tenants}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=list(SCENARIOS))
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    # populate
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--id-offset", type=int, default=10**12, help="Keeps synthetic ids clear of real Strava ids")
+    parser.add_argument("--users", type=int, default=1, help="Synthetic athletes to spread the rows over")
+    # tenants
+    parser.add_argument("--compare-unscoped", action="store_true",
+                        help="Also time each query without the user filter (all athletes)")
+    # ingest
+    parser.add_argument("--activities", type=int, default=1000)
+    parser.add_argument("--strava-latency-ms", type=float, default=0.0)
+    parser.add_argument("--strava-port", type=int, default=8090)
+    parser.add_argument("--strava-rate-limit", type=int, default=0, help="Fake 15-minute request limit, 0 = none")
+    parser.add_argument("--strava-error-rate", type=float, default=0.0, help="Share of fake 503 responses")
+    parser.add_argument("--run-all-args", nargs=argparse.REMAINDER, default=[],
+                        help="Extra arguments for run_all.py (e.g. --subprocess)")
+    # webhook (also uses --activities and the --strava-* options)
+    parser.add_argument("--events", type=int, default=100, help="Create events to post")
+    parser.add_argument("--burst", type=int, default=25, help="Events posted back to back")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="Seconds between bursts")
+    parser.add_argument("--webhook-port", type=int, default=8091)
+    parser.add_argument("--webhook-timeout", type=float, default=120.0, help="Seconds to wait for activities to appear")
+    # query
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--questions", help="'|'-separated questions, cycled through by the clients")
+    parser.add_argument("--prompt-ms", type=float, default=300.0)
+    parser.add_argument("--tokens-per-second", type=float, default=15.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0,
+                        help="Share of fake Ollama replies with failing SQL (compare SQL_CANDIDATES=1 vs 3)")
+    parser.add_argument("--replies", help="JSON file of scripted fake-Ollama replies")
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--backend-port", type=int, default=5055)
+    # similarity
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("scenario", "output")}
+    results = SCENARIOS[args.scenario](args)
+    write_results({
+        "scenario": args.scenario,
+        "params": params,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "results": results,
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
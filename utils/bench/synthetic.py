@@ -0,0 +1,140 @@
+import io
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+from psycopg2 import sql
+
+
+EMBEDDING_DIM = 384
+
+# Rough mix of a typical Strava history; Swim and Yoga are the highly selective types
+ACTIVITY_TYPE_WEIGHTS = {
+    "Run": 0.45, "Ride": 0.30, "Walk": 0.10, "Hike": 0.05, "Workout": 0.06, "Swim": 0.02, "Yoga": 0.02,
+}
+
+# Typical (distance m, duration s) per type
+ACTIVITY_TYPE_PROFILE = {
+    "Run": (8000, 2700), "Ride": (35000, 5400), "Walk": (4000, 3000), "Hike": (12000, 14400),
+    "Workout": (0, 3000), "Swim": (1500, 2400), "Yoga": (0, 3600),
+}
+
+BENCH_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id SERIAL PRIMARY KEY,
+        activity_id BIGINT UNIQUE,
+        user_id VARCHAR(50),
+        activity_type VARCHAR(50),
+        distance FLOAT,
+        duration INT,
+        timestamp TIMESTAMP,
+        embedding vector(384)
+    )
+"""
+
+
+class EmbeddingSpace:
+    """Clustered unit vectors per activity type, so ANN recall behaves like on real embeddings."""
+
+    def __init__(self, types=ACTIVITY_TYPE_WEIGHTS, clusters_per_type=8, noise=0.35, seed=42):
+        rng = np.random.default_rng(seed)
+        self.noise = noise
+        self.centers = {}
+        for activity_type in types:
+            base = rng.normal(size=EMBEDDING_DIM)
+            offsets = rng.normal(scale=0.5, size=(clusters_per_type, EMBEDDING_DIM))
+            self.centers[activity_type] = base + offsets
+
+    def sample(self, activity_types, rng):
+        """One embedding per activity type in `activity_types`, as a float32 matrix."""
+        out = np.empty((len(activity_types), EMBEDDING_DIM), dtype=np.float32)
+        for i, activity_type in enumerate(activity_types):
+            centers = self.centers[activity_type]
+            center = centers[rng.integers(len(centers))]
+            out[i] = center + rng.normal(scale=self.noise * np.linalg.norm(center) / np.sqrt(EMBEDDING_DIM),
+                                         size=EMBEDDING_DIM)
+        out /= np.linalg.norm(out, axis=1, keepdims=True)
+        return out
+
+
+def random_types(n, rng, weights=ACTIVITY_TYPE_WEIGHTS):
+    types = list(weights)
+    return list(rng.choice(types, size=n, p=np.array(list(weights.values())) / sum(weights.values())))
+
+
+def synthetic_activities(n, start_id=1, users=1, seed=0, space=None, batch_size=10_000):
+    """Yield batches of activity rows shaped like the `activities` table."""
+    rng = np.random.default_rng(seed)
+    space = space or EmbeddingSpace()
+    start = datetime(2015, 1, 1)
+    for offset in range(0, n, batch_size):
+        size = min(batch_size, n - offset)
+        types = random_types(size, rng)
+        embeddings = space.sample(types, rng)
+        rows = []
+        for i, activity_type in enumerate(types):
+            distance, duration = ACTIVITY_TYPE_PROFILE[activity_type]
+            rows.append((
+                start_id + offset + i,
+                str(1000 + int(rng.integers(users))),
+                activity_type,
+                float(max(0.0, rng.normal(distance, distance * 0.3))),
+                int(max(60, rng.normal(duration, duration * 0.3))),
+                start + timedelta(minutes=int(rng.integers(0, 60 * 24 * 365 * 10))),
+                embeddings[i],
+            ))
+        yield rows
+
+
+def synthetic_strava_activity(activity_id, rng=None, when=None):
+    """One activity as returned by Strava's /athlete/activities (the fields the ingest reads)."""
+    rng = rng or random.Random(activity_id)
+    when = when or datetime(2015, 1, 1) + timedelta(minutes=rng.randrange(60 * 24 * 365 * 10))
+    activity_type = rng.choices(list(ACTIVITY_TYPE_WEIGHTS), weights=list(ACTIVITY_TYPE_WEIGHTS.values()))[0]
+    distance, duration = ACTIVITY_TYPE_PROFILE[activity_type]
+    moving_time = int(max(60, rng.gauss(duration, duration * 0.3)))
+    return {
+        "id": activity_id,
+        "name": f"{'Morning' if when.hour < 12 else 'Evening'} {activity_type}",
+        "type": activity_type,
+        "sport_type": activity_type,
+        "distance": round(max(0.0, rng.gauss(distance, distance * 0.3)), 1),
+        "moving_time": moving_time,
+        "elapsed_time": moving_time + rng.randrange(0, 600),
+        "total_elevation_gain": round(rng.uniform(0, 400), 1),
+        "start_date": when.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "start_date_local": when.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "average_speed": round(distance / duration, 3) if duration else 0.0,
+        "athlete": {"id": 1000},
+    }
+
+
+def vector_literal(vector):
+    return "[" + ",".join(f"{x:.6f}" for x in vector) + "]"
+
+
+def create_bench_table(conn, table, drop=False):
+    with conn.cursor() as cur:
+        if drop:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+        cur.execute(sql.SQL(BENCH_TABLE_SQL).format(table=sql.Identifier(table)))
+    conn.commit()
+
+
+def load_rows(conn, table, batches):
+    """COPY batches of synthetic rows into a table; returns the number of rows loaded."""
+    total = 0
+    with conn.cursor() as cur:
+        for rows in batches:
+            buffer = io.StringIO()
+            for activity_id, user_id, activity_type, distance, duration, timestamp, embedding in rows:
+                buffer.write(f"{activity_id}\t{user_id}\t{activity_type}\t{distance}\t{duration}\t"
+                             f"{timestamp.isoformat()}\t{vector_literal(embedding)}\n")
+            buffer.seek(0)
+            cur.copy_expert(sql.SQL("COPY {} (activity_id, user_id, activity_type, distance, duration, "
+                                    "timestamp, embedding) FROM STDIN").format(sql.Identifier(table)).as_string(conn),
+                            buffer)
+            total += len(rows)
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    conn.commit()
+    return total
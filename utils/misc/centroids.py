@@ -0,0 +1,102 @@
+"""
+Per-athlete, per-type embedding centroids in `activity_type_centroids`.
+
+run_all.py refreshes them after every sync; plot_embeddings.py overlays them on its
+projections. Refresh by hand with:
+
+    python utils/misc/centroids.py
+"""
+import time
+
+import numpy as np
+import psycopg2
+
+from embedding_loader import connect, read_generation
+
+CENTROID_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS activity_type_centroids (
+        user_id VARCHAR(50),
+        activity_type VARCHAR(50),
+        centroid vector(384) NOT NULL,
+        activity_count INT NOT NULL,
+        generation BIGINT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+# pgvector's AVG(vector) computes the mean in one pass over the table
+REFRESH_CENTROIDS_SQL = """
+    INSERT INTO activity_type_centroids (user_id, activity_type, centroid, activity_count, generation)
+    SELECT user_id, activity_type, AVG(embedding), COUNT(*), %s
+    FROM activities
+    WHERE embedding IS NOT NULL
+    GROUP BY user_id, activity_type
+"""
+
+
+def refresh(cur):
+    """Recompute all centroids from `activities`; returns the number of (user, type) rows."""
+    generation = read_generation(cur)
+    cur.execute(CENTROID_TABLE_SQL)
+    cur.execute("DELETE FROM activity_type_centroids")
+    cur.execute(REFRESH_CENTROIDS_SQL, (generation,))
+    return cur.rowcount
+
+
+def load_centroids(cur, user_id=None):
+    """
+    Count-weighted centroid per activity type ({type: (vector, count)}), combined across athletes
+    unless `user_id` is given. None if the table is missing or older than the current data.
+    """
+    cur.execute("SELECT to_regclass('activity_type_centroids') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return None
+    generation = read_generation(cur)
+    cur.execute("SELECT MIN(generation) IS NOT DISTINCT FROM %s AND MAX(generation) IS NOT DISTINCT FROM %s "
+                "FROM activity_type_centroids", (generation, generation))
+    if not cur.fetchone()[0]:
+        return None
+    query = "SELECT activity_type, centroid::real[], activity_count FROM activity_type_centroids"
+    params = ()
+    if user_id is not None:
+        query += " WHERE user_id = %s"
+        params = (user_id,)
+    cur.execute(query, params)
+    sums, counts = {}, {}
+    for activity_type, centroid, count in cur.fetchall():
+        sums[activity_type] = sums.get(activity_type, 0) + np.asarray(centroid, dtype=np.float64) * count
+        counts[activity_type] = counts.get(activity_type, 0) + count
+    return {activity_type: ((sums[activity_type] / counts[activity_type]).astype(np.float32), counts[activity_type])
+            for activity_type in sums}
+
+
+def centroids_from_matrix(embeddings):
+    """The same centroids computed from a loaded Embeddings set ({type: (vector, count)})."""
+    counts = np.bincount(embeddings.type_codes, minlength=len(embeddings.type_names))
+    sums = np.zeros((len(embeddings.type_names), embeddings.matrix.shape[1]), dtype=np.float64)
+    batch = 50000  # bounded memory when the matrix is memory-mapped
+    for start in range(0, len(embeddings), batch):
+        codes = embeddings.type_codes[start:start + batch]
+        chunk = embeddings.matrix[start:start + batch]
+        for code in np.unique(codes):
+            sums[code] += chunk[codes == code].sum(axis=0, dtype=np.float64)
+    return {name: ((sums[code] / counts[code]).astype(np.float32), int(counts[code]))
+            for code, name in enumerate(embeddings.type_names) if counts[code]}
+
+
+def main():
+    conn = connect()
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            rows = refresh(cur)
+        conn.commit()
+        print(f"✅ Refreshed {rows} activity type centroids in {time.perf_counter() - start:.1f}s")
+    except psycopg2.Error as e:
+        print(f"❌ {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Load activity embeddings into a float32 NumPy matrix for analytics.
+
+    from embedding_loader import load_embeddings
+    embeddings = load_embeddings(activity_type="Run")
+    embeddings.matrix        # (rows, 384) float32, memory-mapped when it came from the cache
+    embeddings.ids, embeddings.activity_types
+
+Rows are streamed with binary COPY (or a server-side cursor) straight into a preallocated
+matrix, never through Python lists of floats. The matrix is cached as a memory-mapped .npy
+keyed by the data generation that store_activities.py bumps on every ingest, so repeated
+runs skip the database until the data changes.
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+# Load env vars
+load_dotenv()
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")  # empty = no cache
+EMBEDDING_LOAD_MODE = os.getenv("EMBEDDING_LOAD_MODE", "copy")  # "copy" (binary COPY) or "cursor"
+EMBEDDING_FETCH_SIZE = int(os.getenv("EMBEDDING_FETCH_SIZE", "5000"))  # rows per round trip in cursor mode
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+    )
+
+
+class Embeddings:
+    """Activity ids, their types (as codes into `type_names`) and the embedding matrix, row-aligned."""
+
+    def __init__(self, ids, type_codes, type_names, matrix, generation=None):
+        self.ids = ids
+        self.type_codes = type_codes
+        self.type_names = list(type_names)
+        self.matrix = matrix
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def activity_types(self):
+        """Activity type per row as an array of strings."""
+        return np.array(self.type_names, dtype=object)[self.type_codes] if len(self) else np.array([], dtype=object)
+
+
+class _CopyParser:
+    """
+    File-like sink for `COPY ... TO STDOUT WITH (FORMAT binary)` of
+    (activity_id bigint, activity_type text, embedding vector) that fills preallocated arrays.
+    """
+
+    def __init__(self, ids, type_codes, matrix):
+        self.ids = ids
+        self.type_codes = type_codes
+        self.matrix = matrix
+        self.type_index = {}
+        self.rows = 0
+        self._buffer = bytearray()
+        self._offset = 0
+        self._header_done = False
+
+    def write(self, chunk):
+        self._buffer += chunk
+        self._parse()
+        return len(chunk)
+
+    def _parse(self):
+        buf, pos = self._buffer, self._offset
+        if not self._header_done:
+            if len(buf) < 19:
+                return
+            if bytes(buf[:11]) != COPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            (extension,) = struct.unpack_from(">i", buf, 15)
+            if len(buf) < 19 + extension:
+                return
+            pos = 19 + extension
+            self._header_done = True
+
+        dim = self.matrix.shape[1]
+        while True:
+            start = pos
+            if len(buf) - pos < 2:
+                break
+            (fields,) = struct.unpack_from(">h", buf, pos)
+            if fields == -1:  # trailer
+                pos += 2
+                break
+            pos += 2
+            values = []
+            complete = True
+            for _ in range(fields):
+                if len(buf) - pos < 4:
+                    complete = False
+                    break
+                (length,) = struct.unpack_from(">i", buf, pos)
+                pos += 4
+                if length == -1:
+                    values.append(None)
+                    continue
+                if len(buf) - pos < length:
+                    complete = False
+                    break
+                values.append((pos, length))
+                pos += length
+            if not complete:
+                pos = start
+                break
+
+            (id_pos, _), type_field, (vector_pos, _) = values
+            (self.ids[self.rows],) = struct.unpack_from(">q", buf, id_pos)
+            activity_type = bytes(buf[type_field[0]:type_field[0] + type_field[1]]).decode() if type_field else None
+            self.type_codes[self.rows] = self.type_index.setdefault(activity_type, len(self.type_index))
+            # pgvector binary format: uint16 dimensions, uint16 unused, float32 big-endian values
+            (vector_dim,) = struct.unpack_from(">H", buf, vector_pos)
+            if vector_dim != dim:
+                raise ValueError(f"Expected {dim}-dimensional embeddings, got {vector_dim}")
+            self.matrix[self.rows] = np.frombuffer(buf, dtype=">f4", count=dim, offset=vector_pos + 4)
+            self.rows += 1
+
+        # Drop consumed bytes once in a while instead of on every chunk
+        if pos > 1 << 20:
+            del buf[:pos]
+            pos = 0
+        self._offset = pos
+
+
+def _where(user_id, activity_type):
+    conditions, params = ["embedding IS NOT NULL"], []
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+    if activity_type is not None:
+        conditions.append("activity_type = %s")
+        params.append(activity_type)
+    return " AND ".join(conditions), params
+
+
+def read_generation(cur):
+    """The data generation bumped by every ingest, or None on databases without the table."""
+    cur.execute("SELECT to_regclass('data_generation') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("SELECT generation FROM data_generation")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def _fetch_copy(cur, where, params, ids, type_codes, matrix):
+    parser = _CopyParser(ids, type_codes, matrix)
+    query = cur.mogrify(f"SELECT activity_id, activity_type, embedding FROM activities WHERE {where}", params)
+    cur.copy_expert(f"COPY ({query.decode()}) TO STDOUT WITH (FORMAT binary)", parser)
+    names = sorted(parser.type_index, key=parser.type_index.get)
+    return parser.rows, names
+
+
+def _fetch_cursor(conn, where, params, ids, type_codes, matrix, fetch_size=EMBEDDING_FETCH_SIZE):
+    try:
+        from pgvector.psycopg2 import register_vector
+        register_vector(conn)  # embeddings arrive as float32 arrays
+    except ImportError:
+        pass
+    type_index = {}
+    rows = 0
+    with conn.cursor(name="embedding_loader") as cur:  # server-side: rows arrive fetch_size at a time
+        cur.itersize = fetch_size
+        cur.execute(f"SELECT activity_id, activity_type, embedding FROM activities WHERE {where}", params)
+        for activity_id, activity_type, embedding in cur:
+            if isinstance(embedding, str):
+                embedding = np.array(embedding.strip("[]").split(","), dtype=np.float32)
+            ids[rows] = activity_id
+            type_codes[rows] = type_index.setdefault(activity_type, len(type_index))
+            matrix[rows] = embedding
+            rows += 1
+    return rows, sorted(type_index, key=type_index.get)
+
+
+def _cache_paths(cache_dir, key):
+    base = os.path.join(cache_dir, key)
+    return {name: f"{base}.{name}" for name in ("matrix.npy", "ids.npy", "types.npy", "json")}
+
+
+def _cache_key(user_id, activity_type, generation):
+    scope = hashlib.sha1(json.dumps([user_id, activity_type]).encode()).hexdigest()[:12]
+    return scope, f"embeddings-{scope}-g{generation}"
+
+
+def _load_cached(paths):
+    if not os.path.exists(paths["json"]):  # written last, so its presence means the rest is complete
+        return None
+    with open(paths["json"], "r") as f:
+        meta = json.load(f)
+    return Embeddings(np.load(paths["ids.npy"]), np.load(paths["types.npy"]), meta["type_names"],
+                      np.load(paths["matrix.npy"], mmap_mode="r"), meta["generation"])
+
+
+def _prune(cache_dir, scope, keep):
+    """Remove cached matrices of the same scope from older generations."""
+    prefix = f"embeddings-{scope}-g"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and not name.startswith(keep + "."):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def load_embeddings(user_id=None, activity_type=None, conn=None, mode=EMBEDDING_LOAD_MODE,
+                    cache_dir=EMBEDDING_CACHE_DIR, timings=None):
+    """
+    Load (ids, types, embedding matrix) for the activities matching the filters.
+
+    Served from the .npy cache when it holds the current data generation; otherwise read in one
+    repeatable-read snapshot, so the row count used to size the matrix matches what is streamed
+    (a passed-in `conn` must not be inside a transaction).
+    Per-step seconds are added to `timings` if a dict is passed.
+    """
+    if mode not in ("copy", "cursor"):
+        raise ValueError(f"Unknown load mode: {mode}")
+    timings = timings if timings is not None else {}
+    own_conn = conn is None
+    conn = conn or connect()
+    try:
+        start = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        generation = read_generation(cur)
+
+        paths = None
+        if cache_dir and generation is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            scope, key = _cache_key(user_id, activity_type, generation)
+            paths = _cache_paths(cache_dir, key)
+            cached = _load_cached(paths)
+            if cached is not None:
+                conn.rollback()
+                timings["load_cache"] = time.perf_counter() - start
+                return cached
+
+        where, params = _where(user_id, activity_type)
+        cur.execute(f"SELECT COUNT(*) FROM activities WHERE {where}", params)
+        count = cur.fetchone()[0]
+        cur.execute(f"SELECT vector_dims(embedding) FROM activities WHERE {where} LIMIT 1", params)
+        row = cur.fetchone()
+        dim = row[0] if row else 0
+        timings["count"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if paths:
+            tmp_matrix = paths["matrix.npy"] + ".tmp"
+            matrix = np.lib.format.open_memmap(tmp_matrix, mode="w+", dtype=np.float32, shape=(count, dim))
+        else:
+            matrix = np.empty((count, dim), dtype=np.float32)
+        ids = np.empty(count, dtype=np.int64)
+        type_codes = np.empty(count, dtype=np.int16)
+        if count:
+            if mode == "copy":
+                rows, type_names = _fetch_copy(cur, where, params, ids, type_codes, matrix)
+            else:
+                rows, type_names = _fetch_cursor(conn, where, params, ids, type_codes, matrix)
+        else:
+            rows, type_names = 0, []
+        cur.close()
+        conn.rollback()
+        timings["fetch"] = time.perf_counter() - start
+        if rows != count:
+            raise RuntimeError(f"Expected {count} embeddings, read {rows}")
+
+        if paths:
+            start = time.perf_counter()
+            matrix.flush()
+            del matrix
+            os.replace(tmp_matrix, paths["matrix.npy"])
+            np.save(paths["ids.npy"], ids)
+            np.save(paths["types.npy"], type_codes)
+            with open(paths["json"] + ".tmp", "w") as f:
+                json.dump({"generation": generation, "rows": rows, "dim": dim, "type_names": type_names,
+                           "user_id": user_id, "activity_type": activity_type}, f)
+            os.replace(paths["json"] + ".tmp", paths["json"])
+            _prune(cache_dir, scope, key)
+            matrix = np.load(paths["matrix.npy"], mmap_mode="r")
+            timings["write_cache"] = time.perf_counter() - start
+        return Embeddings(ids, type_codes, type_names, matrix, generation)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id")
+    parser.add_argument("--activity-type")
+    parser.add_argument("--mode", choices=["copy", "cursor"], default=EMBEDDING_LOAD_MODE)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    timings = {}
+    embeddings = load_embeddings(args.user_id, args.activity_type, mode=args.mode,
+                                 cache_dir=None if args.no_cache else EMBEDDING_CACHE_DIR, timings=timings)
+    print(f"✅ {len(embeddings)} embeddings {embeddings.matrix.shape} at generation {embeddings.generation}; "
+          + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
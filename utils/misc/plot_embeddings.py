@@ -1,62 +1,168 @@
-import psycopg2
+import argparse
+import os
+import time
+
 import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
 from dotenv import load_dotenv
-import os
-import ast
+
+from centroids import centroids_from_matrix, load_centroids
+from embedding_loader import connect, load_embeddings
 
 # Load env vars
 load_dotenv()
-POSTGRES_DB = os.getenv("POSTGRES_DB")
-POSTGRES_USER = os.getenv("POSTGRES_USER")
-POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
-POSTGRES_HOST = os.getenv("POSTGRES_HOST")
-POSTGRES_PORT = os.getenv("POSTGRES_PORT")
-
-def fetch_activities():
-    conn = psycopg2.connect(
-        dbname=POSTGRES_DB,
-        user=POSTGRES_USER,
-        password=POSTGRES_PASSWORD,
-        host=POSTGRES_HOST,
-        port=POSTGRES_PORT
-    )
-    cur = conn.cursor()
-    cur.execute("SELECT activity_id, activity_type, embedding FROM activities")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    # Convert to DataFrame
-    data = pd.DataFrame(rows, columns=["activity_id", "activity_type", "embedding"])
-    #data["embedding"] = data["embedding"].apply(lambda x: np.array(x))
-    data["embedding"] = data["embedding"].apply(
-        lambda x: np.array(ast.literal_eval(x)) if isinstance(x, str) else x
-    )
-    return data
-
-def reduce_and_plot(data, method="pca", filename="embedding_plot.png"):
-    embeddings = np.stack(data["embedding"].values)
-    
+
+# Above this many activities the scalable mode is used (incremental PCA, sampled t-SNE)
+PLOT_SCALABLE_MIN_ROWS = int(os.getenv("PLOT_SCALABLE_MIN_ROWS", "5000"))
+PLOT_TSNE_SAMPLE = int(os.getenv("PLOT_TSNE_SAMPLE", "5000"))  # points t-SNE is fitted on; the rest are projected
+PLOT_PCA_BATCH = int(os.getenv("PLOT_PCA_BATCH", "10000"))  # rows per IncrementalPCA step
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", "200000"))  # drawn points; larger sets are subsampled
+TSNE_PCA_COMPONENTS = 50  # t-SNE and neighbour lookups run on this many PCA components
+PROJECTION_NEIGHBOURS = 10
+
+
+def fetch_activities(user_id=None, activity_type=None, timings=None):
+    """Activity ids/types as a DataFrame, the row-aligned float32 embedding matrix and the Embeddings set."""
+    embeddings = load_embeddings(user_id, activity_type, timings=timings)
+    data = pd.DataFrame({"activity_id": embeddings.ids, "activity_type": embeddings.activity_types})
+    return data, embeddings.matrix, embeddings
+
+
+def fetch_centroids(embeddings, user_id=None):
+    """Stored per-type centroids, or computed from the loaded matrix when the table is stale."""
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            centroids = load_centroids(cur, user_id)
+    finally:
+        conn.close()
+    if centroids is None:
+        print("⚠️ activity_type_centroids is missing or stale, computing centroids from the matrix "
+              "(refresh with utils/misc/centroids.py)")
+        centroids = centroids_from_matrix(embeddings)
+    return {name: value for name, value in centroids.items() if name in embeddings.type_names}
+
+
+def fit_pca(embeddings, n_components, scalable, batch_size=PLOT_PCA_BATCH):
+    """Full PCA, or IncrementalPCA fitted batch by batch so a memory-mapped matrix is never fully loaded."""
+    if not scalable:
+        return PCA(n_components=n_components).fit(embeddings)
+    pca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    batch_size = max(batch_size, n_components)
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start:start + batch_size])
+        if len(batch) >= n_components:  # a short last batch can't be fitted on its own
+            pca.partial_fit(batch)
+    return pca
+
+
+def transform_batched(model, embeddings, batch_size=PLOT_PCA_BATCH):
+    return np.concatenate([model.transform(np.asarray(embeddings[start:start + batch_size]))
+                           for start in range(0, len(embeddings), batch_size)]) if len(embeddings) else \
+        np.empty((0, model.n_components), dtype=np.float32)
+
+
+class NeighbourProjection:
+    """Places points into an existing 2-D embedding at the distance-weighted mean of their nearest fitted points."""
+
+    def __init__(self, features, coords, k=PROJECTION_NEIGHBOURS):
+        self.coords = coords
+        self.index = NearestNeighbors(n_neighbors=min(k, len(features))).fit(features)
+
+    def transform(self, features, batch_size=PLOT_PCA_BATCH):
+        out = np.empty((len(features), 2), dtype=np.float32)
+        for start in range(0, len(features), batch_size):
+            distances, neighbours = self.index.kneighbors(features[start:start + batch_size])
+            weights = 1.0 / np.maximum(distances, 1e-6)
+            weights /= weights.sum(axis=1, keepdims=True)
+            out[start:start + batch_size] = np.einsum("nk,nkd->nd", weights, self.coords[neighbours])
+        return out
+
+
+def reduce(embeddings, method="pca", scalable=False, centroids=None, sample=PLOT_TSNE_SAMPLE, timings=None, seed=42):
+    """
+    2-D coordinates for every row (and for each centroid). Scalable t-SNE runs Barnes-Hut on a
+    random sample in PCA-50 space and projects the remaining points by nearest neighbours.
+    """
+    timings = timings if timings is not None else {}
+    centroid_matrix = np.stack([vector for vector, _ in centroids.values()]) if centroids else None
+
     if method == "pca":
-        reducer = PCA(n_components=2)
-    elif method == "tsne":
-        reducer = TSNE(n_components=2, perplexity=5, random_state=42)
-    else:
+        start = time.perf_counter()
+        pca = fit_pca(embeddings, 2, scalable)
+        timings["pca_fit"] = time.perf_counter() - start
+        start = time.perf_counter()
+        reduced = transform_batched(pca, embeddings)
+        centroid_coords = pca.transform(centroid_matrix) if centroid_matrix is not None else None
+        timings["pca_transform"] = time.perf_counter() - start
+        return reduced, centroid_coords
+
+    if method != "tsne":
         raise ValueError("Method must be 'pca' or 'tsne'")
-    
-    reduced = reducer.fit_transform(embeddings)
-    data["x"] = reduced[:, 0]
-    data["y"] = reduced[:, 1]
 
-    # Plot
+    if not scalable:
+        start = time.perf_counter()
+        features = np.asarray(embeddings)
+        reduced = TSNE(n_components=2, perplexity=min(5, max(1, len(features) - 1)), random_state=seed) \
+            .fit_transform(features)
+        timings["tsne_fit"] = time.perf_counter() - start
+        centroid_coords = None
+        if centroid_matrix is not None:
+            start = time.perf_counter()
+            centroid_coords = NeighbourProjection(features, reduced).transform(centroid_matrix)
+            timings["tsne_project"] = time.perf_counter() - start
+        return reduced, centroid_coords
+
+    start = time.perf_counter()
+    pca = fit_pca(embeddings, min(TSNE_PCA_COMPONENTS, embeddings.shape[1]), scalable=True)
+    features = transform_batched(pca, embeddings).astype(np.float32)
+    timings["pca_fit"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    sampled = np.sort(rng.choice(len(features), size=min(sample, len(features)), replace=False))
+    sample_coords = TSNE(n_components=2, perplexity=min(30, max(1, (len(sampled) - 1) / 3)), method="barnes_hut",
+                         init="pca", random_state=seed).fit_transform(features[sampled])
+    timings["tsne_fit"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    projection = NeighbourProjection(features[sampled], sample_coords)
+    reduced = projection.transform(features)
+    reduced[sampled] = sample_coords
+    centroid_coords = projection.transform(pca.transform(centroid_matrix)) if centroid_matrix is not None else None
+    timings["tsne_project"] = time.perf_counter() - start
+    return reduced, centroid_coords
+
+
+def reduce_and_plot(data, embeddings, method="pca", filename="embedding_plot.png", scalable=None, centroids=None,
+                    max_points=PLOT_MAX_POINTS, timings=None):
+    """Project, plot and save; `scalable=None` picks the mode from the number of activities."""
+    timings = timings if timings is not None else {}
+    if scalable is None:
+        scalable = len(data) > PLOT_SCALABLE_MIN_ROWS
+    reduced, centroid_coords = reduce(embeddings, method, scalable, centroids, timings=timings)
+    data = data.assign(x=reduced[:, 0], y=reduced[:, 1])
+
+    start = time.perf_counter()
+    if len(data) > max_points:
+        data = data.sample(n=max_points, random_state=42)
     plt.figure(figsize=(10, 6))
-    sns.scatterplot(data=data, x="x", y="y", hue="activity_type", palette="tab10", s=80)
-    plt.title(f"{method.upper()} Projection of Activity Embeddings")
+    point_size = 80 if len(data) <= 1000 else max(1, 8000 // len(data))
+    sns.scatterplot(data=data, x="x", y="y", hue="activity_type", palette="tab10", s=point_size,
+                    linewidth=0 if scalable else None, rasterized=scalable)
+    if centroid_coords is not None:
+        plt.scatter(centroid_coords[:, 0], centroid_coords[:, 1], marker="X", s=200, c="black")
+        for (activity_type, (_, count)), (x, y) in zip(centroids.items(), centroid_coords):
+            plt.annotate(f"{activity_type} ({count})", (x, y), textcoords="offset points", xytext=(6, 6))
+    mode = " (scalable)" if scalable else ""
+    plt.title(f"{method.upper()} Projection of Activity Embeddings{mode}")
     plt.xlabel("Component 1")
     plt.ylabel("Component 2")
     plt.legend(title="Activity Type")
@@ -64,9 +170,27 @@ def reduce_and_plot(data, method="pca", filename="embedding_plot.png"):
     #plt.show()
     plt.savefig(filename, dpi=300)
     plt.close()
-    print(f"✅ Saved plot to {filename}")
+    timings["render"] = time.perf_counter() - start
+    print(f"✅ Saved plot to {filename} ({len(reduced)} activities; "
+          + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()) + ")")
+    return timings
+
 
 # Run it
-data = fetch_activities()
-reduce_and_plot(data, method="pca", filename="pca.png") 
-reduce_and_plot(data, method="tsne", filename="tsne.png") 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot 2-D projections of activity embeddings")
+    parser.add_argument("--method", choices=["pca", "tsne", "both"], default="both")
+    parser.add_argument("--user-id")
+    parser.add_argument("--activity-type")
+    parser.add_argument("--scalable", choices=["auto", "on", "off"], default="auto",
+                        help=f"auto = on above {PLOT_SCALABLE_MIN_ROWS} activities")
+    parser.add_argument("--centroids", action="store_true", help="Overlay per-type centroids")
+    args = parser.parse_args()
+
+    load_timings = {}
+    data, matrix, embeddings = fetch_activities(args.user_id, args.activity_type, timings=load_timings)
+    print("Loaded embeddings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in load_timings.items()))
+    centroids = fetch_centroids(embeddings, args.user_id) if args.centroids else None
+    scalable = {"auto": None, "on": True, "off": False}[args.scalable]
+    for method in (["pca", "tsne"] if args.method == "both" else [args.method]):
+        reduce_and_plot(data, matrix, method=method, filename=f"{method}.png", scalable=scalable, centroids=centroids)
@@ -0,0 +1,232 @@
+"""
+Activity embeddings for ingestion: a content-hash cache in front of a lazily loaded model.
+
+Texts whose embedding is already in the SQLite cache never reach the model, and the model
+(sentence-transformers, or an int8 ONNX export of the same MiniLM) is only loaded once a
+text misses, so a no-op sync starts instantly. Create the ONNX backend with:
+
+    python utils/strava/embedder.py export-onnx
+    EMBEDDING_BACKEND=onnx python utils/strava/run_all.py
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # "torch" (sentence-transformers) or "onnx"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")  # empty = no cache
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "models/all-MiniLM-L6-v2-onnx")
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))  # CPU threads for the model, 0 = library default
+MAX_SEQUENCE_LENGTH = 256  # all-MiniLM-L6-v2's max_seq_length
+
+
+class TorchBackend:
+    """sentence-transformers on PyTorch (normalized mean-pooled MiniLM, as before)."""
+
+    name = "torch"
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        if EMBED_THREADS > 0:
+            import torch
+            torch.set_num_threads(EMBED_THREADS)
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts, batch_size=64):
+        return self.model.encode(texts, batch_size=batch_size, show_progress_bar=False).astype(np.float32)
+
+
+class OnnxBackend:
+    """
+    The same MiniLM exported to ONNX with int8 dynamic quantization, run with onnxruntime and the
+    `tokenizers` library (no PyTorch at runtime). Mean pooling and L2 normalization match the
+    sentence-transformers pipeline.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        model_path = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"{model_path} not found; run `python utils/strava/embedder.py export-onnx`")
+        options = onnxruntime.SessionOptions()
+        if EMBED_THREADS > 0:
+            options.intra_op_num_threads = EMBED_THREADS
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(MAX_SEQUENCE_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts, batch_size=64):
+        out = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            inputs = {"input_ids": np.array([e.ids for e in encodings], dtype=np.int64), "attention_mask": mask}
+            if "token_type_ids" in self.input_names:
+                inputs["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = self.session.run(None, inputs)[0]  # (batch, tokens, 384)
+            weights = mask[:, :, None].astype(np.float32)
+            pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+            out[start:start + len(encodings)] = pooled / np.maximum(
+                np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return out
+
+
+BACKENDS = {"torch": TorchBackend, "onnx": OnnxBackend}
+
+
+class EmbeddingCache:
+    """float32 embeddings in SQLite, keyed by sha256(backend, text)."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB NOT NULL)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(backend, text):
+        return hashlib.sha256(f"{EMBEDDING_MODEL}\0{backend}\0{text}".encode()).digest()
+
+    def get_many(self, keys):
+        """{key: vector} for the keys that are cached."""
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), 500):  # stay under SQLite's bound-parameter limit
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        return found
+
+    def put_many(self, items):
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                                  [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items])
+            self.conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class Embedder:
+    """Cache-first embedding of texts; the backend is created on the first cache miss."""
+
+    def __init__(self, backend=EMBEDDING_BACKEND, cache_path=EMBEDDING_CACHE_PATH):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.backend_name = backend
+        self.cache = EmbeddingCache(cache_path) if cache_path else None
+        self._backend = None
+        self._lock = threading.Lock()
+        self.stats = {"texts": 0, "cache_hits": 0, "encoded": 0}
+
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    print(f"Loading {self.backend_name} embedding model ...")
+                    self._backend = BACKENDS[self.backend_name]()
+        return self._backend
+
+    def embed(self, texts, batch_size=64):
+        """Embeddings for `texts` as a (len(texts), 384) float32 array."""
+        texts = list(texts)
+        out = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        keys = [EmbeddingCache.key(self.backend_name, text) for text in texts] if self.cache else None
+        cached = self.cache.get_many(set(keys)) if self.cache else {}
+        missing = []
+        for i, text in enumerate(texts):
+            vector = cached.get(keys[i]) if keys else None
+            if vector is None:
+                missing.append(i)
+            else:
+                out[i] = vector
+        if missing:
+            unique = list(dict.fromkeys(texts[i] for i in missing))  # duplicate texts are encoded once
+            encoded = dict(zip(unique, self.backend().encode(unique, batch_size=batch_size)))
+            for i in missing:
+                out[i] = encoded[texts[i]]
+            if self.cache:
+                self.cache.put_many((EmbeddingCache.key(self.backend_name, text), vector)
+                                    for text, vector in encoded.items())
+            self.stats["encoded"] += len(unique)
+        self.stats["texts"] += len(texts)
+        self.stats["cache_hits"] += len(texts) - len(missing)
+        return out
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """Return the process-wide embedder, creating it on first use."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = Embedder()
+    return _embedder
+
+
+def export_onnx(model_dir=ONNX_MODEL_DIR, model_name=EMBEDDING_MODEL):
+    """Export MiniLM's transformer to ONNX, quantize its weights to int8 and save the tokenizer."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(model_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    tokenizer.save_pretrained(model_dir)  # writes tokenizer.json for the `tokenizers` runtime
+
+    sample = tokenizer(["a 5k run in the park"], return_tensors="pt")
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    fp32_path = os.path.join(model_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer, tuple(sample[name] for name in names), fp32_path,
+            input_names=names, output_names=["last_hidden_state"],
+            dynamic_axes={**{name: {0: "batch", 1: "tokens"} for name in names},
+                          "last_hidden_state": {0: "batch", 1: "tokens"}},
+            opset_version=14,
+        )
+    int8_path = os.path.join(model_dir, "model_int8.onnx")
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export-onnx", "cache-stats"])
+    parser.add_argument("--model-dir", default=ONNX_MODEL_DIR)
+    args = parser.parse_args()
+
+    if args.command == "export-onnx":
+        print(f"✅ Wrote {export_onnx(args.model_dir)}")
+    elif not EMBEDDING_CACHE_PATH:
+        print("Embedding cache disabled (EMBEDDING_CACHE_PATH is empty)")
+    else:
+        print(f"{EMBEDDING_CACHE_PATH}: {len(EmbeddingCache())} cached embeddings")
+
+
+if __name__ == "__main__":
+    main()
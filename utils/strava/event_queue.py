@@ -0,0 +1,132 @@
+"""
+Durable queue of Strava webhook events, in a local SQLite file.
+
+The webhook server appends events as they arrive; the worker claims them in batches with a
+lease, so events survive restarts and an event whose worker died is picked up again.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+WEBHOOK_QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", "webhook_events.sqlite3")
+WEBHOOK_LEASE_SECONDS = float(os.getenv("WEBHOOK_LEASE_SECONDS", "300"))  # claimed events are retried after this
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        received_at REAL NOT NULL,
+        object_type TEXT NOT NULL,
+        object_id INTEGER NOT NULL,
+        aspect_type TEXT NOT NULL,
+        owner_id INTEGER,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending | done | failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS events_available_idx ON events (status, available_at);
+"""
+
+
+class EventQueue:
+    """SQLite-backed FIFO with leases; safe to share between threads and processes."""
+
+    def __init__(self, path=WEBHOOK_QUEUE_PATH, lease_seconds=WEBHOOK_LEASE_SECONDS, max_attempts=WEBHOOK_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._ready = threading.Condition()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")  # the server appends while the worker reads
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, event):
+        """Append one webhook event (the JSON body Strava posted)."""
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO events (received_at, object_type, object_id, aspect_type, owner_id, payload, available_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (now, event["object_type"], int(event["object_id"]), event["aspect_type"], event.get("owner_id"),
+             json.dumps(event), now),
+        )
+        with self._ready:
+            self._ready.notify_all()
+
+    def claim(self, limit=100):
+        """
+        Lease up to `limit` available events, oldest first; returns them as dicts with their queue id.
+
+        Every claim counts as an attempt, so an event whose lease keeps expiring (its worker dies
+        or hangs on it) is parked as failed after max_attempts instead of being claimed forever.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, payload, attempts FROM events WHERE status = 'pending' AND available_at <= ? "
+                "ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            exhausted = [row for row in rows if row[2] >= self.max_attempts]
+            rows = [row for row in rows if row[2] < self.max_attempts]
+            if exhausted:
+                conn.executemany(
+                    "UPDATE events SET status = 'failed', error = COALESCE(error, ?) WHERE id = ?",
+                    [(f"Lease expired after {attempts} attempts", event_id) for event_id, _, attempts in exhausted])
+            if rows:
+                conn.executemany("UPDATE events SET available_at = ?, attempts = attempts + 1 WHERE id = ?",
+                                 [(now + self.lease_seconds, row[0]) for row in rows])
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return [dict(json.loads(payload), queue_id=event_id, attempts=attempts + 1)
+                for event_id, payload, attempts in rows]
+
+    def ack(self, queue_ids):
+        """Mark events as processed."""
+        self._conn().executemany("UPDATE events SET status = 'done', error = NULL WHERE id = ?",
+                                 [(queue_id,) for queue_id in queue_ids])
+
+    def retry(self, event, error, delay):
+        """Make a failed event available again after `delay` seconds, or park it after max_attempts."""
+        status = "failed" if event["attempts"] >= self.max_attempts else "pending"
+        self._conn().execute("UPDATE events SET status = ?, available_at = ?, error = ? WHERE id = ?",
+                             (status, time.time() + delay, str(error), event["queue_id"]))
+
+    def wait(self, timeout):
+        """Sleep until an event is put by this process or `timeout` passes (other processes are polled)."""
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def purge(self, older_than_seconds=7 * 24 * 3600):
+        """Delete processed events older than this."""
+        self._conn().execute("DELETE FROM events WHERE status = 'done' AND received_at < ?",
+                             (time.time() - older_than_seconds,))
+
+    def stats(self):
+        counts = dict(self._conn().execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall())
+        oldest = self._conn().execute("SELECT MIN(received_at) FROM events WHERE status = 'pending'").fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0.0,
+        }
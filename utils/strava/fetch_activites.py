@@ -1,21 +1,36 @@
+import argparse
+import fcntl
 import json
+import threading
 import time
+import psycopg2
 import requests
 import os
+from contextlib import contextmanager
 
 from dotenv import load_dotenv
+from spool import ACTIVITIES_SPOOL, append_activities, batched, read_spool, reset_spool
+from strava_client import FetchScheduler
 
 # Load environment variables from .env file
 load_dotenv()
 
 TOKEN_FILE = "token.json"
-ACTIVITIES_FILE = "activities.json"
+# Tokens for several athletes: {"<user_id>": {"access_token": ..., "refresh_token": ..., "expires_at": ...}}
+ATHLETES_FILE = os.getenv("STRAVA_ATHLETES_FILE", "athletes.json")
+# Refresh tokens this long before they expire, so they don't lapse in the middle of a sync
+TOKEN_REFRESH_MARGIN = int(os.getenv("STRAVA_TOKEN_REFRESH_MARGIN", "300"))
+SYNC_STATE_FILE = "sync_state.json"  # checkpoint so an interrupted sync can resume
+
+# Re-fetch this much history before the newest stored activity, to pick up recent edits
+# and absorb any time zone drift in the stored (timezone-less) timestamps
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "86400"))
 
 CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
 CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
 
-TOKEN_URL = "https://www.strava.com/api/v3/oauth/token"
-ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+STRAVA_API_URL = os.getenv("STRAVA_API_URL", "https://www.strava.com/api/v3")
+TOKEN_URL = f"{STRAVA_API_URL}/oauth/token"
 
 
 def load_tokens():
@@ -28,7 +43,7 @@ def save_tokens(token_data):
         json.dump(token_data, f, indent=2)
 
 
-def refresh_token_if_needed(tokens):
+def refresh_token_if_needed(tokens, save=save_tokens):
     if time.time() < tokens["expires_at"]:
         print("✅ Access token is still valid.")
         return tokens
@@ -54,46 +69,311 @@ def refresh_token_if_needed(tokens):
         "token_type": new_tokens["token_type"]
     }
 
-    save_tokens(refreshed)
+    save(refreshed)
     print("✅ Token refreshed and saved.")
     return refreshed
 
 
-def fetch_activities(access_token, per_page=50, max_pages=5):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    all_activities = []
+class TokenStore:
+    """
+    Access tokens for every athlete being synced, refreshed centrally.
+
+    Reads ATHLETES_FILE if it exists, otherwise token.json as the single athlete
+    STRAVA_USER_ID. Concurrent fetches for one athlete share a single refresh. Several
+    processes (a sync, the webhook worker) can share the athletes file: every write re-reads
+    it under a file lock and changes only its own athlete, and unknown athletes trigger a reload.
+    """
+
+    def __init__(self, path=ATHLETES_FILE):
+        self.path = path if os.path.exists(path) else None
+        self._tokens = self._read()
+        self._locks = {user_id: threading.Lock() for user_id in self._tokens}
+        self._save_lock = threading.Lock()
+
+    def athletes(self):
+        return list(self._tokens)
+
+    def _read(self):
+        if self.path is None:
+            return {os.getenv("STRAVA_USER_ID"): load_tokens()}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the athletes file across processes (caller holds _save_lock)."""
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lock_for(self, user_id):
+        with self._save_lock:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def reload(self):
+        """Re-read the tokens file, picking up athletes added and tokens refreshed by other processes."""
+        with self._save_lock:
+            if self.path is None:
+                self._tokens = self._read() if os.path.exists(TOKEN_FILE) else {}
+                return
+            with self._file_lock():
+                self._tokens = self._read()
+
+    def _save(self, user_id, tokens):
+        if self.path is None:
+            save_tokens(tokens)
+            return
+        with self._save_lock, self._file_lock():
+            latest = self._read()
+            latest[user_id] = tokens
+            self._write(latest)
+
+    def _write(self, tokens):
+        """Rewrite the athletes file (caller holds _save_lock and the file lock)."""
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(tokens, f, indent=2)
+        os.replace(tmp_file, self.path)
+        self._tokens = tokens
+
+    def access_token(self, user_id, force_refresh=False):
+        """A valid access token for the athlete, refreshing it first if it (nearly) expired."""
+        with self._lock_for(user_id):
+            tokens = self._tokens[user_id]
+            if not force_refresh and time.time() < tokens["expires_at"] - TOKEN_REFRESH_MARGIN:
+                return tokens["access_token"]
+            if self.path is not None:
+                # Another process may have refreshed it already (and Strava may have rotated the refresh token)
+                self.reload()
+                latest = self._tokens[user_id]  # KeyError if another process forgot them meanwhile
+                if latest["access_token"] != tokens["access_token"] and \
+                        time.time() < latest["expires_at"] - TOKEN_REFRESH_MARGIN:
+                    return latest["access_token"]
+                tokens = latest
+            # Keep fields the refresh response lacks (e.g. the "athlete" from the first code exchange)
+            refreshed = refresh_token_if_needed(dict(tokens, expires_at=0),
+                                                save=lambda t: self._save(user_id, dict(tokens, **t)))
+            self._tokens[user_id] = dict(tokens, **refreshed)
+            return refreshed["access_token"]
+
+    def forget(self, user_id):
+        """Drop an athlete's tokens (e.g. after they deauthorized the app); their refresh token no longer works."""
+        with self._save_lock:
+            self._locks.pop(user_id, None)
+            if self.path is None:
+                if self._tokens.pop(user_id, None) is None:
+                    return False
+                if os.path.exists(TOKEN_FILE):
+                    os.remove(TOKEN_FILE)
+                return True
+            with self._file_lock():
+                latest = self._read()
+                if latest.pop(user_id, None) is None:
+                    self._tokens = latest
+                    return False
+                self._write(latest)
+        return True
+
+    def user_for_athlete(self, athlete_id):
+        """
+        The user_id whose tokens belong to a Strava athlete id (as sent in webhook events).
+
+        Matches an "athlete_id" or "athlete": {"id": ...} entry, then a user_id equal to the
+        athlete id; with a single athlete and no recorded id, that athlete. The file is re-read
+        once on a miss, in case the athlete was added after this store loaded it. None if unknown.
+        """
+        user_id = self._match_athlete(int(athlete_id))
+        if user_id is None:
+            self.reload()
+            user_id = self._match_athlete(int(athlete_id))
+        return user_id
+
+    def _match_athlete(self, athlete_id):
+        for user_id, tokens in self._tokens.items():
+            recorded = tokens.get("athlete_id") or (tokens.get("athlete") or {}).get("id")
+            if recorded is not None and int(recorded) == athlete_id:
+                return user_id
+        if str(athlete_id) in self._tokens:
+            return str(athlete_id)
+        if len(self._tokens) == 1:
+            user_id, tokens = next(iter(self._tokens.items()))
+            if not tokens.get("athlete_id") and not tokens.get("athlete"):
+                return user_id
+        return None
+
+    def getter(self, user_id):
+        """Token callable for FetchScheduler: get_token(force_refresh=False)."""
+        return lambda force_refresh=False: self.access_token(user_id, force_refresh)
+
+
+def _connect():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+    )
 
-    for page in range(1, max_pages + 1):
-        print(f"Fetching page {page}...")
-        res = requests.get(ACTIVITIES_URL, headers=headers, params={
-            "per_page": per_page,
-            "page": page
-        })
 
-        if res.status_code != 200:
-            print(f"❌ Error fetching page {page}: {res.status_code}")
-            break
+def get_high_water_mark(user_id=None):
+    """Epoch seconds of the newest activity already stored, or None if there is none."""
+    try:
+        conn = _connect()
+    except psycopg2.Error as e:
+        print(f"⚠️ Could not read the latest stored activity ({e}), doing a full sync.")
+        return None
+    try:
+        with conn.cursor() as cur:
+            if user_id:
+                cur.execute("SELECT EXTRACT(EPOCH FROM MAX(timestamp)) FROM activities WHERE user_id = %s", (user_id,))
+            else:
+                cur.execute("SELECT EXTRACT(EPOCH FROM MAX(timestamp)) FROM activities")
+            latest = cur.fetchone()[0]
+    finally:
+        conn.close()
+    return int(latest) if latest is not None else None
 
-        page_data = res.json()
-        if not page_data:
-            break
 
-        all_activities.extend(page_data)
+def get_high_water_marks(user_ids):
+    """Newest stored activity (epoch seconds) per athlete, in one query; athletes with none are left out."""
+    try:
+        conn = _connect()
+    except psycopg2.Error as e:
+        print(f"⚠️ Could not read the latest stored activities ({e}), doing a full sync.")
+        return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, EXTRACT(EPOCH FROM MAX(timestamp)) FROM activities "
+                        "WHERE user_id = ANY(%s) GROUP BY user_id", (list(user_ids),))
+            return {user_id: int(latest) for user_id, latest in cur.fetchall() if latest is not None}
+    finally:
+        conn.close()
 
-    print(f"✅ Total activities fetched: {len(all_activities)}")
-    return all_activities
+
+def load_sync_state():
+    if not os.path.exists(SYNC_STATE_FILE):
+        return None
+    with open(SYNC_STATE_FILE, "r") as f:
+        return json.load(f)
+
+
+def save_sync_state(state):
+    tmp_file = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, SYNC_STATE_FILE)
+
+
+def fetch_activities(access_token, per_page=50, max_pages=5, after=None, start_page=1, on_page=None):
+    """
+    Fetch activities page by page. With `after` (epoch seconds) only newer activities are
+    requested and pages are read until Strava runs out (max_pages=None).
+    `on_page(page, page_data)` is called, in page order, after every page so it can be spooled
+    and checkpointed. Pages are fetched STRAVA_PAGE_CONCURRENCY at a time within the rate limit.
+    Returns the number of activities fetched.
+    """
+    total = FetchScheduler().fetch_pages(lambda force_refresh=False: access_token, per_page=per_page,
+                                         max_pages=max_pages, after=after, start_page=start_page, on_page=on_page)
+    print(f"✅ Total activities fetched: {total}")
+    return total
+
+
+def sync(access_token, full=False, max_pages=5, user_id=None, on_activities=None):
+    """
+    Fetch new activities into the NDJSON spool, resuming an interrupted sync if there is one.
+
+    Incremental syncs request only activities newer than the latest stored one (minus
+    SYNC_OVERLAP_SECONDS); full syncs re-download pages 1..max_pages. Each page is appended
+    to the spool and, if given, handed to `on_activities` so storing can overlap fetching.
+    Returns the number of activities in the spool.
+    """
+    state = load_sync_state()
+    if state and not state.get("complete") and state.get("full", False) == full:
+        print(f"⏯️ Resuming interrupted sync after page {state['page']}.")
+        if on_activities:
+            # pages spooled before the interruption were never stored by this consumer
+            for page_data in batched(read_spool(), 50):
+                on_activities(page_data)
+    else:
+        after = None
+        if not full:
+            latest = get_high_water_mark(user_id)
+            after = max(0, latest - SYNC_OVERLAP_SECONDS) if latest is not None else 0
+            print(f"🔎 Fetching activities after {time.strftime('%Y-%m-%d %H:%M', time.gmtime(after))} UTC")
+        state = {"full": full, "after": after, "page": 0, "count": 0, "complete": False}
+        reset_spool()
+        save_sync_state(state)
+
+    def checkpoint(page, page_data):
+        append_activities(page_data)
+        state["page"] = page
+        state["count"] = state.get("count", 0) + len(page_data)
+        save_sync_state(state)
+        if on_activities:
+            on_activities(page_data)
+
+    incremental = state["after"] is not None
+    fetch_activities(
+        access_token,
+        max_pages=None if incremental else max_pages,
+        after=state["after"],
+        start_page=state["page"] + 1,
+        on_page=checkpoint,
+    )
+
+    state["complete"] = True
+    save_sync_state(state)
+    return state["count"]
+
+
+def sync_athletes(token_store, full=False, max_pages=5, on_activities=None, scheduler=None):
+    """
+    Fetch new activities for every athlete in `token_store` concurrently.
+
+    Each activity is tagged with its athlete's "user_id" before it is handed to `on_activities`.
+    There is no spool/resume here: an interrupted multi-athlete sync simply starts again from
+    each athlete's newest stored activity. Returns (counts, errors) by user_id.
+    """
+    users = token_store.athletes()
+    latest = {} if full else get_high_water_marks(users)
+    athletes = {}
+    for user_id in users:
+        after = None
+        if not full:
+            after = max(0, latest[user_id] - SYNC_OVERLAP_SECONDS) if user_id in latest else 0
+        athletes[user_id] = (token_store.getter(user_id), after)
+
+    def tag(user_id, page_data):
+        for activity in page_data:
+            activity["user_id"] = user_id
+        if on_activities:
+            on_activities(page_data)
+
+    scheduler = scheduler or FetchScheduler()
+    print(f"🔎 Syncing {len(users)} athletes, {scheduler.athlete_concurrency} at a time")
+    counts, errors = scheduler.fetch_athletes(athletes, tag, max_pages=max_pages)
+    print(f"✅ {sum(counts.values())} activities from {len(counts)} athletes ({len(errors)} failed); "
+          f"{scheduler.client.stats()}")
+    return counts, errors
 
 
 def main():
+    parser = argparse.ArgumentParser(description=f"Fetch Strava activities into {ACTIVITIES_SPOOL}")
+    parser.add_argument("--full", action="store_true", help="Re-download history instead of only new activities")
+    parser.add_argument("--max-pages", type=int, default=5, help="Pages to fetch in a full sync")
+    args = parser.parse_args()
+
     tokens = load_tokens()
     tokens = refresh_token_if_needed(tokens)
     access_token = tokens["access_token"]
 
-    activities = fetch_activities(access_token)
-    with open(ACTIVITIES_FILE, "w") as f:
-        json.dump(activities, f, indent=2)
+    count = sync(access_token, full=args.full, max_pages=args.max_pages, user_id=os.getenv("STRAVA_USER_ID"))
 
-    print(f"✅ Activities saved to {ACTIVITIES_FILE}")
+    print(f"✅ {count} activities spooled to {ACTIVITIES_SPOOL}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+"""
+Per-user, per-activity-type rollups by day/week/month/year in `activity_rollups`.
+
+store_activities.py refreshes the buckets touched by each ingest; run this script to
+rebuild everything from `activities`:
+
+    python utils/strava/rollups.py
+"""
+import os
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+PERIODS = ("day", "week", "month", "year")
+
+ROLLUP_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS activity_rollups (
+        user_id VARCHAR(50),
+        activity_type VARCHAR(50),
+        period VARCHAR(5) NOT NULL,
+        period_start DATE NOT NULL,
+        activity_count INT NOT NULL,
+        total_distance DOUBLE PRECISION,
+        total_duration BIGINT,
+        longest_distance DOUBLE PRECISION,
+        longest_duration INT,
+        fastest_speed DOUBLE PRECISION
+    );
+    CREATE INDEX IF NOT EXISTS activity_rollups_bucket_idx
+        ON activity_rollups (period, user_id, activity_type, period_start)
+"""
+
+# (user_id, activity_type, timestamp) of every activity version an ingest wrote or replaced
+TOUCHED_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS rollup_touched (
+        user_id VARCHAR(50),
+        activity_type VARCHAR(50),
+        timestamp TIMESTAMP
+    ) ON COMMIT DROP
+"""
+
+TOUCH_ACTIVITIES_SQL = """
+    INSERT INTO rollup_touched (user_id, activity_type, timestamp)
+    SELECT user_id, activity_type, timestamp FROM activities WHERE activity_id = ANY(%s)
+"""
+
+TOUCHED_BUCKETS = """
+    SELECT DISTINCT t.user_id, t.activity_type, p.period, DATE_TRUNC(p.period, t.timestamp)::date AS period_start
+    FROM rollup_touched t CROSS JOIN UNNEST(%s::text[]) AS p(period)
+    WHERE t.timestamp IS NOT NULL
+"""
+
+ALL_BUCKETS = """
+    SELECT DISTINCT a.user_id, a.activity_type, p.period, DATE_TRUNC(p.period, a.timestamp)::date AS period_start
+    FROM activities a CROSS JOIN UNNEST(%s::text[]) AS p(period)
+    WHERE a.timestamp IS NOT NULL
+"""
+
+DELETE_BUCKETS_SQL = """
+    DELETE FROM activity_rollups r
+    USING ({buckets}) b
+    WHERE r.period = b.period AND r.period_start = b.period_start
+      AND r.user_id IS NOT DISTINCT FROM b.user_id
+      AND r.activity_type IS NOT DISTINCT FROM b.activity_type
+"""
+
+# Recomputes whole buckets from `activities`, so re-fetched or edited activities are never double counted
+INSERT_BUCKETS_SQL = """
+    INSERT INTO activity_rollups (user_id, activity_type, period, period_start, activity_count, total_distance,
+                                  total_duration, longest_distance, longest_duration, fastest_speed)
+    SELECT b.user_id, b.activity_type, b.period, b.period_start, COUNT(*), SUM(a.distance), SUM(a.duration),
+           MAX(a.distance), MAX(a.duration), MAX(a.distance / NULLIF(a.duration, 0))
+    FROM ({buckets}) b
+    JOIN activities a
+      ON a.user_id IS NOT DISTINCT FROM b.user_id
+     AND a.activity_type IS NOT DISTINCT FROM b.activity_type
+     AND a.timestamp >= b.period_start
+     AND a.timestamp < b.period_start + ('1 ' || b.period)::interval
+    GROUP BY b.user_id, b.activity_type, b.period, b.period_start
+"""
+
+
+def begin_refresh(cur):
+    """Create the rollup table if needed and the per-transaction list of touched activities."""
+    cur.execute(ROLLUP_TABLE_SQL)
+    cur.execute(TOUCHED_TABLE_SQL)
+
+
+def touch(cur, activity_ids):
+    """Remember the stored versions of these activities (before and after they are written)."""
+    cur.execute(TOUCH_ACTIVITIES_SQL, (list(activity_ids),))
+
+
+def refresh_touched(cur):
+    """Recompute every bucket containing a touched activity; rebuilds all if the table is empty."""
+    cur.execute("SELECT EXISTS (SELECT 1 FROM activity_rollups)")
+    if not cur.fetchone()[0]:
+        return rebuild(cur)
+    cur.execute(DELETE_BUCKETS_SQL.format(buckets=TOUCHED_BUCKETS), (list(PERIODS),))
+    cur.execute(INSERT_BUCKETS_SQL.format(buckets=TOUCHED_BUCKETS), (list(PERIODS),))
+    return cur.rowcount
+
+
+def rebuild(cur):
+    """Recompute all rollups from `activities`; returns the number of buckets."""
+    cur.execute(ROLLUP_TABLE_SQL)
+    cur.execute("TRUNCATE activity_rollups")
+    cur.execute(INSERT_BUCKETS_SQL.format(buckets=ALL_BUCKETS), (list(PERIODS),))
+    buckets = cur.rowcount
+    cur.execute("ANALYZE activity_rollups")
+    return buckets
+
+
+def main():
+    conn = psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+    )
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            buckets = rebuild(cur)
+        conn.commit()
+        print(f"✅ Rebuilt {buckets} rollup buckets in {time.perf_counter() - start:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
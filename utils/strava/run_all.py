@@ -1,9 +1,19 @@
+import argparse
+import os
+import queue
 import subprocess
 import sys
+import threading
 
-def run_script(name):
+# Pages buffered between the fetcher and the embed/store consumer (bounds memory)
+PIPELINE_QUEUE_PAGES = int(os.getenv("PIPELINE_QUEUE_PAGES", "8"))
+
+# Scripts are resolved from the repo root, so the sync can run from any working directory
+REPO_ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+def run_script(name, *args):
     print(f"\n🚀 Running {name} ...")
-    result = subprocess.run([sys.executable, name], capture_output=True, text=True)
+    result = subprocess.run([sys.executable, os.path.join(REPO_ROOT, name), *args], capture_output=True, text=True)
     if result.returncode != 0:
         print(f"❌ {name} failed:")
         print(result.stderr)
@@ -11,9 +21,90 @@ def run_script(name):
     else:
         print(result.stdout)
 
+class PipelineStopped(Exception):
+    """Raised in the fetcher once the store step has stopped, instead of blocking on the full queue."""
+
+def run_pipeline(full=False, athletes=False):
+    """
+    Fetch, embed and store in one process, overlapping network, model and DB work.
+    With `athletes`, every athlete in the athletes file is fetched concurrently.
+    """
+    import fetch_activites
+    import store_activities
+
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_PAGES)
+    done = object()
+    stopped = threading.Event()
+    errors = []
+
+    def hand_off(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise PipelineStopped("store step stopped")
+
+    def produce():
+        try:
+            if athletes:
+                _, failed = fetch_activites.sync_athletes(fetch_activites.TokenStore(), full=full,
+                                                          on_activities=hand_off)
+                errors.extend(failed.values())
+                return
+            tokens = fetch_activites.refresh_token_if_needed(fetch_activites.load_tokens())
+            fetch_activites.sync(tokens["access_token"], full=full,
+                                 user_id=os.getenv("STRAVA_USER_ID"), on_activities=hand_off)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                hand_off(done)
+            except PipelineStopped:
+                pass
+
+    def consume():
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            yield from page
+
+    print("\n🚀 Running fetch → embed → store pipeline ...")
+    conn = store_activities.connect_db()
+    fetcher = threading.Thread(target=produce, name="strava-fetch", daemon=True)
+    fetcher.start()
+    try:
+        store_activities.store_activities(conn, consume())
+    finally:
+        stopped.set()  # if storing failed, the fetcher gives up at its next page
+        conn.close()
+        fetcher.join()
+    if errors:
+        print(f"❌ Fetch failed: {errors[0]}")
+        sys.exit(1)
+
 def main():
-    run_script("utils/strava/fetch_activites.py")
-    run_script("utils/strava/store_activities.py")
+    parser = argparse.ArgumentParser(description="Fetch and store Strava activities")
+    parser.add_argument("--full", action="store_true", help="Re-sync history instead of only new activities")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="Run fetch and store as separate scripts, handing off through the spool file")
+    parser.add_argument("--athletes", action="store_true",
+                        help="Sync every athlete in STRAVA_ATHLETES_FILE concurrently")
+    args = parser.parse_args()
+
+    if args.athletes:
+        run_pipeline(full=args.full, athletes=True)
+    elif args.subprocess:
+        run_script("utils/strava/fetch_activites.py", *(["--full"] if args.full else []))
+        run_script("utils/strava/store_activities.py")
+    else:
+        run_pipeline(full=args.full)
+    # Per-activity-type vector indexes for any type that has grown enough to need one
+    run_script("backend/vector_index.py", "partial")
+    # Per-type embedding centroids for the analytics plots
+    run_script("utils/misc/centroids.py")
     print("✅ All steps completed successfully.")
 
 if __name__ == "__main__":
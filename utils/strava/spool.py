@@ -0,0 +1,64 @@
+import gzip
+import json
+import os
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Append-only NDJSON hand-off between fetch and store (".gz" = gzip compressed)
+ACTIVITIES_SPOOL = os.getenv("ACTIVITIES_SPOOL", "activities.ndjson.gz")
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def reset_spool(path=ACTIVITIES_SPOOL):
+    """Start a new, empty spool."""
+    with _open(path, "w"):
+        pass
+
+
+def append_activities(activities, path=ACTIVITIES_SPOOL):
+    """Append one page of activities, one JSON object per line."""
+    with _open(path, "a") as f:
+        for activity in activities:
+            f.write(json.dumps(activity, separators=(",", ":")) + "\n")
+
+
+def read_spool(path=ACTIVITIES_SPOOL):
+    """Yield activities from a spool without loading the whole file (legacy .json lists are also accepted)."""
+    if not os.path.exists(path):
+        return
+    if path.endswith(".json"):
+        with open(path, "r") as f:
+            yield from json.load(f)
+        return
+    with _open(path, "r") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    print(f"⚠️ Skipping truncated line in {path}")  # left behind by an interrupted write
+        except EOFError:
+            print(f"⚠️ {path} ends with a truncated gzip member, ignoring the rest")
+
+
+def batched(iterable, size):
+    """Group an iterable into lists of at most `size` items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
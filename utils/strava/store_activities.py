@@ -1,76 +1,285 @@
-import json
+import csv
+import io
 import psycopg2
+import psycopg2.extras
 import os
-from sentence_transformers import SentenceTransformer
+import time
 from datetime import datetime
 
 from dotenv import load_dotenv
+from spool import ACTIVITIES_SPOOL, batched, read_spool
+import rollups
+from embedder import get_embedder
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Load the embedding model
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-
-# Load Strava activities
-with open("activities.json", "r") as file:
-    activities = json.load(file)
-
-# Connect to PostgreSQL
-conn = psycopg2.connect(
-    dbname=os.getenv("POSTGRES_DB"),
-    user=os.getenv("POSTGRES_USER"),
-    password=os.getenv("POSTGRES_PASSWORD"),
-    host=os.getenv("POSTGRES_HOST"),
-    port=os.getenv("POSTGRES_PORT"),
-)
-cur = conn.cursor()
-
-# Function to convert activity into an embedding
-def generate_embedding(activity):
-    text = f"{activity['name']} {activity['type']} {activity['distance']} meters in {activity['elapsed_time']} seconds"
-    print(f"Generating embedding for: {text}")
-    # Generate embedding using the model
-    return model.encode(text).tolist()
+STRAVA_USER_ID = os.getenv("STRAVA_USER_ID")
+
+# Ingestion tuning
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))  # activities per model.encode call and per DB write
+INGEST_WRITE_MODE = os.getenv("INGEST_WRITE_MODE", "copy")  # "copy" (staging table + merge) or "values"
+# Batches per transaction, so an interrupted ingest keeps what it stored (0 = one transaction for everything)
+INGEST_COMMIT_BATCHES = int(os.getenv("INGEST_COMMIT_BATCHES", "1"))
+
+UPSERT_COLUMNS = "activity_id, user_id, activity_type, distance, duration, timestamp, embedding"
+
+UPSERT_SQL = f"""
+    INSERT INTO activities ({UPSERT_COLUMNS})
+    VALUES %s
+    ON CONFLICT (activity_id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        activity_type = EXCLUDED.activity_type,
+        distance = EXCLUDED.distance,
+        duration = EXCLUDED.duration,
+        timestamp = EXCLUDED.timestamp,
+        embedding = EXCLUDED.embedding
+"""
+
+# timestamptz so the merge converts timestamps exactly like a direct INSERT does; seq numbers
+# rows in COPY order (COPY only lists UPSERT_COLUMNS) so the merge can keep the latest per activity
+STAGING_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS activities_staging (
+        seq BIGSERIAL,
+        activity_id BIGINT,
+        user_id VARCHAR(50),
+        activity_type VARCHAR(50),
+        distance FLOAT,
+        duration INT,
+        timestamp TIMESTAMPTZ,
+        embedding vector(384)
+    ) ON COMMIT DROP
+"""
+
+MERGE_SQL = f"""
+    INSERT INTO activities ({UPSERT_COLUMNS})
+    SELECT DISTINCT ON (activity_id) {UPSERT_COLUMNS}
+    FROM activities_staging
+    ORDER BY activity_id, seq DESC
+    ON CONFLICT (activity_id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        activity_type = EXCLUDED.activity_type,
+        distance = EXCLUDED.distance,
+        duration = EXCLUDED.duration,
+        timestamp = EXCLUDED.timestamp,
+        embedding = EXCLUDED.embedding
+"""
+
+# Invalidates backend result caches; runs in the ingest transaction so readers never see
+# new rows under the old generation (the table is created here too for databases set up
+# before it was added to schema.sql)
+GENERATION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS data_generation (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        generation BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+BUMP_GENERATION_SQL = """
+    INSERT INTO data_generation (id, generation, updated_at) VALUES (TRUE, 1, now())
+    ON CONFLICT (id) DO UPDATE SET generation = data_generation.generation + 1, updated_at = now()
+"""
+
+
+DELETE_SQL = "DELETE FROM activities WHERE activity_id = ANY(%s)"
+
+DELETE_ATHLETE_SQL = "DELETE FROM activities WHERE user_id = %s"
+
+
+def connect_db():
+    """Connect to PostgreSQL."""
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+    )
+
+
+# Text that gets embedded for an activity
+def activity_text(activity):
+    return f"{activity['name']} {activity['type']} {activity['distance']} meters in {activity['elapsed_time']} seconds"
+
+
+# Embed a batch of activities; unchanged texts come from the embedding cache, the rest in one model call
+def generate_embeddings(activities, batch_size=EMBED_BATCH_SIZE):
+    texts = [activity_text(activity) for activity in activities]
+    return get_embedder().embed(texts, batch_size=batch_size).tolist()
+
 
 # Function to convert ISO 8601 to PostgreSQL timestamp
 def parse_timestamp(iso_date):
     return datetime.fromisoformat(iso_date.replace("Z", "+00:00"))
 
 
-STRAVA_USER_ID = os.getenv("STRAVA_USER_ID")
-
-for activity in activities:
-    embedding = generate_embedding(activity)
-    activity_timestamp = parse_timestamp(activity["start_date"])
-    
-    cur.execute(
-        """
-        INSERT INTO activities (activity_id, user_id, activity_type, distance, duration, timestamp, embedding)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (activity_id) DO UPDATE SET
-            user_id = EXCLUDED.user_id,
-            activity_type = EXCLUDED.activity_type,
-            distance = EXCLUDED.distance,
-            duration = EXCLUDED.duration,
-            timestamp = EXCLUDED.timestamp,
-            embedding = EXCLUDED.embedding
-        """,
-        (
-            activity["id"],  # Unique Strava activity ID
-            STRAVA_USER_ID,
-            activity["type"],
-            activity["distance"],
-            activity["elapsed_time"],
-            activity_timestamp,
-            embedding,
-        ),
+def to_row(activity, embedding):
+    return (
+        activity["id"],  # Unique Strava activity ID
+        activity.get("user_id", STRAVA_USER_ID),  # set by multi-athlete syncs
+        activity["type"],
+        activity["distance"],
+        activity["elapsed_time"],
+        parse_timestamp(activity["start_date"]),
+        embedding,
     )
 
 
-# Commit and close connection
-conn.commit()
-cur.close()
-conn.close()
+def write_values(cur, rows):
+    """Upsert a batch with one multi-row INSERT ... VALUES statement."""
+    latest = {row[0]: row for row in rows}  # ON CONFLICT can't touch the same row twice in one statement
+    psycopg2.extras.execute_values(cur, UPSERT_SQL, list(latest.values()), page_size=len(latest))
+
+
+def copy_to_staging(cur, rows):
+    """Stream a batch into the staging table with COPY."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for activity_id, user_id, activity_type, distance, duration, timestamp, embedding in rows:
+        writer.writerow([
+            activity_id, user_id, activity_type, distance, duration, timestamp.isoformat(),
+            "[" + ",".join(repr(float(x)) for x in embedding) + "]",
+        ])
+    buffer.seek(0)
+    cur.copy_expert(f"COPY activities_staging ({UPSERT_COLUMNS}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def begin_transaction(cur, write_mode):
+    """Create the per-transaction staging and rollup tables (both are dropped on commit)."""
+    if write_mode == "copy":
+        cur.execute(STAGING_TABLE_SQL)
+    rollups.begin_refresh(cur)
+
+
+def commit_transaction(conn, cur, write_mode, stored_ids):
+    """
+    Merge staged rows, refresh the rollups they touch, bump the data generation and commit.
+    Returns (write seconds, rollup seconds).
+    """
+    write_time = rollup_time = 0.0
+    if write_mode == "copy":
+        t0 = time.perf_counter()
+        cur.execute(MERGE_SQL)
+        write_time = time.perf_counter() - t0
+    if stored_ids:
+        t0 = time.perf_counter()
+        rollups.touch(cur, stored_ids)
+        rollups.refresh_touched(cur)
+        rollup_time = time.perf_counter() - t0
+        cur.execute(GENERATION_TABLE_SQL)
+        cur.execute(BUMP_GENERATION_SQL)
+    conn.commit()
+    return write_time, rollup_time
+
+
+def store_activities(conn, activities, batch_size=EMBED_BATCH_SIZE, write_mode=INGEST_WRITE_MODE,
+                     commit_batches=INGEST_COMMIT_BATCHES):
+    """
+    Embed activities in batches and bulk-upsert them; returns the number stored.
+
+    `activities` can be any iterable (e.g. a spool reader or a queue consumer), so only one
+    batch is held in memory at a time. Every `commit_batches` batches are committed together
+    with their rollups and a generation bump, so an interruption loses at most that much.
+    """
+    if write_mode not in ("copy", "values"):
+        raise ValueError(f"Unknown write mode: {write_mode}")
+    total = 0
+    start = time.perf_counter()
+    embed_time = write_time = rollup_time = 0.0
+    stored_ids = []  # activities written in the open transaction
+    pending_batches = 0
+    cur = conn.cursor()
+    begin_transaction(cur, write_mode)
+
+    for batch in batched(activities, batch_size):
+        ids = [activity["id"] for activity in batch]
+        rollups.touch(cur, ids)  # versions about to be replaced still count towards their old buckets
+        stored_ids.extend(ids)
+        t0 = time.perf_counter()
+        embeddings = generate_embeddings(batch, batch_size)
+        t1 = time.perf_counter()
+        rows = [to_row(activity, embedding) for activity, embedding in zip(batch, embeddings)]
+        if write_mode == "copy":
+            copy_to_staging(cur, rows)
+        else:
+            write_values(cur, rows)
+        t2 = time.perf_counter()
+        embed_time += t1 - t0
+        write_time += t2 - t1
+
+        total += len(batch)
+        pending_batches += 1
+        if commit_batches and pending_batches >= commit_batches:
+            commit_write, commit_rollups = commit_transaction(conn, cur, write_mode, stored_ids)
+            write_time += commit_write
+            rollup_time += commit_rollups
+            stored_ids, pending_batches = [], 0
+            begin_transaction(cur, write_mode)
+        elapsed = time.perf_counter() - start
+        print(f"Stored {total} activities ({total / elapsed:.1f} activities/sec)")
+
+    commit_write, commit_rollups = commit_transaction(conn, cur, write_mode, stored_ids)
+    write_time += commit_write
+    rollup_time += commit_rollups
+    cur.close()
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed else 0.0
+    embedder = get_embedder()
+    print(f"✅ {total} activities in {elapsed:.1f}s ({rate:.1f} activities/sec; "
+          f"embedding {embed_time:.1f}s, database {write_time:.1f}s, rollups {rollup_time:.1f}s; "
+          f"{embedder.stats['cache_hits']}/{embedder.stats['texts']} embeddings from cache)")
+    return total
+
+
+def delete_activities(conn, activity_ids):
+    """Delete activities and refresh the rollup buckets they counted towards; returns the number deleted."""
+    activity_ids = list(activity_ids)
+    cur = conn.cursor()
+    rollups.begin_refresh(cur)
+    rollups.touch(cur, activity_ids)
+    cur.execute(DELETE_SQL, (activity_ids,))
+    deleted = cur.rowcount
+    if deleted:
+        rollups.refresh_touched(cur)
+        cur.execute(GENERATION_TABLE_SQL)
+        cur.execute(BUMP_GENERATION_SQL)
+    conn.commit()
+    cur.close()
+    return deleted
+
+
+def delete_athlete(conn, user_id):
+    """
+    Delete an athlete's activities and what is derived from them (rollups, centroids), e.g. after
+    they deauthorized the app; returns the number of activities deleted.
+    """
+    cur = conn.cursor()
+    cur.execute(DELETE_ATHLETE_SQL, (user_id,))
+    deleted = cur.rowcount
+    for table in ("activity_rollups", "activity_type_centroids"):  # created by later steps, may not exist yet
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+        if cur.fetchone()[0]:
+            cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+    cur.execute(GENERATION_TABLE_SQL)
+    cur.execute(BUMP_GENERATION_SQL)
+    conn.commit()
+    cur.close()
+    return deleted
+
+
+def main():
+    # Connect to PostgreSQL
+    conn = connect_db()
+    try:
+        # Stream Strava activities from the spool written by fetch_activites.py
+        store_activities(conn, read_spool(ACTIVITIES_SPOOL))
+    finally:
+        conn.close()
+
+    print("- Activities stored successfully! -")
+
 
-print("- Activities stored successfully! -")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
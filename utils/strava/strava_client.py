@@ -0,0 +1,290 @@
+"""
+Rate-limit-aware Strava API client and concurrent page/athlete fetch scheduler.
+
+All requests share one RateLimiter that follows Strava's X-RateLimit-Limit/-Usage headers
+(15-minute and daily windows), so pages and athletes can be fetched concurrently without
+tripping the limits. 429s wait for the window to reset; 5xx and connection errors are
+retried with exponential backoff and full jitter.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Load environment variables from .env file
+load_dotenv()
+
+STRAVA_API_URL = os.getenv("STRAVA_API_URL", "https://www.strava.com/api/v3")
+STRAVA_PAGE_CONCURRENCY = int(os.getenv("STRAVA_PAGE_CONCURRENCY", "3"))  # pages in flight per athlete
+STRAVA_ATHLETE_CONCURRENCY = int(os.getenv("STRAVA_ATHLETE_CONCURRENCY", "4"))  # athletes fetched at once
+STRAVA_MAX_RETRIES = int(os.getenv("STRAVA_MAX_RETRIES", "5"))
+STRAVA_BACKOFF_BASE = float(os.getenv("STRAVA_BACKOFF_BASE", "1"))  # seconds, doubled per retry
+STRAVA_HTTP_TIMEOUT = float(os.getenv("STRAVA_HTTP_TIMEOUT", "30"))
+# Requests left unused in each window, e.g. for the webhook worker or other tools
+STRAVA_RATE_RESERVE = int(os.getenv("STRAVA_RATE_RESERVE", "5"))
+# Give up instead of sleeping longer than this for a rate limit window (the daily one resets at midnight UTC)
+STRAVA_MAX_RATE_WAIT = float(os.getenv("STRAVA_MAX_RATE_WAIT", "1800"))
+
+SHORT_WINDOW = 15 * 60
+DAY = 24 * 60 * 60
+
+
+class StravaError(Exception):
+    """A Strava request failed for good."""
+
+
+class Unauthorized(StravaError):
+    """The access token was rejected (expired or revoked)."""
+
+
+class NotFound(StravaError):
+    """The resource does not exist or is no longer visible to this token (404)."""
+
+
+class RateLimitExhausted(StravaError):
+    """The rate limit budget won't free up within STRAVA_MAX_RATE_WAIT."""
+
+
+class RateLimiter:
+    """
+    Shared request budget for the 15-minute and daily windows.
+
+    Usage is counted locally as requests are made and corrected from the X-RateLimit-*
+    headers of every response; windows reset on Strava's schedule (quarter hours, midnight UTC).
+    """
+
+    def __init__(self, short_limit=200, daily_limit=2000, reserve=STRAVA_RATE_RESERVE,
+                 max_wait=STRAVA_MAX_RATE_WAIT, clock=time.time):
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._short_used = 0
+        self._daily_used = 0
+        self._short_window = self._window(SHORT_WINDOW)
+        self._day_window = self._window(DAY)
+        self._stats = {"requests": 0, "throttled": 0, "throttled_s": 0.0, "rate_limited": 0}
+
+    def _window(self, length):
+        return int(self.clock() // length)
+
+    def _roll(self):
+        if self._window(SHORT_WINDOW) != self._short_window:
+            self._short_window, self._short_used = self._window(SHORT_WINDOW), 0
+        if self._window(DAY) != self._day_window:
+            self._day_window, self._daily_used = self._window(DAY), 0
+
+    def acquire(self):
+        """Block until a request fits in both windows, then count it."""
+        with self._cond:
+            while True:
+                self._roll()
+                if (self._short_used < self.short_limit - self.reserve
+                        and self._daily_used < self.daily_limit - self.reserve):
+                    self._short_used += 1
+                    self._daily_used += 1
+                    self._stats["requests"] += 1
+                    return
+                now = self.clock()
+                if self._daily_used >= self.daily_limit - self.reserve:
+                    resume = (self._day_window + 1) * DAY
+                else:
+                    resume = (self._short_window + 1) * SHORT_WINDOW
+                wait = resume - now + random.uniform(0, 1)
+                if wait > self.max_wait:
+                    raise RateLimitExhausted(f"Rate limit budget exhausted for {wait:.0f}s")
+                self._stats["throttled"] += 1
+                self._stats["throttled_s"] += wait
+                print(f"⏳ Rate limit budget used ({self._short_used}/{self.short_limit} short, "
+                      f"{self._daily_used}/{self.daily_limit} daily), waiting {wait:.0f}s")
+                self._cond.wait(wait)  # releases the lock; other threads queue up behind us
+
+    def update(self, headers):
+        """Adopt the limits and usage Strava reports (the server's count wins if it is higher)."""
+        limit, usage = headers.get("X-RateLimit-Limit"), headers.get("X-RateLimit-Usage")
+        if not limit or not usage:
+            return
+        try:
+            short_limit, daily_limit = (int(v) for v in limit.split(","))
+            short_used, daily_used = (int(v) for v in usage.split(","))
+        except ValueError:
+            return
+        with self._cond:
+            self._roll()
+            self.short_limit, self.daily_limit = short_limit, daily_limit
+            self._short_used = max(self._short_used, short_used)
+            self._daily_used = max(self._daily_used, daily_used)
+
+    def exhausted(self):
+        """A 429 came back: treat the short window as used up."""
+        with self._cond:
+            self._short_used = max(self._short_used, self.short_limit)
+            self._stats["rate_limited"] += 1
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(short_used=self._short_used, short_limit=self.short_limit,
+                         daily_used=self._daily_used, daily_limit=self.daily_limit)
+        stats["throttled_s"] = round(stats["throttled_s"], 1)
+        return stats
+
+
+class StravaClient:
+    """GETs against the Strava API through pooled keep-alive sessions (one per thread) and the shared limiter."""
+
+    def __init__(self, limiter=None, base_url=STRAVA_API_URL, max_retries=STRAVA_MAX_RETRIES,
+                 backoff_base=STRAVA_BACKOFF_BASE, timeout=STRAVA_HTTP_TIMEOUT):
+        self.limiter = limiter or RateLimiter()
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"retries": 0, "errors": 0}
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            self._local.session = session
+        return session
+
+    def _backoff(self, attempt):
+        """Full jitter: uniform in [0, base * 2^attempt]."""
+        with self._lock:
+            self._stats["retries"] += 1
+        time.sleep(random.uniform(0, self.backoff_base * 2 ** attempt))
+
+    def get(self, path, access_token, params=None):
+        """GET a JSON resource, retrying 429/5xx/connection errors; raises StravaError when it gives up."""
+        url = f"{self.base_url}{path}"
+        headers = {"Authorization": f"Bearer {access_token}"}
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                res = self._session().get(url, headers=headers, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise StravaError(f"GET {path} failed: {e}") from e
+                self._backoff(attempt)
+                continue
+            self.limiter.update(res.headers)
+            if res.status_code == 200:
+                return res.json()
+            if res.status_code == 401:
+                raise Unauthorized(f"GET {path}: 401 {res.text}")
+            if res.status_code == 404:
+                raise NotFound(f"GET {path}: 404 {res.text}")
+            if res.status_code == 429:
+                self.limiter.exhausted()  # the next acquire() waits for the window to reset
+                continue
+            if res.status_code >= 500 and attempt < self.max_retries:
+                self._backoff(attempt)
+                continue
+            with self._lock:
+                self._stats["errors"] += 1
+            raise StravaError(f"GET {path}: {res.status_code}, {res.text}")
+        with self._lock:
+            self._stats["errors"] += 1
+        raise StravaError(f"GET {path}: still failing after {self.max_retries} retries")
+
+    def activities_page(self, access_token, page, per_page=50, after=None):
+        params = {"per_page": per_page, "page": page}
+        if after is not None:
+            params["after"] = after
+        return self.get("/athlete/activities", access_token, params)
+
+    def activity(self, access_token, activity_id):
+        return self.get(f"/activities/{int(activity_id)}", access_token)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["rate_limit"] = self.limiter.stats()
+        return stats
+
+
+class FetchScheduler:
+    """Fetches activity pages for many athletes concurrently within the shared rate limit budget."""
+
+    def __init__(self, client=None, page_concurrency=STRAVA_PAGE_CONCURRENCY,
+                 athlete_concurrency=STRAVA_ATHLETE_CONCURRENCY):
+        self.client = client or StravaClient()
+        self.page_concurrency = max(1, page_concurrency)
+        self.athlete_concurrency = max(1, athlete_concurrency)
+
+    def _page(self, get_token, page, per_page, after):
+        try:
+            return self.client.activities_page(get_token(), page, per_page, after)
+        except Unauthorized:
+            return self.client.activities_page(get_token(force_refresh=True), page, per_page, after)
+
+    def fetch_pages(self, get_token, per_page=50, max_pages=None, after=None, start_page=1, on_page=None):
+        """
+        Fetch one athlete's pages with up to `page_concurrency` requests in flight.
+
+        Pages are handed to `on_page(page, page_data)` in order. Fetching stops at the first
+        empty page (Strava can return short pages before the end), so at most page_concurrency - 1
+        requests past it are wasted.
+        Returns the number of activities fetched.
+        """
+        total = 0
+        with ThreadPoolExecutor(max_workers=self.page_concurrency) as executor:
+            pending = deque()
+            next_page = start_page
+
+            def fill():
+                nonlocal next_page
+                while len(pending) < self.page_concurrency and (max_pages is None or next_page <= max_pages):
+                    pending.append((next_page, executor.submit(self._page, get_token, next_page, per_page, after)))
+                    next_page += 1
+
+            fill()
+            try:
+                while pending:
+                    page, future = pending.popleft()
+                    page_data = future.result()
+                    if not page_data:
+                        break
+                    print(f"Fetched page {page} ({len(page_data)} activities)")
+                    total += len(page_data)
+                    if on_page:
+                        on_page(page, page_data)
+                    fill()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+        return total
+
+    def fetch_athletes(self, athletes, on_activities, per_page=50, max_pages=None):
+        """
+        Fetch several athletes concurrently. `athletes` maps user_id -> (get_token, after);
+        `on_activities(user_id, page_data)` receives every page. Returns (counts, errors) by user_id.
+        """
+        counts, errors = {}, {}
+
+        def one(user_id, get_token, after):
+            try:
+                counts[user_id] = self.fetch_pages(
+                    get_token, per_page=per_page, max_pages=None if after is not None else max_pages, after=after,
+                    on_page=lambda page, page_data: on_activities(user_id, page_data))
+            except Exception as e:  # one athlete's failure (e.g. a revoked token) must not stop the others
+                print(f"❌ Fetch failed for athlete {user_id}: {e}")
+                errors[user_id] = str(e)
+
+        with ThreadPoolExecutor(max_workers=self.athlete_concurrency) as executor:
+            for user_id, (get_token, after) in athletes.items():
+                executor.submit(one, user_id, get_token, after)
+        return counts, errors
@@ -0,0 +1,257 @@
+"""
+Apply queued Strava webhook events to `activities`.
+
+Each batch re-fetches only the created/updated activities, embeds and upserts them through
+store_activities (rollups and the result cache generation included) and deletes removed ones.
+When an athlete deauthorizes the app, their activities, rollups, centroids and tokens are deleted.
+Runs inside server/webhook_server.py by default, or on its own:
+
+    python utils/strava/webhook_worker.py
+    python utils/strava/webhook_worker.py --once
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from dotenv import load_dotenv
+
+from event_queue import EventQueue
+from fetch_activites import TokenStore
+from strava_client import NotFound, StravaClient, StravaError, Unauthorized
+
+# Load environment variables from .env file
+load_dotenv()
+
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+# After the first event of a batch arrives, wait this long (s) for the rest of a burst
+WEBHOOK_BATCH_WAIT = float(os.getenv("WEBHOOK_BATCH_WAIT", "2"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))  # picks up events queued by other processes
+WEBHOOK_RETRY_DELAY = float(os.getenv("WEBHOOK_RETRY_DELAY", "60"))  # doubled per failed attempt
+WEBHOOK_FETCH_CONCURRENCY = int(os.getenv("WEBHOOK_FETCH_CONCURRENCY", "4"))
+
+
+def is_deauthorization(event):
+    """An athlete revoking the app's access: {"object_type": "athlete", "updates": {"authorized": "false"}}."""
+    return event.get("object_type") == "athlete" and \
+        str((event.get("updates") or {}).get("authorized", "")).lower() == "false"
+
+
+def coalesce(events):
+    """
+    Reduce a batch to the final action per activity: {activity_id: ("upsert" | "delete", owner_id)}.
+
+    A delete wins over earlier creates/updates; several updates to one activity need one fetch.
+    """
+    actions = {}
+    for event in events:
+        if event.get("object_type") != "activity":
+            continue
+        activity_id = int(event["object_id"])
+        if event["aspect_type"] == "delete" or actions.get(activity_id, ("",))[0] == "delete":
+            actions[activity_id] = ("delete", event.get("owner_id"))
+        else:
+            actions[activity_id] = ("upsert", event.get("owner_id"))
+    return actions
+
+
+class WebhookWorker:
+    """Drains the event queue in batches; events that fail are retried with backoff."""
+
+    def __init__(self, queue=None, token_store=None, client=None, batch_size=WEBHOOK_BATCH_SIZE,
+                 batch_wait=WEBHOOK_BATCH_WAIT, fetch_concurrency=WEBHOOK_FETCH_CONCURRENCY):
+        self.queue = queue or EventQueue()
+        self.token_store = token_store or TokenStore()
+        self.client = client or StravaClient()
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.fetch_concurrency = max(1, fetch_concurrency)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "events": 0, "upserted": 0, "deleted": 0, "skipped": 0, "failed": 0,
+                       "deauthorized": 0, "last_batch_ms": 0.0}
+
+    def _claim_batch(self):
+        """Claim available events, lingering briefly so a burst is handled as one batch."""
+        events = self.queue.claim(self.batch_size)
+        if not events:
+            return events
+        deadline = time.monotonic() + self.batch_wait
+        while len(events) < self.batch_size and not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.queue.wait(remaining)
+            events.extend(self.queue.claim(self.batch_size - len(events)))
+        return events
+
+    def _fetch(self, activity_id, user_id):
+        try:
+            activity = self.client.activity(self.token_store.access_token(user_id), activity_id)
+        except Unauthorized:
+            activity = self.client.activity(self.token_store.access_token(user_id, force_refresh=True), activity_id)
+        activity["user_id"] = user_id
+        return activity
+
+    def process(self, events):
+        """Apply one batch; returns the queue ids of events that failed and were rescheduled."""
+        import store_activities  # pulls in the embedding stack, so only once there is work
+
+        start = time.perf_counter()
+        actions = coalesce(events)
+        deauthorized = {}  # user_id -> athlete id
+        failed_athletes = {}
+        for event in events:
+            if is_deauthorization(event):
+                user_id = self.token_store.user_for_athlete(event["object_id"])
+                if user_id is None:
+                    # Its tokens may not have reached this process's athletes file yet
+                    failed_athletes[int(event["object_id"])] = LookupError(
+                        f"no tokens for deauthorized athlete {event['object_id']}")
+                else:
+                    deauthorized[user_id] = int(event["object_id"])
+            elif event.get("object_type") == "athlete":
+                print(f"ℹ️ Athlete {event.get('object_id')} update: {event.get('updates')}")
+
+        deletes = {activity_id for activity_id, (action, _) in actions.items() if action == "delete"}
+        upserts = {}
+        skipped = set()
+        failed = {}
+        for activity_id, (action, owner_id) in actions.items():
+            if action != "upsert":
+                continue
+            user_id = self.token_store.user_for_athlete(owner_id) if owner_id is not None else None
+            if user_id in deauthorized:
+                skipped.add(activity_id)  # everything of theirs is deleted below
+            elif user_id is None:
+                # Retried: the athlete may not have reached this process's athletes file yet
+                failed[activity_id] = LookupError(f"no tokens for athlete {owner_id}")
+            else:
+                upserts[activity_id] = user_id
+
+        fetched = []
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+            futures = {activity_id: executor.submit(self._fetch, activity_id, user_id)
+                       for activity_id, user_id in upserts.items()}
+            for activity_id, future in futures.items():
+                try:
+                    fetched.append(future.result())
+                except NotFound:
+                    deletes.add(activity_id)  # deleted or made private since the event was sent
+                except (StravaError, KeyError, ValueError) as e:
+                    failed[activity_id] = e
+
+        stored = deleted = 0
+        conn = store_activities.connect_db()
+        try:
+            try:
+                if fetched:
+                    stored = store_activities.store_activities(conn, fetched)
+                if deletes:
+                    deleted = store_activities.delete_activities(conn, deletes)
+            except psycopg2.Error as e:
+                conn.rollback()
+                failed.update({activity_id: e for activity_id in actions if activity_id not in skipped})
+            for user_id, athlete_id in deauthorized.items():
+                try:
+                    removed = store_activities.delete_athlete(conn, user_id)
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    failed_athletes[athlete_id] = e
+                    continue
+                self.token_store.forget(user_id)  # only once their data is gone, so a retry still finds them
+                deleted += removed
+                print(f"🗑️ Athlete {athlete_id} deauthorized: deleted {removed} activities and their tokens")
+        finally:
+            conn.close()
+
+        retried = []
+        done = []
+        for event in events:
+            if event.get("object_type") == "activity":
+                error = failed.get(int(event["object_id"]))
+            else:
+                error = failed_athletes.get(int(event["object_id"]))
+            if error is None:
+                done.append(event["queue_id"])
+                continue
+            print(f"⚠️ Event {event['queue_id']} for {event['object_type']} {event['object_id']} failed "
+                  f"(attempt {event['attempts']}): {error}")
+            self.queue.retry(event, error, WEBHOOK_RETRY_DELAY * 2 ** (event["attempts"] - 1))
+            retried.append(event["queue_id"])
+        self.queue.ack(done)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["events"] += len(events)
+            self._stats["upserted"] += stored
+            self._stats["deleted"] += deleted
+            self._stats["skipped"] += len(skipped)
+            self._stats["deauthorized"] += len(deauthorized) - len(set(failed_athletes) & set(deauthorized.values()))
+            self._stats["failed"] += len(retried)
+            self._stats["last_batch_ms"] = round(elapsed_ms, 1)
+        print(f"✅ {len(events)} events: {stored} activities stored, {deleted} deleted, "
+              f"{len(retried)} rescheduled in {elapsed_ms:.0f}ms")
+        return retried
+
+    def run_once(self):
+        """Process everything currently available; returns the number of events handled."""
+        handled = 0
+        while True:
+            events = self.queue.claim(self.batch_size)
+            if not events:
+                return handled
+            self.process(events)
+            handled += len(events)
+
+    def run(self):
+        """Process batches until stop() is called."""
+        while not self._stop.is_set():
+            events = self._claim_batch()
+            if not events:
+                self.queue.wait(WEBHOOK_POLL_INTERVAL)
+                continue
+            try:
+                self.process(events)
+            except Exception as e:
+                # Leased events become available again when the lease expires
+                print(f"❌ Webhook batch failed: {e}")
+                self._stop.wait(WEBHOOK_POLL_INTERVAL)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="webhook-worker", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue"] = self.queue.stats()
+        stats["strava"] = self.client.stats()
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--once", action="store_true", help="Drain the queue and exit")
+    args = parser.parse_args()
+
+    worker = WebhookWorker()
+    if args.once:
+        print(f"✅ Handled {worker.run_once()} events; {worker.queue.stats()}")
+        return
+    print(f"👷 Processing webhook events from {worker.queue.path}")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()